@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+""" Benchmark refimgdb.py queries before and after indexing site table
+
+Usage:
+    bench_refimgdb.py [options] [<database>]
+
+Options:
+    -n --nrow <n>           Number of rows of synthetic site table
+                                [default: 1000000]
+    -d --ndate <n>          Number of image dates of each FID [default: 4]
+    -r --repeat <n>         Number of times each query is timed [default: 50]
+    -u --nupdate <n>        Number of rows in bulk update [default: 100]
+    -h --help               Show help
+
+Creates a synthetic site table in <database> (or a temporary file, removed
+afterwards), opened with refimgdb.openDB, and reports the median time of
+each query with no indexes and again after refimgdb.createIndexes. Column
+names are read with "SELECT *" before, as refimgdb.py once did, and with
+"PRAGMA table_info" after. Refuses
+to run on a database that already has a site table, so it cannot replace
+the real one.
+
+"""
+from docopt import docopt
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+import refimgdb
+
+SCHEMA = '''
+CREATE TABLE site (
+    fid INTEGER,
+    image_date DATE,
+    class_progress TEXT,
+    interp_progress TEXT,
+    analyst TEXT,
+    notes TEXT
+);
+'''
+
+def has_site(database):
+    """
+    Return True if database file exists and has a site table, checked
+    without changing its settings (e.g., journal mode)
+    """
+    if not os.path.exists(database):
+        return False
+    db = sqlite3.connect(database)
+    try:
+        return db.execute("SELECT 1 FROM sqlite_master WHERE type='table' "
+                          "AND name='site';").fetchone() is not None
+    finally:
+        db.close()
+
+def create_site(db, nrow, ndate, seed=0):
+    """
+    Fill synthetic site table with nrow rows, ndate image dates per FID
+    """
+    rng = random.Random(seed)
+    classes = refimgdb.VOCABULARY['class_progress']
+    interps = refimgdb.VOCABULARY['interp_progress']
+
+    def rows():
+        for i in xrange(nrow):
+            yield (i // ndate,
+                   '%i-%02i-%02i' % (2000 + i % ndate, rng.randint(1, 12),
+                                     rng.randint(1, 28)),
+                   rng.choice(classes), rng.choice(interps),
+                   'analyst%i' % rng.randint(1, 20), '')
+
+    db.execute(SCHEMA)
+    with db:
+        db.executemany('INSERT INTO site VALUES (?, ?, ?, ?, ?, ?);', rows())
+
+def select_column_names(db):
+    """
+    Return column names of site as refimgdb.getColumnNames did before
+    reading PRAGMA table_info, from the description of SELECT *
+    """
+    cursor = db.cursor()
+    cursor.execute('SELECT * FROM site')
+    return list(col[0] for col in cursor.description)
+
+def timeit(func, args_list):
+    """
+    Return median seconds of calling func with each tuple of args
+    """
+    times = []
+    for args in args_list:
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+def run_queries(db, nfid, repeat, nupdate, column_names, seed=0):
+    """
+    Return list of query name and median seconds, reading column names with
+    column_names(db)
+    """
+    rng = random.Random(seed)
+    fids = [rng.randint(0, nfid - 1) for _ in range(repeat)]
+    pairs = [(f, rng.choice(refimgdb.getDates(db, f))) for f in
+             [rng.randint(0, nfid - 1) for _ in range(repeat)]]
+    updates = [({'fid': rng.randint(0, nfid - 1),
+                 'class_progress': rng.choice(
+                     refimgdb.VOCABULARY['class_progress'])}
+                for _ in range(nupdate)) for _ in range(3)]
+
+    return [
+        ('getColumnNames',
+         timeit(lambda: column_names(db), [()] * repeat)),
+        ('getDates',
+         timeit(lambda f: refimgdb.getDates(db, f), [(f, ) for f in fids])),
+        ('queryFID (fid)',
+         timeit(lambda f: refimgdb.queryFID(db, f, None, None).fetchall(),
+                [(f, ) for f in fids])),
+        ('queryFID (fid, date)',
+         timeit(lambda f, d: refimgdb.queryFID(
+             db, f, d, 'class_progress').fetchall(),
+                pairs)),
+        ('class_progress count',
+         timeit(lambda c: db.execute(
+             'SELECT COUNT(*) FROM site WHERE class_progress=?;',
+             (c, )).fetchone(),
+                [(c, ) for c in refimgdb.VOCABULARY['class_progress']])),
+        ('queryFIDs (%i)' % repeat,
+         timeit(lambda: refimgdb.queryFIDs(db, fids), [()] * 3)),
+        ('updateFIDs (%i)' % nupdate,
+         timeit(lambda rows: refimgdb.updateFIDs(db, rows),
+                [(u, ) for u in updates]))
+    ]
+
+def main():
+    """
+    Parse arguments, build table and report timings
+    """
+    try:
+        nrow = int(arguments['--nrow'])
+        ndate = int(arguments['--ndate'])
+        repeat = int(arguments['--repeat'])
+        nupdate = int(arguments['--nupdate'])
+    except ValueError:
+        print 'Error: number of rows, dates, repeats and updates must be ' \
+            'integers'
+        sys.exit(1)
+
+    database = arguments['<database>']
+    remove = database is None
+    if remove:
+        fd, database = tempfile.mkstemp(suffix='.sqlite')
+        os.close(fd)
+    elif has_site(database):
+        print 'Error: %s already has a site table. Benchmark in a new ' \
+            'database file' % database
+        sys.exit(1)
+
+    try:
+        db = refimgdb.openDB(database)
+        print 'Creating site table of %i rows' % nrow
+        start = time.time()
+        create_site(db, nrow, ndate)
+        print '    %.1fs' % (time.time() - start)
+
+        # Before also reads column names with SELECT *, as refimgdb did
+        before = run_queries(db, nrow // ndate, repeat, nupdate,
+                             select_column_names)
+
+        print 'Creating indexes'
+        start = time.time()
+        refimgdb.createIndexes(db)
+        print '    %.1fs' % (time.time() - start)
+
+        after = run_queries(db, nrow // ndate, repeat, nupdate,
+                            refimgdb.getColumnNames)
+        db.close()
+    finally:
+        if remove:
+            for ext in ('', '-wal', '-shm'):
+                if os.path.exists(database + ext):
+                    os.remove(database + ext)
+
+    print ''
+    print '%-24s %12s %12s %10s' % ('Query', 'Before (ms)', 'After (ms)',
+                                    'Speedup')
+    for (name, b), (_, a) in zip(before, after):
+        print '%-24s %12.3f %12.3f %9.1fx' % (name, b * 1000, a * 1000,
+                                              b / a if a > 0 else 0)
+
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    main()
@@ -9,9 +9,28 @@ Options:
     -w --where <columns>        Columns to select [default: fid]
     -d --delimit <delimiter>    Delimiter for CSV file [default: ,]
     -q --quotechar <quotechar>  Quote character [default: "]
+    -n --dry-run                Check CSV file without updating
+    --no-index                  Do not index "--where" columns before updating
+    --no-wal                    Do not switch database to write-ahead log
     -v --verbose                Show verbose debugging options
     --quiet                     Be quiet
     -h --help                   Show help messages
+
+Each row of the CSV file updates the rows of the table matching its values
+of the "--where" columns, setting every other column of the CSV file. Values
+of columns with a fixed vocabulary (e.g., class_progress) are checked and
+normalized as in refimgdb.py, and all rows are checked before updating any.
+All updates are applied with one prepared statement in one transaction, so
+either every row is updated or none are. Each update looks up rows by the
+"--where" columns, which are indexed first unless an index already covers
+them.
+
+Example CSV file:
+
+    fid,image_date,class_progress
+    1001,2010-06-15,Complete - edited
+    1002,2011-07-01,assigned
+
 """
 from docopt import docopt
 
@@ -20,19 +39,69 @@ import os
 import sqlite3
 import sys
 
+# Bulk updates and vocabularies are shared with glcv/refimgdb.py
+try:
+    import refimgdb
+except ImportError:
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..'))
+    import refimgdb
+
 VERBOSE = False
 QUIET = False
 
-def update_sqlite3_db(database, csvfile, table, where, delimit, quotechar):
+def read_updates(csvfile, delimit, quotechar):
+    """
+    Return column names and list of dict of values of each row of CSV file
+    """
+    with open(csvfile, 'rb') as f:
+        reader = csv.DictReader(f, delimiter=delimit, quotechar=quotechar)
+        rows = [dict((k.strip(), v.decode('utf-8').strip()
+                      if v is not None else None)
+                     for k, v in row.iteritems() if k is not None)
+                for row in reader]
+        fieldnames = [k.strip() for k in reader.fieldnames or []]
+
+    return fieldnames, rows
+
+def update_sqlite3_db(database, csvfile, table, where, delimit, quotechar,
+                      dry_run=False, wal=True, index=True):
     """
     Open database file updating where specified in CSV file
     """
-    print database
-    print csvfile
-    print table
-    print where
-    print delimit
-    print quotechar
+    fieldnames, rows = read_updates(csvfile, delimit, quotechar)
+    missing = [w for w in where if w not in fieldnames]
+    if missing:
+        print 'Error: CSV file has no column %s' % ', '.join(missing)
+        sys.exit(1)
+    if VERBOSE:
+        print 'Read %i rows setting %s' % (
+            len(rows), ', '.join(f for f in fieldnames if f not in where))
+
+    db = refimgdb.openDB(database, wal=wal and not dry_run, quiet=not VERBOSE)
+
+    try:
+        if index and not dry_run:
+            name = refimgdb.createIndex(db, where, table)
+            if name is not None and not QUIET:
+                print 'Created index %s' % name
+        if dry_run:
+            columns, params = refimgdb.prepareUpdates(db, rows, where, table)
+            if not QUIET:
+                print 'Checked %i rows' % len(params)
+        else:
+            n = refimgdb.updateFIDs(db, rows, where, table)
+            if not QUIET:
+                print 'Updated %i rows of %s from %i rows of CSV file' % (
+                    n, table, len(rows))
+    except ValueError as err:
+        print 'Error: %s' % err
+        sys.exit(1)
+    except sqlite3.Error as err:
+        print 'Error: could not update database: %s' % err
+        sys.exit(1)
+    finally:
+        db.close()
 
 def main():
     """
@@ -61,7 +130,7 @@ def main():
 
     # Database columns to select where
     where = arguments['--where']
-    where = where.replace(', ', ' ').split(' ')
+    where = where.replace(',', ' ').split()
 
     # CSV file delimiter
     delim = arguments['--delimit']
@@ -69,7 +138,10 @@ def main():
     # Quote character
     quotechar = arguments['--quotechar']
 
-    update_sqlite3_db(database, csvfile, table, where, delim, quotechar)
+    update_sqlite3_db(database, csvfile, table, where, delim, quotechar,
+                      dry_run=arguments['--dry-run'],
+                      wal=not arguments['--no-wal'],
+                      index=not arguments['--no-index'])
 
 if __name__ == '__main__':
     arguments = docopt(__doc__)
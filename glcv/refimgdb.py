@@ -38,6 +38,37 @@ import sqlite3
 ###
 setdebug = False
 
+###
+# Default database and acceptable values of columns
+###
+DB_PATH = "/projectnb/modislc/projects/glcv/docs/database/glcv_db.sqlite"
+
+# Key - column name
+# Value - acceptable values
+VOCABULARY = dict([('class_progress', list(['Unassigned',
+                                            'Assigned',
+                                            'Complete - unedited',
+                                            'Complete - edited',
+                                            'Complete - another date'])),
+                   ('interp_progress', list(['incomplete', 'in progress',
+                                             'review', 'complete']))])
+
+# Number of FIDs in each bulk query, below SQLite's limit of 999 parameters
+QUERY_CHUNK = 500
+
+# Indexes of site table as name and columns. Queries filter on fid and
+# image_date, which the first index serves alone or together.
+SITE_INDEXES = [('site_fid_date', ('fid', 'image_date')),
+                ('site_image_date', ('image_date', )),
+                ('site_class_progress', ('class_progress', ))]
+
+# Connection settings: write-ahead log, fewer syncs (safe with WAL), 64 MB
+# page cache and temporary tables in memory
+PRAGMAS = [('journal_mode', 'WAL'),
+           ('synchronous', 'NORMAL'),
+           ('cache_size', -64000),
+           ('temp_store', 'MEMORY')]
+
 ###
 # Class for auto-completion
 ###
@@ -73,13 +104,13 @@ def checkInt(string):
     else:
         return False
 
-def getColumnNames(db):
+def getColumnNames(db, table='site'):
     # Get cursor
     cursor = db.cursor()
-    # Get all
-    cursor.execute('SELECT * FROM site')
+    # Read schema of table instead of querying it
+    cursor.execute('PRAGMA table_info(%s)' % table)
 
-    desc = list(col[0] for col in cursor.description)
+    desc = list(str(col[1]) for col in cursor.fetchall())
     return desc
 
 def getDates(db, fid):
@@ -95,19 +126,73 @@ def getDates(db, fid):
     return dates
 
 ###
-# Function that opens database
+# Function that opens database. Open one connection for the session, tuned
+# with PRAGMAS, and pass it to every function. Write-ahead log lets readers
+# continue during bulk updates.
 ###
-def openDB():
-    path = "/projectnb/modislc/projects/glcv/docs/database/glcv_db.sqlite"
-    
+def openDB(path=DB_PATH, wal=True, quiet=False):
     # Open db connection with parsing of types
     # See: http://stackoverflow.com/questions/4272908
     db = sqlite3.connect(path, detect_types=sqlite3.PARSE_DECLTYPES)
-    print 'Opened database: ' + path
+    if not quiet:
+        print 'Opened database: ' + path
     #db.text_factory = lambda x: unicode(x, "utf-8", "ignore")
+    tuneDB(db, wal)
 
     return db
 
+# Apply PRAGMAS to connection, skipping journal settings unless wal
+def tuneDB(db, wal=True):
+    for pragma, value in PRAGMAS:
+        if not wal and pragma in ('journal_mode', 'synchronous'):
+            continue
+        db.execute('PRAGMA %s=%s' % (pragma, value))
+
+###
+# Functions for managing schema
+###
+# Returns dict of index name and list of its columns for table
+def getIndexes(db, table='site'):
+    cursor = db.cursor()
+    cursor.execute('PRAGMA index_list(%s)' % table)
+    names = [str(row[1]) for row in cursor.fetchall()]
+
+    indexes = {}
+    for name in names:
+        cursor.execute('PRAGMA index_info(%s)' % name)
+        indexes[name] = [str(row[2]) for row in sorted(cursor.fetchall())]
+    return indexes
+
+# Creates index of columns unless an index already starts with them
+# Returns name of index created, or None
+def createIndex(db, columns, table='site', name=None):
+    columns = list(columns)
+    checkColumns(db, columns, table)
+    for index in getIndexes(db, table).values():
+        if set(index[:len(columns)]) == set(columns):
+            return None
+
+    if name is None:
+        name = '_'.join([table] + columns)
+    with db:
+        db.execute('CREATE INDEX IF NOT EXISTS %s ON %s (%s);' %
+                   (name, table, ', '.join(columns)))
+    return name
+
+# Creates missing indexes of site table and updates query planner statistics
+# Returns names of indexes created
+def createIndexes(db, table='site', indexes=SITE_INDEXES):
+    names = getColumnNames(db, table)
+    created = []
+    for name, columns in indexes:
+        if all(c in names for c in columns):
+            if createIndex(db, columns, table, name) is not None:
+                created.append(name)
+    if created:
+        with db:
+            db.execute('ANALYZE %s;' % table)
+    return created
+
 ###
 # Main functions for user interaction. Includes raw_input prompts and checks on
 # user input. Used only for terminal mode
@@ -239,29 +324,29 @@ def promptValue():
             success = True
     return value
 
-# Checks value input by user against dictionary of acceptable values
-def checkValue(column, value):
-    # Create a dictionary of lists
-    # Key - column name
-    # Value - acceptable values
-    d = dict([('class_progress', list(['Unassigned',
-                                       'Assigned',
-                                       'Complete - unedited',
-                                       'Complete - edited',
-                                       'Complete - another date'])),
-              ('interp_progress', list(['incomplete', 'in progress', 'review',
-                                        'complete']))])
+# Returns value as spelled in dictionary of acceptable values for column, or
+# raises ValueError if value is not acceptable
+def normalizeValue(column, value):
     # Check if column is in dictionary
-    if column in d.keys():
+    if column in VOCABULARY and value is not None:
+        lower = [x.lower() for x in VOCABULARY[column]]
         # Check if value is in acceptable list
-        if value.lower() in [x.lower() for x in d[column]]:
-            # Get index of value in acceptable list
-            index = [x.lower() for x in d[column]].index(value.lower())
-            value = d[column][index]
-        else:
-            print 'Error: unacceptable entry. Use the following: '
-            print d[column]
-            value = None
+        if value.lower() not in lower:
+            raise ValueError('unacceptable %s "%s". Use one of: %s' %
+                             (column, value, ', '.join(VOCABULARY[column])))
+        # Get value from acceptable list
+        value = VOCABULARY[column][lower.index(value.lower())]
+
+    return value
+
+# Checks value input by user against dictionary of acceptable values
+def checkValue(column, value):
+    try:
+        value = normalizeValue(column, value)
+    except ValueError:
+        print 'Error: unacceptable entry. Use the following: '
+        print VOCABULARY[column]
+        value = None
 
     return value 
 
@@ -422,34 +507,120 @@ def print_query(cursor):
 
 # Function to query DB and update FID/date
 def updateFID(db, fid, date, column, value):
-    # Get cursor
-    cursor = db.cursor()
-
     # Check if column is specified - needs to be for updates
     if column is None:
         print 'Error: updating database requires a column'
+        return
     elif value is None:
         print 'Error: cannot update database with null value'
+        return
     elif fid is None:
         print 'Error: must select a FID'
+        return
 
-    command = '''
-    UPDATE site
-    SET %s=:value
-    WHERE fid=:id;
-    ''' % column
+    # Update just the date, if given
+    row = {'fid': fid, column: value}
+    where = ['fid']
+    if date is not None:
+        row['image_date'] = date
+        where.append('image_date')
 
-    # Execute commmand
-    cursor.execute(command, {"value":value, "id":fid})
-    # Check data type from update command
     try:
-        cursor.execute("SELECT * FROM site WHERE fid=(?)", (fid,))
-    except ValueError as err:
-        print 'Error: invalid data type for selected column'
+        n = updateFIDs(db, [row], where)
+    except (ValueError, sqlite3.Error) as err:
+        print 'Error: could not update database'
         print(err)
-        conn.rollback()
-    # Commit
-    db.commit()
+        return
+    print 'Updated %i rows' % n
+
+###
+# Functions for bulk, non-interactive queries and updates. Each runs one
+# prepared statement for all FIDs or rows.
+###
+# Function to query DB for many FIDs
+# Returns column names and list of rows
+def queryFIDs(db, fids, columns=None, table='site'):
+    # Check columns before putting them into the query
+    if columns is None:
+        columns = getColumnNames(db, table)
+    else:
+        checkColumns(db, columns, table)
+
+    fids = list(fids)
+    cursor = db.cursor()
+    rows = []
+    for i in range(0, len(fids), QUERY_CHUNK):
+        chunk = fids[i:i + QUERY_CHUNK]
+        command = 'SELECT %s FROM %s WHERE fid IN (%s);' % (
+            ', '.join(columns), table, ', '.join('?' * len(chunk)))
+        cursor.execute(command, chunk)
+        rows.extend(cursor.fetchall())
+
+    return list(columns), rows
+
+# Raises ValueError if any column is not in table
+def checkColumns(db, columns, table='site'):
+    names = getColumnNames(db, table)
+    unknown = [c for c in columns if c not in names]
+    if unknown:
+        raise ValueError('no such columns in %s: %s' %
+                         (table, ', '.join(unknown)))
+
+# Check and normalize values of updates to many rows
+# Returns columns to set and list of parameters for each row, or raises
+# ValueError describing every invalid row
+def prepareUpdates(db, rows, where=('fid', ), table='site'):
+    rows = list(rows)
+    if not rows:
+        return [], []
+    where = list(where)
+    columns = [c for c in sorted(rows[0].keys()) if c not in where]
+    if not columns:
+        raise ValueError('updates must set a column besides %s' %
+                         ', '.join(where))
+    checkColumns(db, columns + where, table)
+
+    params = []
+    errors = []
+    for i, row in enumerate(rows):
+        missing = [c for c in columns + where if row.get(c) in (None, '')]
+        if missing:
+            errors.append('row %i: no value for %s' %
+                          (i + 1, ', '.join(missing)))
+            continue
+        if 'fid' in where and not checkInt(row['fid']):
+            errors.append('row %i: FID must be an integer' % (i + 1))
+            continue
+        try:
+            params.append([normalizeValue(c, row[c]) for c in columns] +
+                          [row[w] for w in where])
+        except ValueError as err:
+            errors.append('row %i: %s' % (i + 1, err))
+
+    if errors:
+        raise ValueError('%i invalid rows\n' % len(errors) +
+                         '\n'.join(errors))
+
+    return columns, params
+
+# Function to update many rows of DB in one transaction
+# Each row is a dict of values to set and of where columns selecting rows
+# Returns number of rows changed
+def updateFIDs(db, rows, where=('fid', ), table='site'):
+    columns, params = prepareUpdates(db, rows, where, table)
+    if not params:
+        return 0
+
+    command = 'UPDATE %s SET %s WHERE %s;' % (
+        table,
+        ', '.join('%s=?' % c for c in columns),
+        ' AND '.join('%s=?' % w for w in where))
+
+    # Commits once, or rolls back every update on error
+    with db:
+        cursor = db.executemany(command, params)
+
+    return cursor.rowcount
 
 def outputTable(db):
     print 'Output valid SQL query to CSV'
@@ -543,7 +714,7 @@ def main():
     parser = argparse.ArgumentParser(prog="refimgdb.py", description=desc)
 
     parser.add_argument('-action', action='store', dest='action', type=str,
-                        help='Action to perform (get, update)')
+                        help='Action to perform (get, update, index)')
     parser.add_argument('-fid', action='store', dest='fid', type=int,
                         help='FID of image')
     parser.add_argument('-date', action='store', dest='date', type=str,
@@ -552,10 +723,12 @@ def main():
                         help='Database column')
     parser.add_argument('-value', action='store', dest='value', type=str,
                         help='Update column with value')
+    parser.add_argument('-db', action='store', dest='db', type=str,
+                        default=DB_PATH, help='Database file')
 
     args = parser.parse_args()
 
-    db = openDB()
+    db = openDB(args.db)
     
     # Check if command lines arguements used
     if (args.action is None and args.fid is None and args.date is None 
@@ -568,7 +741,7 @@ def main():
     # If command line argument, perform actions accordingly
     else:
         # Check if user specified a usable action
-        possible_action = ['get', 'update']
+        possible_action = ['get', 'update', 'index']
         if (args.action in possible_action) is False:
             print 'Error: action not possible'
             print parser.print_help()
@@ -579,6 +752,9 @@ def main():
                 print_query(cursor)
             elif args.action == 'update':
                 updateFID(db, args.fid, args.date, args.column, args.value)
+            elif args.action == 'index':
+                created = createIndexes(db)
+                print 'Created indexes: %s' % (', '.join(created) or 'none')
 
     db.close()
     sys.exit(0)
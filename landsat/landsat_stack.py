@@ -23,6 +23,7 @@ Options:
     -e --exit-on-warn           Exit on warning messages
     --format=<format>           GDAL format [default: ENVI]
     --co=<creation options>     GDAL creation options
+    --catalog=<file>            Catalog Fmask counts of last band of stacks
     -v --verbose                Show verbose debugging messages
     -q --quiet                  Be quiet by not showing warnings
     --dry-run                   Dry run - don't actually stack
@@ -73,12 +74,16 @@ import numpy as np
 
 try:
     from osgeo import gdal
+    from osgeo import gdal_array
     from osgeo import osr
     from osgeo.gdalconst import GA_ReadOnly
 except ImportError:
     import gdal
+    import gdal_array
     from gdalconst import GA_ReadOnly
 
+from mask_catalog import MaskCatalog, value_counts
+
 
 QUIET = False
 VERBOSE = False
@@ -381,11 +386,14 @@ class LandsatImage():
             print('Error: could not find or assume a geotransform or extent' \
                 'for all images for {id}'.format(id=self.id))
 
-    def stack_image(self, t_extent, utm=None):
+    def stack_image(self, t_extent, utm=None, catalog=None):
         """
         Take self and output a 'stacked' image defined by the target extent
         (t_extent), named according to output_pattern.
 
+        If a MaskCatalog is given, the counts of values in the last band of
+        the stack (e.g., Fmask) are cataloged from the data as it is stacked.
+
         Notice: much of this code is graciously taken from gdal_merge.py
         """
         if VERBOSE:
@@ -521,9 +529,22 @@ class LandsatImage():
 
         print()
 
+        # Count last band, including NoData filled outside of the source
+        if catalog is not None:
+            counts = value_counts(np.frombuffer(
+                data, dtype=gdal_array.GDALTypeCodeToNumericTypeCode(
+                    self.dtype)))
+            fill = self.no_data[-1][-1]
+            counts[fill] = (counts.get(fill, 0) +
+                            x_size * y_size - tw_xsize * tw_ysize)
+
         # Close input and output datasets
         ds = None
         out_ds = None
+
+        if catalog is not None:
+            catalog.add(self.output_name, out_band - 1, counts,
+                        (y_size, x_size))
         # Return successful
         return True
 
@@ -681,7 +702,7 @@ def landsat_stack(location, dir_pattern, image_pattern, out_pattern,
                   extent=None, max_extent=None, min_extent=None,
                   percentile=None, extent_image=None,
                   utm=None, resume=False,
-                  fformat='ENVI', co='INTERLEAVE=BIP'):
+                  fformat='ENVI', co='INTERLEAVE=BIP', catalog=None):
     """ Performs stacking of Landsat data
 
     Arguments:
@@ -702,6 +723,8 @@ def landsat_stack(location, dir_pattern, image_pattern, out_pattern,
         resume              Option to resume by skipping already stacked images
         fformat             GDAL file format
         co                  GDAL format creation options
+        catalog             MaskCatalog to store counts of the last band
+                                (e.g., Fmask) of each stack
 
     Example:
         landsat_stack('./', 'L*', 'lndsr*hdf; L*Fmask', '*_stack',
@@ -768,9 +791,12 @@ def landsat_stack(location, dir_pattern, image_pattern, out_pattern,
         if resume and image.check_completed(extent):
             if VERBOSE and not QUIET:
                 print('Already stacked...')
+            if catalog is not None and not DRY_RUN:
+                catalog.counts(image.output_name,
+                               sum([len(_bands) for _bands in image.bands]))
         else:
             if not DRY_RUN:
-                stack_status.append(image.stack_image(extent, utm))
+                stack_status.append(image.stack_image(extent, utm, catalog))
             else:
                 stack_status.append(True)
         sys.stdout.flush()
@@ -912,12 +938,22 @@ def main():
     if creation_opts:
         creation_opts = [co for co in creation_opts.split(';')]
 
+    # Catalog of Fmask counts
+    catalog = None
+    if arguments['--catalog']:
+        try:
+            catalog = MaskCatalog(arguments['--catalog'])
+        except:
+            print('Error: cannot open catalog {f}'.format(
+                f=arguments['--catalog']))
+            return 1
+
     # Now that we've parsed input, perform stacking
     return(landsat_stack(location, dir_pattern, image_pattern, out_pattern,
                          bands, ndv,
                          extent, max_extent, min_extent, percentile,
                          extent_image,
-                         utm, resume, fformat, creation_opts))
+                         utm, resume, fformat, creation_opts, catalog))
 
 if __name__ == '__main__':
     arguments = docopt(__doc__)
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+""" Catalog of Fmask value counts for each scene
+
+Stores the count of pixels of each Fmask value (land, water, shadow, snow,
+cloud and NoData) for each scene, and optionally for each block of a scene,
+in a SQLite database so the clear percentage of a scene is only ever read
+from its mask once. Entries are keyed by file identity -- the real path and
+band of the mask, checked against the size and modification time of the
+file -- so a re-processed scene is counted again.
+
+Shared by ``landsat/remove_cloudy.py``, ``landsat/landsat_stack.py`` and
+``timeseries/stacks/plot_stack_nobs.py``.
+
+Usage:
+    mask_catalog.py add [options] <catalog> <image>...
+    mask_catalog.py query [options] <catalog>
+
+Options:
+    --band=<band>           Fmask band in image [default: 1]
+    --blocksize=<size>      Also count each block of this many pixels
+    --clear=<clear values>  Acceptable Fmask values [default: 0, 1]
+    --min=<pct>             Minimum clear percent [default: 0]
+    --max=<pct>             Maximum clear percent [default: 100]
+    --root=<directory>      Only query images within directory
+    -h --help               Show help
+
+Examples:
+
+    Catalog the Fmask of every image within "images/" and then list the
+    images at least 30% clear (land or water):
+
+    > mask_catalog.py add fmask.db images/*/*Fmask
+    > mask_catalog.py query --min 30 fmask.db
+
+"""
+from __future__ import division, print_function
+import json
+import logging
+import os
+import sqlite3
+import sys
+
+from docopt import docopt
+import numpy as np
+try:
+    from osgeo import gdal
+except ImportError:
+    import gdal
+
+logger = logging.getLogger(__name__)
+
+# Fmask values counted in their own column, in addition to the histogram
+FMASK_VALUES = [('land', 0), ('water', 1), ('shadow', 2), ('snow', 3),
+                ('cloud', 4), ('nodata', 255)]
+FMASK_CLEAR = [0, 1]
+FMASK_NDV = 255
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scenes (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    band INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    nrow INTEGER NOT NULL,
+    ncol INTEGER NOT NULL,
+    {columns},
+    histogram TEXT NOT NULL,
+    UNIQUE (path, band)
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    scene INTEGER NOT NULL REFERENCES scenes (id) ON DELETE CASCADE,
+    yoff INTEGER NOT NULL,
+    xoff INTEGER NOT NULL,
+    nrow INTEGER NOT NULL,
+    ncol INTEGER NOT NULL,
+    {columns},
+    histogram TEXT NOT NULL,
+    PRIMARY KEY (scene, yoff, xoff)
+);
+""".format(columns=',\n    '.join('{n} INTEGER NOT NULL'.format(n=n)
+                                   for n, _ in FMASK_VALUES))
+
+
+def file_identity(path):
+    """ Return real path, size and modification time of a file """
+    st = os.stat(path)
+    return os.path.realpath(path), st.st_size, st.st_mtime
+
+
+def value_counts(arr):
+    """ Return dict of count of each value in an array """
+    arr = np.asarray(arr).ravel()
+    if arr.dtype.kind in 'bu' and arr.dtype.itemsize <= 2:
+        counts = np.bincount(arr)
+        values = np.flatnonzero(counts)
+        counts = counts[values]
+    else:
+        values, counts = np.unique(arr, return_counts=True)
+    return dict(zip(values.tolist(), counts.tolist()))
+
+
+def add_counts(a, b):
+    """ Return sum of two dicts of value counts """
+    total = dict(a)
+    for value, count in b.items():
+        total[value] = total.get(value, 0) + count
+    return total
+
+
+def reduce_counts(counts):
+    """ Return sum of a sequence of dicts of value counts """
+    total = {}
+    for c in counts:
+        total = add_counts(total, c)
+    return total
+
+
+def clear_percent(counts, clear=FMASK_CLEAR, ndv=FMASK_NDV):
+    """ Return percent of non-NoData pixels that are clear
+
+    Args:
+        counts (dict): Count of each mask value
+        clear (list): Mask values considered clear
+        ndv (int): Mask NoData value
+
+    Returns:
+        float: Clear percent, or NaN if the mask is entirely NoData
+    """
+    nclear = sum(counts.get(c, 0) for c in clear)
+    nobs = sum(counts.values()) - counts.get(ndv, 0)
+    if nobs == 0:
+        return float('nan')
+    return nclear / nobs * 100.0
+
+
+def count_mask(path, band=1, block_size=None):
+    """ Count pixels of each value in a mask image, reading by strip of rows
+
+    Args:
+        path (str): Mask image filename
+        band (int): Band of mask image
+        block_size (int): If given, also count each block of this many
+            pixels on a side
+
+    Returns:
+        tuple: dict of the count of each value, (nrow, ncol), and a list of
+            ``(yoff, xoff, nrow, ncol, counts)`` for each block (empty
+            unless ``block_size`` is given)
+    """
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    b = ds.GetRasterBand(band)
+    nrow, ncol = ds.RasterYSize, ds.RasterXSize
+    nstrip = block_size or max(1, b.GetBlockSize()[1])
+
+    counts, blocks = {}, []
+    for yoff in range(0, nrow, nstrip):
+        ny = min(nstrip, nrow - yoff)
+        strip = b.ReadAsArray(0, yoff, ncol, ny)
+        if block_size:
+            strip_blocks = [
+                (yoff, xoff, ny, min(block_size, ncol - xoff),
+                 value_counts(strip[:, xoff:xoff + block_size]))
+                for xoff in range(0, ncol, block_size)]
+            blocks.extend(strip_blocks)
+            counts = add_counts(counts,
+                                reduce_counts(blk[-1] for blk in strip_blocks))
+        else:
+            counts = add_counts(counts, value_counts(strip))
+    ds = None
+
+    return counts, (nrow, ncol), blocks
+
+
+def sample_mask(path, band=1, stride=10):
+    """ Count values of every ``stride`` pixel in each direction of a mask
+
+    Reads the mask decimated by nearest neighbor, so GDAL reads from
+    overviews when available instead of the full resolution band.
+
+    Args:
+        path (str): Mask image filename
+        band (int): Band of mask image
+        stride (int): Sampling interval in rows and columns
+
+    Returns:
+        dict: Count of each value among sampled pixels
+    """
+    ds = gdal.Open(path, gdal.GA_ReadOnly)
+    nrow, ncol = ds.RasterYSize, ds.RasterXSize
+    mask = ds.GetRasterBand(band).ReadAsArray(
+        0, 0, ncol, nrow,
+        buf_xsize=max(1, ncol // stride), buf_ysize=max(1, nrow // stride))
+    ds = None
+    return value_counts(mask)
+
+
+def clear_percent_error(counts, clear=FMASK_CLEAR, ndv=FMASK_NDV, z=3.0):
+    """ Return bound of error of clear percent estimated from sampled pixels
+
+    The bound is ``z`` standard errors of a proportion from a simple random
+    sample, which is conservative for the systematic sample of
+    ``sample_mask`` since clouds are spatially autocorrelated.
+
+    Args:
+        counts (dict): Count of each value among sampled pixels
+        clear (list): Mask values considered clear
+        ndv (int): Mask NoData value
+        z (float): Number of standard errors
+
+    Returns:
+        float: Error bound of clear percent, or NaN if no pixels observed
+    """
+    nobs = sum(counts.values()) - counts.get(ndv, 0)
+    if nobs == 0:
+        return float('nan')
+    # Shrink toward 50% by half a pixel so bound is not 0 at 0% or 100%
+    p = (sum(counts.get(c, 0) for c in clear) + 0.5) / (nobs + 1.0)
+    return z * np.sqrt(p * (1 - p) / nobs) * 100.0
+
+
+def _row(counts):
+    """ Return named Fmask value counts and JSON histogram of counts """
+    return ([counts.get(v, 0) for _, v in FMASK_VALUES] +
+            [json.dumps(sorted(counts.items()))])
+
+
+def _counts(histogram):
+    return dict((int(v), int(c)) for v, c in json.loads(histogram))
+
+
+class MaskCatalog(object):
+    """ SQLite catalog of Fmask value counts keyed by file identity
+
+    Args:
+        filename (str): SQLite database filename, created if necessary
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename)
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        self.conn.executescript(_SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def _scene(self, path, band):
+        """ Return ID and shape of a current entry, or None if missing or
+        stale
+        """
+        try:
+            realpath, size, mtime = file_identity(path)
+        except OSError:
+            return None
+        row = self.conn.execute(
+            'SELECT id, size, mtime, nrow, ncol FROM scenes '
+            'WHERE path = ? AND band = ?', (realpath, band)).fetchone()
+        if row is None or row[1] != size or row[2] != mtime:
+            return None
+        return row[0], (row[3], row[4])
+
+    def lookup(self, path, band=1):
+        """ Return cataloged counts of each value of a mask, or None if the
+        mask is not cataloged or has changed since
+        """
+        scene = self._scene(path, band)
+        if scene is None:
+            return None
+        histogram, = self.conn.execute(
+            'SELECT histogram FROM scenes WHERE id = ?',
+            (scene[0], )).fetchone()
+        return _counts(histogram)
+
+    def blocks(self, path, band=1):
+        """ Return list of ``(yoff, xoff, nrow, ncol, counts)`` of each
+        cataloged block of a mask (empty if not counted by block)
+        """
+        scene = self._scene(path, band)
+        if scene is None:
+            return []
+        cursor = self.conn.execute(
+            'SELECT yoff, xoff, nrow, ncol, histogram FROM blocks '
+            'WHERE scene = ? ORDER BY yoff, xoff', (scene[0], ))
+        return [row[:4] + (_counts(row[4]), ) for row in cursor]
+
+    def add(self, path, band, counts, shape, blocks=None):
+        """ Catalog counts of each value of a mask, replacing any entry
+
+        Args:
+            path (str): Mask image filename
+            band (int): Band of mask image
+            counts (dict): Count of each mask value
+            shape (tuple): Number of rows and columns in mask
+            blocks (list): ``(yoff, xoff, nrow, ncol, counts)`` of blocks
+        """
+        realpath, size, mtime = file_identity(path)
+        names = [n for n, _ in FMASK_VALUES]
+        with self.conn:
+            self.conn.execute(
+                'DELETE FROM scenes WHERE path = ? AND band = ?',
+                (realpath, band))
+            cursor = self.conn.execute(
+                'INSERT INTO scenes (path, band, size, mtime, nrow, ncol, '
+                '{n}, histogram) VALUES ({q})'.format(
+                    n=', '.join(names), q=', '.join('?' * (len(names) + 7))),
+                [realpath, band, size, mtime, shape[0], shape[1]] +
+                _row(counts))
+            scene = cursor.lastrowid
+            if blocks:
+                self.conn.executemany(
+                    'INSERT INTO blocks (scene, yoff, xoff, nrow, ncol, '
+                    '{n}, histogram) VALUES ({q})'.format(
+                        n=', '.join(names),
+                        q=', '.join('?' * (len(names) + 6))),
+                    ([scene] + list(blk[:4]) + _row(blk[4])
+                     for blk in blocks))
+
+    def counts(self, path, band=1, block_size=None):
+        """ Return counts of each value of a mask, counting and cataloging
+        the mask if not already cataloged
+        """
+        counts = self.lookup(path, band)
+        if counts is not None and (not block_size or
+                                   self.blocks(path, band)):
+            return counts
+        logger.debug('Counting mask values in {f}'.format(f=path))
+        counts, shape, blocks = count_mask(path, band, block_size)
+        self.add(path, band, counts, shape, blocks)
+        return counts
+
+    def clear_percent(self, path, band=1, clear=FMASK_CLEAR, ndv=FMASK_NDV):
+        """ Return clear percent of a mask, cataloging it if necessary """
+        return clear_percent(self.counts(path, band), clear, ndv)
+
+    def query(self, min_clear=0, max_clear=100, clear=FMASK_CLEAR,
+              root=None, band=None):
+        """ Return cataloged masks within a range of clear percent
+
+        Clear and NoData values must be among the Fmask values with their own
+        column (``FMASK_VALUES``). Entries are not checked against their file
+        identity. Masks without any valid (non-NoData) pixels, whose clear
+        percent is NaN in ``clear_percent``, are never returned, whatever the
+        range.
+
+        Args:
+            min_clear (float): Minimum clear percent
+            max_clear (float): Maximum clear percent
+            clear (list): Mask values considered clear
+            root (str): Only return masks within this directory
+            band (int): Only return masks of this band
+
+        Returns:
+            list: ``(path, band, clear percent)`` of each mask, by path
+        """
+        names = dict((v, n) for n, v in FMASK_VALUES)
+        try:
+            nclear = ' + '.join(names[c] for c in clear) or '0'
+        except KeyError as e:
+            raise ValueError('Cannot query by unknown Fmask value {v}'
+                             .format(v=e.args[0]))
+        pct = ('100.0 * ({c}) / (nrow * ncol - nodata)'.format(c=nclear))
+
+        where, params = ['nrow * ncol > nodata', pct + ' BETWEEN ? AND ?'], \
+            [min_clear, max_clear]
+        if root is not None:
+            where.append('substr(path, 1, ?) = ?')
+            root = os.path.join(os.path.realpath(root), '')
+            params.extend([len(root), root])
+        if band is not None:
+            where.append('band = ?')
+            params.append(band)
+
+        return self.conn.execute(
+            'SELECT path, band, {p} FROM scenes WHERE {w} ORDER BY path'
+            .format(p=pct, w=' AND '.join(where)), params).fetchall()
+
+
+def main():
+    args = docopt(__doc__)
+
+    try:
+        band = int(args['--band'])
+        block_size = args['--blocksize'] and int(args['--blocksize'])
+        clear = [int(c) for c in
+                 args['--clear'].replace(' ', ',').split(',') if c != '']
+        min_clear, max_clear = float(args['--min']), float(args['--max'])
+    except ValueError:
+        print('Error: band, block size, clear values, and clear percent '
+              'range must be numbers')
+        sys.exit(1)
+
+    catalog = MaskCatalog(args['<catalog>'])
+    if args['add']:
+        for i, image in enumerate(args['<image>']):
+            pct = clear_percent(catalog.counts(image, band, block_size),
+                                clear)
+            print('{i}/{n} {f}: {p:0.1f}% clear'.format(
+                i=i + 1, n=len(args['<image>']), f=image, p=pct))
+    else:
+        try:
+            found = catalog.query(min_clear, max_clear, clear,
+                                  root=args['--root'], band=band)
+        except ValueError as e:
+            print('Error: {e}'.format(e=e))
+            sys.exit(1)
+        for path, _band, pct in found:
+            print('{f},{b},{p:0.3f}'.format(f=path, b=_band, p=pct))
+    catalog.close()
+
+
+if __name__ == '__main__':
+    main()
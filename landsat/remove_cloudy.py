@@ -9,10 +9,18 @@ Options:
     --band=<band>           Fmask band in image [default: 1]
     --clear=<clear values>  Acceptable Fmask values [default: 0, 1]
     --store=<directory>     Directory to store cloudy images [default: cloudy]
+    --catalog=<file>        Read and store Fmask counts in SQLite catalog
+    --estimate              Estimate clear percent from decimated reads
+    --stride=<n>            Estimate sampling interval in pixels [default: 10]
+    --z=<z>                 Estimate error bound in std. errors [default: 3]
     --dry-run               Dry-run (do not move files)
     -v --verbose            Show verbose messages
     --help                  Show help
 
+Estimate mode reads every Nth row and column of the Fmask band (or an
+overview, if available) and only counts all pixels for images whose clear
+percent is within the error bound of the minimum.
+
 """
 from docopt import docopt
 
@@ -24,14 +32,31 @@ import sys
 from osgeo import gdal
 import numpy as np
 
+from mask_catalog import (MaskCatalog, clear_percent, clear_percent_error,
+                          count_mask, sample_mask)
+
 DEBUG = False
 DRY = False
 
 ndv = 255
 
-def remove_cloudy(min_clear, directory, fmask, band, clear, storage):
+def count_exact(img, band, catalog=None):
+    """ Return counts of all Fmask values, from catalog if given """
+    if catalog is not None:
+        return catalog.counts(img, band)
+    return count_mask(img, band)[0]
+
+def remove_cloudy(min_clear, directory, fmask, band, clear, storage,
+                  catalog=None, stride=None, z=3.0):
     """ Find all mask images, check the clear percent of pixels in each, and 
     move or retain accordingly
+
+    If a MaskCatalog is given, the counts of Fmask values are read from it, or
+    counted and stored in it for images not yet cataloged.
+
+    If a sampling stride is given, the clear percent of images not cataloged
+    is estimated from every `stride` pixel, and all pixels are counted only
+    when the minimum is within `z` standard errors of the estimate.
     """
     images = []
     # Search folder for Fmask images
@@ -51,38 +76,54 @@ def remove_cloudy(min_clear, directory, fmask, band, clear, storage):
 
     # Loop through images, checking
     count = len(images)
+    nestimate, nexact = 0, 0
     for _i, img in enumerate(images):
         dir = os.path.dirname(img)
 
         if DEBUG is True:
             print 'Working on: ' + dir + ' ({i}/{t})'.format(i=_i, t=count)
 
-        # Open dataset
+        # Count pixels of each mask value
         try:
-            ds = gdal.Open(img, gdal.GA_ReadOnly)
+            counts = None
+            if catalog is not None:
+                counts = catalog.lookup(img, band)
+            if counts is None and stride:
+                # Estimate, counting exactly only if near minimum
+                sample = sample_mask(img, band, stride)
+                pct_clear = clear_percent(sample, clear, ndv)
+                error = clear_percent_error(sample, clear, ndv, z)
+                if DEBUG is True:
+                    print '    estimated {f:0.1f}% +/- {e:0.1f}%'.format(
+                        f=pct_clear, e=error)
+                if not abs(pct_clear - min_clear) > error:
+                    counts = count_exact(img, band, catalog)
+                    nexact += 1
+                else:
+                    nestimate += 1
+            elif counts is None:
+                counts = count_exact(img, band, catalog)
         except:
-            print 'Error: could not open {f}'.format(f=img)
+            print 'Error: could not read Fmask band of {f}'.format(f=img)
             sys.exit(1)
 
-        # Read in mask image
-        mask = ds.GetRasterBand(band).ReadAsArray()
+        # Determine percent clear of observed pixels
+        if counts is not None:
+            pct_clear = clear_percent(counts, clear, ndv)
+            error = 0
 
-        if mask is None:
-            print 'Error: cannot read in Fmask band'
-        
-        # Determine number of observed pixels
-        nobs = (mask != ndv).sum()
-        # Determine number of good pixels
-        nclear = reduce(np.logical_or, [mask == c for c in clear]).sum()
-        # Determine percent clear
-        pct_clear = float(nclear) / float(nobs) * 100
-
-        if pct_clear < min_clear:
+        # Images without valid pixels (NaN clear percent) fail the minimum
+        if not pct_clear >= min_clear:
             # Warn
-            print 'Image {i} does not meet minimum ({f:0.1f}%)'.format(
-                i=img, f=pct_clear)
-            # Destroy dataset
-            ds = None
+            if np.isnan(pct_clear):
+                print 'Image {i} does not meet minimum (no valid ' \
+                    'pixels)'.format(i=img)
+            elif error:
+                print 'Image {i} does not meet minimum ({f:0.1f}% +/- ' \
+                    '{e:0.1f}%)'.format(i=img, f=pct_clear, e=error)
+            else:
+                print 'Image {i} does not meet minimum ({f:0.1f}%)'.format(
+                    i=img, f=pct_clear)
             # Move folder
             if DRY is False:
                 try:
@@ -91,9 +132,10 @@ def remove_cloudy(min_clear, directory, fmask, band, clear, storage):
                 except:
                     print 'Error: could not move folder into storage'
                     sys.exit(1)
-
-        ds = None
     
+    if stride:
+        print 'Estimated {n} images, counted {e} near minimum exactly'.format(
+            n=nestimate, e=nexact)
     print 'Filtered all cloudy images'
 
 def main():
@@ -135,6 +177,21 @@ def main():
         print 'Error: Fmask clear values must be integers'
         sys.exit(1)
 
+    # Estimate sampling interval and error bound
+    stride = None
+    if args['--estimate']:
+        try:
+            stride = int(args['--stride'])
+            z = float(args['--z'])
+        except:
+            print 'Error: stride must be an integer and z a real number'
+            sys.exit(1)
+        if stride < 1:
+            print 'Error: stride must be at least 1'
+            sys.exit(1)
+    else:
+        z = 3.0
+
     # Make storage directory for cloudy images
     storage = args['--store'] 
     if not os.path.exists(storage):
@@ -144,7 +201,20 @@ def main():
             print 'Error: cannot make storage directory {d}'.format(d=storage)
             sys.exit(1)
 
-    remove_cloudy(min_clear, directory, fmask, band, clear, storage)
+    # Catalog of Fmask counts
+    catalog = None
+    if args['--catalog']:
+        try:
+            catalog = MaskCatalog(args['--catalog'])
+        except:
+            print 'Error: cannot open catalog {f}'.format(f=args['--catalog'])
+            sys.exit(1)
+
+    remove_cloudy(min_clear, directory, fmask, band, clear, storage,
+                  catalog=catalog, stride=stride, z=z)
+
+    if catalog is not None:
+        catalog.close()
 
 
 if __name__ == '__main__':
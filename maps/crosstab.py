@@ -7,6 +7,9 @@ Usage:
 Options:
     -l --layer=<layer>          Layer in shapefile (index or name) [default: 0]
     -a --attribute=<attribute>  Attribute to compare with map [default: truth]
+    --area                      Tabulate pixel area instead of pixel count
+    --accuracy=<csv>            Write accuracy measures to CSV file
+    --blocksize=<rows>          Rows of map processed at once [default: 1024]
     -v --verbose                Show verbose debugging messages
     -h --help                   Show help
 
@@ -24,6 +27,15 @@ Example:
         Ref-Class_3,1,3,1,5
         Ref-Class_255,4,9,3,0
 
+Notes:
+
+    Accuracy measures include overall accuracy and user's and producer's
+    accuracy of each class. They are area-adjusted using the total count (or
+    area) of each class within the entire map, with standard errors, following
+    Olofsson et al. (2014) "Good practices for estimating area and assessing
+    accuracy of land change". Area of pixels in geographic coordinate systems
+    is calculated on a sphere in square meters.
+
 """
 
 from __future__ import print_function
@@ -37,14 +49,19 @@ import numpy as np
 try:
     from osgeo import gdal
     from osgeo import ogr
+    from osgeo import osr
 except:
     import gdal
     import ogr
+    import osr
 
 __version__ = '0.1.0'
 
 VERBOSE = False
 
+# Authalic radius of Earth (meters)
+EARTH_RADIUS = 6371007.2
+
 gdal.UseExceptions()
 gdal.AllRegister()
 
@@ -57,16 +74,15 @@ logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
 logger = logging.getLogger(__name__)
 
 
-def rasterize_map(raster_file, vector_file, attribute, layer=1):
-    """ Rasterizes vector file to extent/size of raster """
+def open_reference(raster_file, vector_file, attribute, layer=1):
+    """ Open raster map and reference vector layer, checking attribute """
     # Open raster file
     try:
         raster_ds = gdal.Open(raster_file, gdal.GA_ReadOnly)
     except:
         logger.error('Cannot open input raster')
         sys.exit(1)
-    raster = raster_ds.GetRasterBand(1).ReadAsArray()
-    logger.debug('Read in raster file')
+    logger.debug('Opened raster file')
 
     # Get raster NoDataValue
     ndv = raster_ds.GetRasterBand(1).GetNoDataValue()
@@ -124,22 +140,62 @@ def rasterize_map(raster_file, vector_file, attribute, layer=1):
         sys.exit(1)
     logger.debug('Found attribute {a} in vector file'.format(a=attribute))
 
-    # If we've passed checks so far, setup memory raster
-    logger.debug('Setting up memory raster for rasterization')
-    mem_driver = gdal.GetDriverByName('MEM')
-
-    mem_ds = mem_driver.Create('',
-                               raster_ds.RasterXSize,
-                               raster_ds.RasterYSize,
-                               1,
-                               raster_ds.GetRasterBand(1).DataType)
+    # Keep vector dataset referenced while layer is in use
+    return raster_ds, vector, layer, ndv
+
+
+def layer_transform(raster_ds, layer):
+    """ Return transformation from raster to layer coordinate system, or
+    None if they are the same
+    """
+    raster_srs = osr.SpatialReference()
+    raster_srs.ImportFromWkt(raster_ds.GetProjectionRef())
+    layer_srs = layer.GetSpatialRef()
+    if layer_srs is not None and raster_srs.ExportToWkt() and \
+            not raster_srs.IsSame(layer_srs):
+        return osr.CoordinateTransformation(raster_srs, layer_srs)
+    return None
+
+
+def rasterize_block(raster_ds, layer, attribute, ndv, row, nrow,
+                    transform=None):
+    """ Rasterizes vector layer to a block of rows of raster
+
+    Args:
+        raster_ds (gdal.Dataset): raster map
+        layer (ogr.Layer): reference layer
+        attribute (str): attribute of layer to rasterize
+        ndv (int or float): NoDataValue of raster
+        row (int): first row of block
+        nrow (int): number of rows in block
+        transform (osr.CoordinateTransformation): transformation from raster
+            to layer coordinate system, if they differ
+    """
+    cols = raster_ds.RasterXSize
+    gt = list(raster_ds.GetGeoTransform())
+    gt[0] += row * gt[2]
+    gt[3] += row * gt[5]
+
+    mem_ds = gdal.GetDriverByName('MEM').Create(
+        '', cols, nrow, 1, raster_ds.GetRasterBand(1).DataType)
     mem_ds.SetProjection(raster_ds.GetProjection())
-    mem_ds.SetGeoTransform(raster_ds.GetGeoTransform())
-    logger.debug('Set up memory dataset for rasterization')
+    mem_ds.SetGeoTransform(gt)
 
     # Fill with NDV
     mem_ds.GetRasterBand(1).Fill(ndv)
 
+    # Only rasterize features within block footprint, in layer coordinates
+    corners = [(gt[0] + c * gt[1] + r * gt[2], gt[3] + c * gt[4] + r * gt[5])
+               for c, r in ((0, 0), (cols, 0), (cols, nrow), (0, nrow))]
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x, y in corners + corners[:1]:
+        ring.AddPoint(x, y)
+    footprint = ogr.Geometry(ogr.wkbPolygon)
+    footprint.AddGeometry(ring)
+    if transform is not None:
+        footprint.Transform(transform)
+    layer.SetSpatialFilter(footprint)
+
     # Rasterize
     status = gdal.RasterizeLayer(mem_ds,
                                  [1],
@@ -149,46 +205,244 @@ def rasterize_map(raster_file, vector_file, attribute, layer=1):
                                  options=['ALL_TOUCHED=FALSE',
                                           'ATTRIBUTE={a}'.format(a=attribute)]
                                  )
+    layer.SetSpatialFilter(None)
 
     if status != 0:
         logger.error('Could not rasterize vector')
         sys.exit(1)
-    else:
-        logger.debug('Rasterized vector file')
 
-    # Get raster from dataset and return
-    print(np.unique(mem_ds.GetRasterBand(1).ReadAsArray()))
-    return (mem_ds.GetRasterBand(1).ReadAsArray(), raster, ndv)
+    return mem_ds.GetRasterBand(1).ReadAsArray()
+
+
+def pixel_area(raster_ds, row, nrow):
+    """ Return area of pixels in each row of a block as a column vector
+
+    Area is in squared units of projected coordinate systems, or in squared
+    meters on a sphere for geographic coordinate systems.
+    """
+    gt = raster_ds.GetGeoTransform()
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(raster_ds.GetProjectionRef())
+    if not srs.IsGeographic():
+        return np.full((nrow, 1), abs(gt[1] * gt[5] - gt[2] * gt[4]))
+
+    # Spherical area between edges of each row of pixels
+    lat = np.radians(gt[3] + gt[5] * np.arange(row, row + nrow + 1))
+    area = (EARTH_RADIUS ** 2 * np.radians(abs(gt[1])) *
+            np.abs(np.diff(np.sin(lat))))
+    return area[:, np.newaxis]
+
+
+def _codes(values, max_bins):
+    """ Return integer codes, number of codes, and code-to-value mapping
+
+    Integer values within a small range are offset by their minimum so codes
+    come without sorting. Other values are coded by ``np.unique``.
+    """
+    if values.dtype.kind in 'biu' and values.size:
+        lo, hi = int(values.min()), int(values.max())
+        if hi - lo < max_bins:
+            return (values.astype(np.int64) - lo, hi - lo + 1,
+                    lambda code: code + lo)
+    uniq, inverse = np.unique(values, return_inverse=True)
+    return inverse.astype(np.int64), uniq.size, lambda code: uniq[code]
+
+
+def value_counts(values, weights=None, max_bins=2 ** 24):
+    """ Count (or sum weights of) each unique value
+
+    Returns:
+        tuple: values and counts of each value
+    """
+    code, n, decode = _codes(values.ravel(), max_bins)
+    counts = np.bincount(code, weights=weights, minlength=n)
+    code = np.flatnonzero(counts)
+    return decode(code), counts[code]
+
+
+def pair_counts(ref, pred, weights=None, max_bins=2 ** 24):
+    """ Count (or sum weights of) each pair of reference and map values
+
+    Pairs are counted in one pass with ``np.bincount`` on a combined code of
+    both values when there are few enough possible pairs, or with
+    ``np.unique`` on the combined codes otherwise.
+
+    Returns:
+        tuple: reference values, map values, and counts of each pair
+    """
+    ref_code, n_ref, ref_decode = _codes(ref.ravel(), max_bins)
+    pred_code, n_pred, pred_decode = _codes(pred.ravel(), max_bins)
+    code = ref_code * n_pred + pred_code
+
+    if n_ref * n_pred <= max_bins:
+        counts = np.bincount(code, weights=weights, minlength=n_ref * n_pred)
+        code = np.flatnonzero(counts)
+        counts = counts[code]
+    else:
+        code, inverse = np.unique(code, return_inverse=True)
+        counts = np.bincount(inverse, weights=weights)
+
+    return ref_decode(code // n_pred), pred_decode(code % n_pred), counts
+
+
+class CrossTabulation(object):
+    """ Accumulate crosstabulation of reference and map classes by block
+
+    Also accumulates the total (count or area) of every map class over the
+    entire map for area-adjusted accuracy estimates. When pairs are weighted
+    by area, the unweighted count of each pair is kept too, since accuracy
+    estimates need sample counts.
+    """
+    def __init__(self, ndv=0):
+        self.ndv = ndv
+        self.pairs = {}
+        self.pair_counts = {}
+        self.map_totals = {}
+        self.ref_classes = set()
+
+    def update(self, rasterized, raster, weights=None):
+        """ Add a block of rasterized reference data and map """
+        if weights is not None:
+            weights = np.broadcast_to(weights, raster.shape)
+
+        # Map class totals, including pixels without reference data
+        valid = raster != self.ndv
+        classes, totals = value_counts(
+            raster[valid],
+            weights=None if weights is None else weights[valid])
+        for c, total in zip(classes.tolist(), totals.tolist()):
+            self.map_totals[c] = self.map_totals.get(c, 0) + total
+
+        # Reference and map pairs
+        ref_valid = rasterized != self.ndv
+        self.ref_classes.update(
+            value_counts(rasterized[ref_valid])[0].tolist())
+        valid &= ref_valid
+        refs, preds, counts = pair_counts(rasterized[valid], raster[valid])
+        for r, p, count in zip(refs.tolist(), preds.tolist(),
+                               counts.tolist()):
+            self.pair_counts[(r, p)] = self.pair_counts.get((r, p), 0) + count
+        if weights is not None:
+            refs, preds, counts = pair_counts(rasterized[valid],
+                                              raster[valid],
+                                              weights=weights[valid])
+        for r, p, count in zip(refs.tolist(), preds.tolist(),
+                               counts.tolist()):
+            self.pairs[(r, p)] = self.pairs.get((r, p), 0) + count
+
+    @property
+    def classes(self):
+        """ list: all values in either reference data or map """
+        return sorted(self.ref_classes | set(self.map_totals))
+
+    def table(self, counts=False):
+        """ Return crosstabulation with reference along rows and map along
+        columns, ordered by ``self.classes``
+
+        Args:
+            counts (bool): return unweighted pixel counts even if pairs were
+                weighted by area
+        """
+        classes = self.classes
+        index = dict((c, i) for i, c in enumerate(classes))
+        tab = np.zeros((len(classes), len(classes)))
+        pairs = self.pair_counts if counts else self.pairs
+        for (r, p), count in pairs.items():
+            tab[index[r], index[p]] = count
+        return tab
 
 
 def crosstabulate(rasterized, raster, ndv=0):
     """ Crosstabulate raster against rasterized vector file """
-    # Find all values in either dataset
-    uniqs = np.unique(np.concatenate([
-        np.unique(rasterized[rasterized != ndv]),
-        np.unique(raster[raster != ndv])]))
-
-    # Crosstabulate
-    tab = np.zeros((uniqs.size, uniqs.size))
-
-    for i, uv_row in enumerate(uniqs):
-        for j, uv_col in enumerate(uniqs):
-            tab[i, j] = (raster[rasterized == uv_row] == uv_col).sum()
+    xtab = CrossTabulation(ndv=ndv)
+    xtab.update(rasterized, raster)
     logger.debug('Crosstabulated map with reference data')
+    return format_crosstab(xtab.classes, xtab.table())
+
 
+def format_crosstab(uniqs, tab, fmt='%i'):
+    """ Format crosstabulation with headers for output """
     # Setup array headers
     rownames = np.array(['Ref-Class_' + str(u)
                         for u in uniqs])[:, np.newaxis]
     colnames = ['']
     colnames.extend(['Map-Class_' + str(u) for u in uniqs])
 
-    pretty_tab = np.hstack((rownames, np.char.mod('%i', tab)))
+    pretty_tab = np.hstack((rownames, np.char.mod(fmt, tab)))
     pretty_tab = np.vstack((colnames, pretty_tab))
 
     # Return with reference across & map labels going down
     return pretty_tab.T
 
 
+def accuracy(tab, map_totals=None):
+    """ Calculate accuracy measures from crosstabulation
+
+    If the total count or area of each map class is given, estimates are
+    area-adjusted following the stratified estimators of Olofsson et al.
+    (2014), treating map classes as strata.
+
+    Args:
+        tab (np.ndarray): crosstabulation of sample (pixel) counts with
+            reference along rows and map along columns
+        map_totals (np.ndarray): total count or area of each map class
+
+    Returns:
+        dict: overall accuracy ('overall'), and user's ('users') and
+            producer's ('producers') accuracy for each class. With
+            ``map_totals``, also includes the adjusted area ('area') of each
+            class and its standard error ('area_se'), and the standard error
+            of overall accuracy ('overall_se')
+    """
+    # Rows are map classes below
+    n = tab.T.astype(np.float64)
+    n_i = n.sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if map_totals is None:
+            p = n / n.sum()
+        else:
+            # Proportion of each cell in population
+            W = map_totals / map_totals.sum()
+            p = W[:, np.newaxis] * n / n_i[:, np.newaxis]
+            p[n_i == 0, :] = 0
+
+        diag = np.diag(p)
+        out = {
+            'overall': diag.sum(),
+            'users': diag / p.sum(axis=1),
+            'producers': diag / p.sum(axis=0)
+        }
+
+        if map_totals is not None:
+            ratio = n / n_i[:, np.newaxis]
+            ratio[n_i == 0, :] = 0
+            var = (W ** 2)[:, np.newaxis] * ratio * (1 - ratio) / \
+                (n_i - 1)[:, np.newaxis]
+            var[n_i <= 1, :] = 0
+            out['area'] = p.sum(axis=0) * map_totals.sum()
+            out['area_se'] = np.sqrt(var.sum(axis=0)) * map_totals.sum()
+            out['overall_se'] = np.sqrt(np.diag(var).sum())
+
+    return out
+
+
+def write_accuracy(output, classes, acc):
+    """ Write accuracy measures for each class to CSV file """
+    header = ['class', 'users', 'producers']
+    if 'area' in acc:
+        header.extend(['area', 'area_se'])
+    with open(output, 'w') as f:
+        f.write(','.join(header) + '\n')
+        for i, c in enumerate(classes):
+            row = [str(c)] + [repr(float(acc[h][i])) for h in header[1:]]
+            f.write(','.join(row) + '\n')
+        row = ['overall', repr(float(acc['overall'])), '']
+        if 'area' in acc:
+            row.extend(['', repr(float(acc['overall_se']))])
+        f.write(','.join(row) + '\n')
+
+
 def main():
     """ Read input arguments, check them, then run script """
     # Raster map
@@ -212,12 +466,41 @@ def main():
     # Attribute in vector layer
     attribute = args['--attribute']
 
-    # Rasterize vector file
-    rasterized, raster_image, ndv = rasterize_map(
+    # Block size
+    try:
+        block_size = int(args['--blocksize'])
+    except ValueError:
+        logging.error('Block size must be an integer')
+        sys.exit(1)
+
+    raster_ds, vector_ds, layer, ndv = open_reference(
         raster, vector, attribute, layer=layer)
 
-    # Crosstabulate
-    crosstab = crosstabulate(rasterized, raster_image, ndv=ndv)
+    # Rasterize vector file and crosstabulate block by block
+    xtab = CrossTabulation(ndv=ndv)
+    band = raster_ds.GetRasterBand(1)
+    transform = layer_transform(raster_ds, layer)
+    for row in range(0, raster_ds.RasterYSize, block_size):
+        nrow = min(block_size, raster_ds.RasterYSize - row)
+        rasterized = rasterize_block(raster_ds, layer, attribute, ndv,
+                                     row, nrow, transform=transform)
+        raster_image = band.ReadAsArray(0, row, raster_ds.RasterXSize, nrow)
+        weights = pixel_area(raster_ds, row, nrow) if args['--area'] \
+            else None
+        xtab.update(rasterized, raster_image, weights=weights)
+    logger.debug('Crosstabulated map with reference data')
+
+    classes, tab = xtab.classes, xtab.table()
+    crosstab = format_crosstab(classes, tab,
+                               fmt='%f' if args['--area'] else '%i')
+
+    if args['--accuracy']:
+        map_totals = np.array([xtab.map_totals.get(c, 0) for c in classes],
+                              dtype=np.float64)
+        # Sample counts, not areas, with map class areas as strata weights
+        write_accuracy(args['--accuracy'], classes,
+                       accuracy(xtab.table(counts=True),
+                                map_totals=map_totals))
 
     print(crosstab)
     with open(output, 'w') as f:
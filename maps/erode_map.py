@@ -11,10 +11,11 @@ Usage:
 Options:
     --label             Instead, create image with labeled patches from the
                             eroded map
-    -w --window=<w>     Convolution window size (must be odd) [default: 3]
+    -w --window=<w>     Erosion window size (must be odd) [default: 3]
     -m --max=<max>...   Maximum number of pixels per class
     -n --ndv=<ndv>      Override output map NoDataValue
     -f --format=<f>     Output data format [default: GTiff]
+    -b --blocksize=<b>  Number of rows processed at once [default: 1024]
     -v --debug          Show (verbose) debugging messages
     -h --help           Show help
 
@@ -31,6 +32,13 @@ Notes:
         2. One value per unmasked class with each value separated by spaces
             or commas (e.g., in 3 class map, "--max 5, 10 ,5)"
 
+    Pixels remain after erosion if their 4-connected neighbors (for a
+    window of 3) share their class. Larger windows repeat the erosion once
+    for each additional pixel of window radius.
+
+    Maps are eroded and labeled in blocks of rows, so memory depends on
+    "--blocksize" rather than map size.
+
 """
 from __future__ import print_function, division
 import logging
@@ -49,6 +57,8 @@ except ImportError:
     import gdal_array
 
 import scipy.ndimage
+import scipy.sparse
+import scipy.sparse.csgraph
 import numpy as np
 
 logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
@@ -57,10 +67,138 @@ logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
 logger = logging.getLogger(__name__)
 
 
+def erosion_footprint(window):
+    """
+    Returns footprint of neighbors that must share a pixel's class for the
+    pixel to remain after erosion: the 3x3 cross used by
+    scipy.ndimage.binary_erosion, iterated to the radius of the window
+    """
+    return scipy.ndimage.iterate_structure(
+        scipy.ndimage.generate_binary_structure(2, 1), window // 2)
+
+
+def erode_classes(padded, footprint):
+    """
+    Erodes every class of a map at once
+
+    A pixel keeps its class only if every neighbor within footprint has the
+    same class, which matches binary erosion of each class separately. Map
+    must be padded by the footprint radius on each side, and 0 is treated as
+    unclassified.
+
+    Returns:
+        np.ndarray: eroded map, without padding
+    """
+    r = footprint.shape[0] // 2
+    nrow = padded.shape[0] - 2 * r
+    ncol = padded.shape[1] - 2 * r
+
+    center = padded[r:r + nrow, r:r + ncol]
+    keep = center != 0
+    for dy, dx in zip(*np.nonzero(footprint)):
+        keep &= padded[dy:dy + nrow, dx:dx + ncol] == center
+
+    return center * keep
+
+
+def read_eroded(band, ndv, footprint, block_size):
+    """
+    Yields first row, source map, and eroded map for blocks of rows of map
+
+    Blocks are read with neighboring rows so erosion matches eroding entire
+    map. Pixels beyond the edges of map count as unclassified.
+    """
+    r = footprint.shape[0] // 2
+    rows, cols = band.YSize, band.XSize
+    for start in range(0, rows, block_size):
+        end = min(start + block_size, rows)
+        read_start = max(start - r, 0)
+        read_end = min(end + r, rows)
+
+        source_map = band.ReadAsArray(0, read_start, cols,
+                                      read_end - read_start)
+        masked_map = source_map * (source_map != ndv)
+        padded = np.pad(masked_map,
+                        ((r - (start - read_start), r - (read_end - end)),
+                         (r, r)),
+                        mode='constant')
+
+        yield (start, source_map[start - read_start:end - read_start],
+               erode_classes(padded, footprint))
+
+
+def subsample(eroded, classes, chosen, seen):
+    """
+    Keeps only chosen pixels of classes being subsampled within block
+
+    Pixels of each class are ranked in the order they are read, continuing
+    from `seen`, and only pixels whose rank is among the class's chosen
+    (sorted) ranks are kept. Updates `seen` in place.
+    """
+    flat = eroded.ravel()
+    for i, u in enumerate(classes):
+        if chosen[i] is None:
+            continue
+        pos = np.flatnonzero(flat == u)
+        ranks = seen[i] + np.arange(pos.size)
+        idx = np.minimum(np.searchsorted(chosen[i], ranks),
+                         chosen[i].size - 1)
+        flat[pos[chosen[i][idx] != ranks]] = 0
+        seen[i] += pos.size
+    return eroded
+
+
+def seam_pairs(above, below):
+    """
+    Returns pairs of labels that are 8-connected across the seam between the
+    last row of one block (above) and first row of next block (below)
+    """
+    pairs = []
+    for dx in (-1, 0, 1):
+        a = above[max(0, -dx):above.size - max(0, dx)]
+        b = below[max(0, dx):below.size - max(0, -dx)]
+        connected = (a != 0) & (b != 0)
+        pairs.append(np.vstack((a[connected], b[connected])))
+    return np.hstack(pairs)
+
+
+def merge_labels(nlabels, pairs):
+    """
+    Returns lookup table from provisional label to final label given pairs
+    of provisional labels belonging to the same patch
+
+    Pairs are edges of a sparse (COO) graph of provisional labels, and
+    patches are its connected components from
+    scipy.sparse.csgraph.connected_components, numbered by their smallest
+    provisional label, which is the order scipy.ndimage.label numbers
+    patches of the entire map.
+    """
+    graph = scipy.sparse.coo_matrix(
+        (np.ones(pairs.shape[1], dtype=np.int8), (pairs[0], pairs[1])),
+        shape=(nlabels + 1, nlabels + 1))
+    _, component = scipy.sparse.csgraph.connected_components(
+        graph, directed=False)
+
+    # Components in order of their smallest provisional label
+    _, first = np.unique(component[1:], return_index=True)
+    final = np.zeros(component.max() + 1, dtype=np.int64)
+    final[component[1:][np.sort(first)]] = np.arange(1, first.size + 1)
+
+    lookup = final[component]
+    lookup[0] = 0
+    return lookup
+
+
 def process_map(in_name, out_name, out_driver, window, ndv, max_pix,
-                label=False):
+                label=False, block_size=1024):
     """
     Opens map applies erosion filter and handles output of map
+
+    Map is processed in blocks of rows so memory depends on block size and
+    sample size, not map size. First pass erodes map to count pixels of each
+    eroded class. Second pass erodes map again, keeps sampled pixels, labels
+    patches within each block, and records labels touching across block
+    seams. Third pass merges labels across seams.
     """
     # Open source input image
     src_ds = gdal.Open(in_name, GA_ReadOnly)
@@ -68,24 +206,34 @@ def process_map(in_name, out_name, out_driver, window, ndv, max_pix,
         print('Error: could not open {0}'.format(in_name))
         sys.exit(1)
 
-    src_datatype = src_ds.GetRasterBand(1).DataType
-
-    # Read map into NumPy array
-    source_map = src_ds.GetRasterBand(1).ReadAsArray()
+    src_band = src_ds.GetRasterBand(1)
+    src_datatype = src_band.DataType
+    rows, cols = src_ds.RasterYSize, src_ds.RasterXSize
+    if block_size <= 0:
+        block_size = rows
 
     # If user hasn't overriden datatype, get from map in map's datatype
     if not ndv:
-        ndv = src_ds.GetRasterBand(1).GetNoDataValue()
+        ndv = src_band.GetNoDataValue()
         if not ndv:
             ndv = 0
         ndv = gdal_array.GDALTypeCodeToNumericTypeCode(src_datatype)(ndv)
-
-    # Create initial mask and masked map
-    mask = np.ma.masked_equal(source_map, ndv)
-    masked_map = source_map * (source_map != ndv)
-
-    # Find unique values (classes) from map
-    classes = np.unique(mask.compressed())
+    else:
+        ndv = np.asarray(ndv).astype(
+            gdal_array.GDALTypeCodeToNumericTypeCode(src_datatype))[()]
+
+    footprint = erosion_footprint(window)
+
+    # First pass -- find unique values (classes) and eroded size of each
+    counts = {}
+    for row, source_map, eroded in read_eroded(src_band, ndv, footprint,
+                                               block_size):
+        for u in np.unique(source_map[source_map != ndv]).tolist():
+            counts.setdefault(u, 0)
+        u, n = np.unique(eroded[eroded != 0], return_counts=True)
+        for u, n in zip(u.tolist(), n.tolist()):
+            counts[u] += n
+    classes = np.array(sorted(counts))
 
     # Check that either:
     #   1. max_pix is None
@@ -102,93 +250,95 @@ def process_map(in_name, out_name, out_driver, window, ndv, max_pix,
         print(classes)
         sys.exit(1)
 
-    # Setup output matrix for erosion
-    map_erode = np.zeros_like(masked_map)
-
+    # Choose ranks of pixels to keep from classes larger than maximum
+    chosen = [None] * len(classes)
     for i, u in enumerate(classes):
         # Don't work on 0 since 0 is not classified
-        if u == 0:
+        if u == 0 or max_pix is None:
             continue
 
-        # Do erosion
-        eroded = scipy.ndimage.morphology.binary_erosion(masked_map == u)
-
-        # Erode further, if required
-        if max_pix is not None:
-            # Find number specified for this class
-            if len(max_pix) == 1:
-                m = max_pix[0]
-            else:
-                m = max_pix[i]
-
-            logger.debug('Sampling class {u} to {n} pixels'.format(u=u, n=m))
+        # Find number specified for this class
+        if len(max_pix) == 1:
+            m = max_pix[0]
+        else:
+            m = max_pix[i]
 
-            # Find number of pixels
-            n_pix = np.sum(eroded)
+        logger.debug('Sampling class {u} to {n} pixels'.format(u=u, n=m))
 
-            # Iterate until smaller than specified
-            if n_pix > m:
-                logger.debug('   Sampling class {u}'.format(u=u))
-                logger.debug('        {n} > {m}'.format(n=n_pix, m=m))
+        # Find number of pixels
+        n_pix = counts[u]
 
-                # Sample
-                ind = np.ravel_multi_index(np.where(eroded == 1), eroded.shape)
+        if n_pix > m:
+            logger.debug('   Sampling class {u}'.format(u=u))
+            logger.debug('        {n} > {m}'.format(n=n_pix, m=m))
 
-                ind = np.random.choice(ind, m, replace=False)
+            # Sample
+            chosen[i] = np.sort(np.random.choice(n_pix, m, replace=False))
+            n_pix = m
 
-                eroded = np.zeros_like(eroded)
-                eroded[np.unravel_index(ind, eroded.shape)] = 1
+        logger.debug('Finished sampling class {u} to size {n}'.format(
+            u=u, n=n_pix))
 
-#                # Erode again
-#                eroded = scipy.ndimage.morphology.binary_erosion(eroded)
-                # Recalculate
-                n_pix = np.sum(eroded)
-
-            logger.debug('Finished sampling class {u} to size {n}'.format(
-                u=u, n=n_pix))
-
-        # Add in this class to full map
-        map_erode = map_erode + eroded * u
-
-    # Clean up memory
-    del(eroded)
-
-    # Add NDV back in
-    unmasked_erode = ndv * (source_map == ndv) + map_erode
-
-    # Label eroded ROI
+    # Find output datatype -- upcast map or label to match biggest possible
+    np_dtype = gdal_array.GDALTypeCodeToNumericTypeCode(src_datatype)
     if label:
-        lab, nlab = scipy.ndimage.label(map_erode,
-                                        structure=np.ones(9).reshape(3, 3))
-        lab = ndv * (source_map == ndv) + lab
-
-        # Convert datatype to minimum necessary
-        lab = lab.astype(np.min_scalar_type(lab.max()))
-
-
-
-    # Find output datatype -- upcast map or label to match biggest
-    np_dtype = (np.promote_types(unmasked_erode.dtype, lab.dtype) if label
-                else unmasked_erode.dtype)
-    gdal_dtype = gdal_array.NumericTypeCodeToGDALTypeCode(np_dtype.type)
+        np_dtype = np.promote_types(np_dtype,
+                                    np.min_scalar_type(rows * cols))
+    gdal_dtype = gdal_array.NumericTypeCodeToGDALTypeCode(
+        np.dtype(np_dtype).type)
 
     nbands = 2 if label else 1
 
-    dst_ds = out_driver.Create(out_name,
-                               src_ds.RasterXSize, src_ds.RasterYSize,
-                               nbands, gdal_dtype)
+    dst_ds = out_driver.Create(out_name, cols, rows, nbands, gdal_dtype)
     if dst_ds is None:
         print('Error: could not write to {0}'.format(out_name))
         sys.exit(1)
 
-    # Write data
+    # Second pass -- erode, sample, and label patches within blocks
     dst_ds.GetRasterBand(1).SetNoDataValue(ndv.item())
-    dst_ds.GetRasterBand(1).WriteArray(unmasked_erode)
     dst_ds.SetDescription('Eroded map')
 
+    seen = np.zeros(len(classes), dtype=np.int64)
+    nlabels = 0
+    last_row = None
+    pairs = [np.zeros((2, 0), dtype=np.int64)]
+    for row, source_map, eroded in read_eroded(src_band, ndv, footprint,
+                                               block_size):
+        map_erode = subsample(eroded, classes, chosen, seen)
+
+        # Add NDV back in
+        unmasked_erode = np.where(source_map == ndv, ndv, map_erode)
+        dst_ds.GetRasterBand(1).WriteArray(unmasked_erode, 0, row)
+
+        # Label eroded ROI
+        if label:
+            lab, nlab = scipy.ndimage.label(map_erode,
+                                            structure=np.ones(9).reshape(3, 3))
+            lab = lab.astype(np.int64)
+            lab[lab > 0] += nlabels
+            nlabels += nlab
+            if last_row is not None:
+                pairs.append(seam_pairs(last_row, lab[0]))
+            last_row = lab[-1]
+
+            # Provisional labels
+            dst_ds.GetRasterBand(2).WriteArray(lab, 0, row)
+
+    # Third pass -- merge labels across blocks
     if label:
-        dst_ds.GetRasterBand(2).SetNoDataValue(ndv.item())
-        dst_ds.GetRasterBand(2).WriteArray(lab)
+        lookup = merge_labels(nlabels, np.hstack(pairs))
+        logger.debug('Merged {n} labels across blocks into {m}'.format(
+            n=nlabels, m=lookup.max()))
+
+        lab_band = dst_ds.GetRasterBand(2)
+        for row in range(0, rows, block_size):
+            nrow = min(block_size, rows - row)
+            lab = lookup[lab_band.ReadAsArray(0, row, cols, nrow)]
+            source_map = src_band.ReadAsArray(0, row, cols, nrow)
+            lab = np.where(source_map == ndv, ndv, lab)
+            lab_band.WriteArray(lab, 0, row)
+
+        lab_band.SetNoDataValue(ndv.item())
         dst_ds.SetDescription('Labeled, eroded map')
 
     # Write projection/etc
@@ -269,9 +419,16 @@ def main():
             print('Error: Nodata value must be an integer')
             sys.exit(1)
 
+    # Block size
+    try:
+        block_size = int(arguments['--blocksize'])
+    except ValueError:
+        print('Error: block size must be an integer')
+        sys.exit(1)
+
     ## perform file handling and send to erosion function
     process_map(in_name, out_name, out_driver, window, ndv, max_pix,
-                label=label)
+                label=label, block_size=block_size)
 
 
 if __name__ == '__main__':
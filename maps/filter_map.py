@@ -7,6 +7,10 @@ Filters a change map for high-frequency "noisy" changes using moving window.
 Retains change pixel if neighborhood contains at least [threshold] number of
 changes.
 
+Map is processed in blocks of rows with an overlapping "halo" of rows above
+and below each block so that the filtered output is identical to filtering
+the entire map at once. Blocks may be filtered in parallel.
+
 Usage:
     filter_map.py [options] ( --erode | --dilate ) <input> <output>
 
@@ -15,6 +19,9 @@ Options:
     -t --threshold=<t>      Threshold changes within window (default: 3)
     -n --ndv <ndv>          No data value [default: 0]
     -f --format=<format>    Output data format [default: GTiff]
+    -b --blocksize=<b>      Number of rows per block (0 for entire map)
+                                [default: 1024]
+    -p --ncpu=<n>           Number of processes for filtering [default: 1]
     -v --debug              Show (verbose) debugging messages
     -h --help               Show help
 
@@ -30,6 +37,7 @@ except ImportError:
     import gdal
     from gdalconst import GA_ReadOnly
 
+import multiprocessing
 import os
 import sys
 
@@ -38,36 +46,109 @@ import scipy.ndimage
 
 DEBUG = False
 
-def filter_map(in_name, out_name, out_driver, 
-               choice, threshold, window, ndv):
+def block_windows(nrow, block_size, halo):
+    """
+    Yields (read_start, read_end, core_start, core_end) row windows that cover
+    an image of nrow rows in blocks of block_size rows, padded by halo rows on
+    each side where available. The core rows are relative to the read window.
+
+    Blocks touching the top or bottom of the image are not padded beyond the
+    image so that edge handling is the same as for the entire image.
+    """
+    if block_size <= 0 or block_size >= nrow:
+        yield 0, nrow, 0, nrow
+        return
+
+    for start in xrange(0, nrow, block_size):
+        end = min(start + block_size, nrow)
+        read_start = max(start - halo, 0)
+        read_end = min(end + halo, nrow)
+        yield read_start, read_end, start - read_start, end - read_start
+
+def filter_halo(choice, window):
+    """
+    Returns number of rows of neighboring context needed for output of filter
+    to match filtering entire image
+
+    Erosion depends upon the convolved mask within window / 2 pixels. Dilation
+    dilates the convolved mask, which depends upon pixels an additional
+    window / 2 pixels away.
+    """
+    radius = window // 2
+    if choice == 'erode':
+        return radius
+    return 2 * radius
+
+def _filter_block(args):
+    """
+    Reads, filters, and crops one block of map
+
+    Opens input map within the worker so GDAL datasets do not need to be
+    passed between processes.
+    """
+    (in_name, choice, threshold, window, ndv,
+     read_start, read_end, core_start, core_end) = args
+
+    src_ds = gdal.Open(in_name, GA_ReadOnly)
+    image = src_ds.GetRasterBand(1).ReadAsArray(
+        0, read_start, src_ds.RasterXSize, read_end - read_start)
+    src_ds = None
+
+    if choice == 'erode':
+        out_image = erode_map(image, threshold, window, ndv)
+    elif choice == 'dilate':
+        out_image = dilate_map(image, threshold, window, ndv)
+
+    return read_start + core_start, out_image[core_start:core_end, :]
+
+def filter_map(in_name, out_name, out_driver,
+               choice, threshold, window, ndv, block_size=0, ncpu=1):
     """
     Opens map, applies filter of choice, and handles the output of map
+
+    Map is filtered in blocks of block_size rows (entire map if 0), using up
+    to ncpu processes.
     """
     # Read in input data
     src_ds = gdal.Open(in_name, GA_ReadOnly)
     if src_ds is None:
         print 'Error: could not open {0}'.format(in_name)
         sys.exit(1)
-    image = src_ds.GetRasterBand(1).ReadAsArray()
-    
-    if choice == 'erode':
-        out_image = erode_map(image, threshold, window, ndv)
-    elif choice == 'dilate':
-        out_image = dilate_map(image, threshold, window, ndv)
-   
+
     # Write mask to disk
     dst_ds = out_driver.Create(out_name,
                            src_ds.RasterXSize, src_ds.RasterYSize, 1,
                            gdal.GDT_Byte)
     if dst_ds is None:
         print 'Error: could not write to {0}'.format(out_name)
+        sys.exit(1)
 
     dst_ds.SetProjection(src_ds.GetProjection())
     dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
-    
-    dst_ds.GetRasterBand(1).SetNoDataValue(ndv)
 
-    dst_ds.GetRasterBand(1).WriteArray(out_image)
+    dst_band = dst_ds.GetRasterBand(1)
+    dst_band.SetNoDataValue(ndv)
+
+    halo = filter_halo(choice, window)
+    jobs = [(in_name, choice, threshold, window, ndv) + w
+            for w in block_windows(src_ds.RasterYSize, block_size, halo)]
+
+    if ncpu > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(ncpu)
+        results = pool.imap(_filter_block, jobs)
+    else:
+        pool = None
+        results = (_filter_block(job) for job in jobs)
+
+    for row, out_image in results:
+        if DEBUG:
+            print 'Writing rows {0}-{1}'.format(
+                row, row + out_image.shape[0])
+        dst_band.WriteArray(out_image, 0, row)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     # Close
     src_ds = None
@@ -161,12 +242,27 @@ def main():
     except ValueError:
         print 'Error: NoDataValue must be an integer'
         sys.exit(1)
+    # Block size
+    try:
+        block_size = int(arguments['--blocksize'])
+    except ValueError:
+        print 'Error: block size must be an integer'
+        sys.exit(1)
+    # Number of processes
+    try:
+        ncpu = int(arguments['--ncpu'])
+    except ValueError:
+        print 'Error: number of CPUs must be an integer'
+        sys.exit(1)
+    if ncpu < 1:
+        ncpu = 1
 
     # Register drivers
     gdal.AllRegister()
     # Filter map
     choice = 'erode' if arguments['--erode'] else 'dilate'
-    filter_map(in_name, out_name, out_driver, choice, threshold, window, ndv)
+    filter_map(in_name, out_name, out_driver, choice, threshold, window, ndv,
+               block_size=block_size, ncpu=ncpu)
 
 if __name__ == '__main__':
     arguments = docopt(__doc__)
@@ -10,13 +10,22 @@ Options:
     -c --colname            Header column names
     -d --delim=<delim>      CSV delimiter [default: ,]
     -q --quote=<quote>      CSV quote character [default: "]
+    --default=<value>       Output value for values not in LUT (default is
+                                to keep input value)
     --format=<format>       Output format [default: ENVI]
+    -b --blocksize=<b>      Number of rows processed at once [default: 1024]
+    -p --ncpu=<n>           Number of processes [default: 1]
     -v --debug              Show (verbose) debugging messages
     -h --help               Show help
+
+Notes:
+    The LUT CSV has input values in the first column and output values in
+    each remaining column. Each column is written as one band of output.
 """
 from docopt import docopt
 
 import csv
+import multiprocessing
 import os
 import sys
 
@@ -37,84 +46,190 @@ DEBUG = False
 
 def read_lut(csvfile, header, delimiter, quotechar):
     """
-    Reads CSV file and records LUT as dictionary
+    Reads CSV file and records LUT as dictionary of input value to list of
+    output values, one for each column after the first
     """
     # Read in file
     with open(csvfile, 'rb') as f:
         csvreader = csv.reader(f, delimiter=delimiter, quotechar=quotechar)
         if header:
             csvreader.next()
-        lut = { int(row[0]) : int(row[1]) for row in csvreader }
+        lut = { int(row[0]) : [int(v) for v in row[1:]]
+                for row in csvreader if row }
+
+    ncol = set([len(v) for v in lut.values()])
+    if len(ncol) != 1 or 0 in ncol:
+        print 'Error: each LUT row must have the same number of columns'
+        sys.exit(1)
 
     if DEBUG:
         print 'Read in LUT:\n {0}'.format(lut)
 
     return lut
 
-def lutx(lut, input, output, format):
+def lut_dtype(values):
     """
-    Reads in input image, applies lut and outputs image
+    Returns smallest NumPy data type that GDAL can write for values
     """
-    # Read in input image
-    gdal.AllRegister()
-    src_ds = gdal.Open(input, GA_ReadOnly)
-    if src_ds is None:
-        print 'Error: could not open {0}'.format(input)
-    rows = src_ds.RasterYSize
-    cols = src_ds.RasterXSize
-    # Read in data
-    band = src_ds.GetRasterBand(1)
-    dtype = band.DataType
-    data = band.ReadAsArray(0, 0, cols, rows).astype(
-                                gdal_array.flip_code(dtype))
-    
-    # Determine requiredo output datatype
+    vmin, vmax = np.min(values), np.max(values)
     out_dt = np.byte
-    if np.min(lut.values()) < 0:
+    if vmin < 0:
         # Must be signed int
-        if np.max(np.abs(lut.values())) < 2 ** 15:
+        if np.max(np.abs(values)) < 2 ** 15:
             # NOTE: put np.int8 as np.int16 since GDAL has no int8
             out_dt = np.int16
-        elif np.max(np.abs(lut.values())) < 2 ** 31:
+        elif np.max(np.abs(values)) < 2 ** 31:
             out_dt = np.int32
-        elif np.max(np.abs(lut.values())) < 2 ** 63:
+        elif np.max(np.abs(values)) < 2 ** 63:
             out_dt = np.int64
         else:
             print 'Required output data type is unknown'
             sys.exit(1)
     else:
         # Can be unsigned
-        if np.max(lut.values()) < 2 ** 8:
+        if vmax < 2 ** 8:
             out_dt = np.uint8
-        elif np.max(lut.values()) < 2 ** 16:
+        elif vmax < 2 ** 16:
             out_dt = np.uint16
-        elif np.max(lut.values()) < 2 ** 32:
+        elif vmax < 2 ** 32:
             out_dt = np.uint32
-        elif np.max(lut.values()) < 2 ** 64:
+        elif vmax < 2 ** 64:
             out_dt = np.uint64
         else:
             print 'Required output data type is unknown'
             sys.exit(1)
+    return out_dt
+
+class LUT(object):
+    """
+    Vectorized look-up-table reclassification
+
+    Input data types of 16 bits or less are reclassified by indexing a dense
+    array holding the output of every possible input value. Wider data types
+    are reclassified by locating values within the sorted LUT keys using
+    np.searchsorted. Either way, each block is reclassified in one pass for
+    all LUT columns.
+
+    Unmapped values are set to default, or keep their input value if default
+    is None.
+    """
+    def __init__(self, lut, in_dt, out_dt, default=None):
+        self.keys = np.array(sorted(lut.keys()))
+        self.values = np.array([lut[k] for k in self.keys],
+                               dtype=out_dt).reshape(len(self.keys), -1)
+        self.nbands = self.values.shape[1]
+        self.in_dt = np.dtype(in_dt)
+        self.out_dt = out_dt
+        self.default = default
+
+        self.dense = None
+        if self.in_dt.kind in 'biu' and self.in_dt.itemsize <= 2:
+            info = np.iinfo(self.in_dt)
+            self.offset = info.min
+            codes = np.arange(info.min, info.max + 1)
+            self.dense = self._lookup(codes)
+
+    def _lookup(self, data):
+        """
+        Returns (nbands x data.shape) reclassified data using sorted keys
+        """
+        idx = np.searchsorted(self.keys, data)
+        idx[idx == len(self.keys)] = 0
+        found = self.keys[idx] == data
+
+        out = np.empty((self.nbands, ) + data.shape, dtype=self.out_dt)
+        if self.default is None:
+            out[:] = data.astype(self.out_dt)
+        else:
+            out[:] = self.default
+        for b in range(self.nbands):
+            out[b][found] = self.values[idx[found], b]
+        return out
+
+    def apply(self, data):
+        """
+        Returns (nbands x data.shape) reclassified data
+        """
+        if self.dense is not None:
+            return self.dense[:, data.astype(np.int64) - self.offset]
+        return self._lookup(data)
+
+# Set within each process of pool used by lutx
+_LUT = None
+
+def _init_worker(lut):
+    global _LUT
+    _LUT = lut
+
+def _lutx_block(args):
+    """
+    Reads and reclassifies one block of rows
+    """
+    input, row, nrow = args
+    src_ds = gdal.Open(input, GA_ReadOnly)
+    data = src_ds.GetRasterBand(1).ReadAsArray(0, row,
+                                               src_ds.RasterXSize, nrow)
+    src_ds = None
+    return row, _LUT.apply(data)
+
+def lutx(lut, input, output, format, default=None, block_size=1024, ncpu=1):
+    """
+    Reads in input image block by block, applies lut and outputs image with
+    one band per LUT column
+    """
+    # Read in input image
+    gdal.AllRegister()
+    src_ds = gdal.Open(input, GA_ReadOnly)
+    if src_ds is None:
+        print 'Error: could not open {0}'.format(input)
+        sys.exit(1)
+    rows = src_ds.RasterYSize
+    cols = src_ds.RasterXSize
+    band = src_ds.GetRasterBand(1)
+    in_dt = gdal_array.flip_code(band.DataType)
+    
+    # Determine required output datatype
+    values = [v for vs in lut.values() for v in vs]
+    if default is not None:
+        values.append(default)
+    out_dt = lut_dtype(values)
 
     if DEBUG:
         print 'NumPy data type:  %s' % str(out_dt)
         print 'GDAL data type:   %s' % str(
             gdal.GetDataTypeName(gdal_array.flip_code(out_dt)))
 
-    # Copy data for output
-    lutdata = data.copy().astype(out_dt)
-    # Apply lut
-    for key, value in lut.iteritems():
-        np.place(lutdata, data == key, value)
+    table = LUT(lut, in_dt, out_dt, default=default)
 
     # Write to output
     driver = gdal.GetDriverByName(format)
     dst_ds = driver.Create(output, 
-                           src_ds.RasterXSize, src_ds.RasterYSize, 1,
+                           src_ds.RasterXSize, src_ds.RasterYSize,
+                           table.nbands,
                            gdal_array.flip_code(out_dt))
     dst_ds.SetProjection(src_ds.GetProjection())
     dst_ds.SetGeoTransform(src_ds.GetGeoTransform())
-    dst_ds.GetRasterBand(1).WriteArray(lutdata)
+
+    if block_size <= 0:
+        block_size = rows
+    jobs = [(input, row, min(block_size, rows - row))
+            for row in xrange(0, rows, block_size)]
+    if ncpu > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(ncpu, _init_worker, (table, ))
+        results = pool.imap_unordered(_lutx_block, jobs)
+    else:
+        pool = None
+        _init_worker(table)
+        results = (_lutx_block(job) for job in jobs)
+
+    for row, lutdata in results:
+        for b in range(table.nbands):
+            dst_ds.GetRasterBand(b + 1).WriteArray(lutdata[b], 0, row)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
     # Close
     src_ds = None
     dst_ds = None
@@ -154,11 +269,27 @@ def main():
    
     # Format
     format = arguments['--format']
+    # Default value
+    default = arguments['--default']
+    if default is not None:
+        try:
+            default = int(default)
+        except ValueError:
+            print 'Error: default value must be an integer'
+            sys.exit(1)
+    # Block size and number of processes
+    try:
+        block_size = int(arguments['--blocksize'])
+        ncpu = int(arguments['--ncpu'])
+    except ValueError:
+        print 'Error: block size and number of processes must be integers'
+        sys.exit(1)
 
     # Read CSV and get look-up-table
     lut = read_lut(csvfile, header, delim, quotechar)
     # Execute LUT
-    lutx(lut, input, output, format)
+    lutx(lut, input, output, format, default=default,
+         block_size=block_size, ncpu=ncpu)
 
 if __name__ == '__main__':
     arguments = docopt(__doc__)
@@ -9,6 +9,10 @@ Usage:
 Options:
     --of=<format>                   Output format [default: GTiff]
     --masks=<filename>              Save the mask image?
+    --ties=<rule>                   Band chosen when bands tie for the most
+                                        observations (first or last)
+                                        [default: first]
+    --blocksize=<rows>              Rows processed at once [default: 1024]
     -v --debug                      Show (verbose) debugging messages
     -q --quiet                      Do not show messages
     -h --help                       Show help
@@ -31,10 +35,26 @@ sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 QUIET = False
 DEBUG = False
 
-def create_map(map_mosaic, nobs_mosaic, output, mask_fn, out_format):
+def select_band(nobs, ties='first'):
+    """
+    Returns index of band with the most observations for each pixel of a
+    stack (bands x rows x cols) of the number of observations
+
+    Ties go to the first band with the most observations, or the last band
+    if ties is "last".
+    """
+    if ties == 'last':
+        return nobs.shape[0] - 1 - np.argmax(nobs[::-1], axis=0)
+    return np.argmax(nobs, axis=0)
+
+def create_map(map_mosaic, nobs_mosaic, output, mask_fn, out_format,
+               ties='first', block_size=1024):
     """
     Creates one map using the land cover estimated from the most number of
     observations
+
+    Reads, selects, and writes blocks of rows so that mosaics do not need to
+    fit in memory. The map and mask image are written in the same pass.
     """
     # Read in data
     map_ds = gdal.Open(map_mosaic, gdal.GA_ReadOnly)
@@ -44,9 +64,6 @@ def create_map(map_mosaic, nobs_mosaic, output, mask_fn, out_format):
     if DEBUG:
         print 'Opened #Obs file {f}'.format(f=nobs_mosaic)
 
-    # Fetch NoDataValue
-    ndv = map_ds.GetRasterBand(1).GetNoDataValue()
-
     # Check number of bands
     bands = map_ds.RasterCount
     if bands != nobs_ds.RasterCount:
@@ -55,95 +72,68 @@ def create_map(map_mosaic, nobs_mosaic, output, mask_fn, out_format):
     if DEBUG:
         print 'Input image has {n} map bands'.format(n=bands)
 
-    # Read in number of observations into list of np.array
-    nobs = []
-    for i in xrange(bands):
-        nobs.append(nobs_ds.GetRasterBand(i + 1).ReadAsArray())
-        if nobs[i] is None:
-            print 'Error: could not read band {b} from image'.format(b=i + 1)
-            sys.exit(1)
-    if DEBUG:
-        print 'Read in the number of observations bands'
-        
-    # Setup and generate masks
-    masks = []
-    if DEBUG:
-        print 'Starting the masking...'
-    for i in xrange(bands):
-        if i == 0:
-            # Don't worry about pixels already being filled
-            masks.append(reduce(np.logical_and, 
-                            [np.greater_equal(nobs[i], n) 
-                            for n in nobs if n is not nobs[i]]))
-        else:
-            # Also need to check to make sure hasn't been filled
-            masks.append(reduce(np.logical_and,
-                            [np.logical_and(
-                                np.greater_equal(nobs[i], b), m == False) 
-                                for b in nobs if b is not nobs[i] 
-                                for m in masks
-                            ]
-                        )
-                    )
-            masks[i] = masks[i] * masks[i] != ndv
-        if DEBUG:
-            print 'Masked image {i} of {t}'.format(i=(i + 1), t=bands)
+    rows, cols = map_ds.RasterYSize, map_ds.RasterXSize
+    if block_size <= 0:
+        block_size = rows
 
+    mask_ds = None
     if mask_fn is not None:
         mask_driver = gdal.GetDriverByName(out_format)
-        mask_ds = mask_driver.Create(mask_fn, map_ds.RasterXSize, 
-                                     map_ds.RasterYSize, 1)
+        mask_ds = mask_driver.Create(mask_fn, cols, rows, 1)
         if mask_ds is None:
             print 'Error: could not write output mask {f}'.format(f=mask_fn)
             sys.exit(1)
-        if DEBUG:
-            print 'Writing out mask rule image'
-        
-        # Condense mask
-        mask = np.zeros_like(masks[0])
-        for i, m in enumerate(masks):
-            mask = mask + m * (i + 1)
-        
-        # Write to disk
-        mask_ds.GetRasterBand(1).WriteArray(mask)
         mask_ds.SetProjection(map_ds.GetProjection())
         mask_ds.SetGeoTransform(map_ds.GetGeoTransform())
+        if DEBUG:
+            print 'Writing out mask rule image'
 
-        del(mask)
-        mask_ds = None
-
-    # Clear memory by removing nobs
-    del(nobs)
-    nobs_ds = None
-
-    # Read in land cover maps
-    maps = []
-    for i in xrange(bands):
-        maps.append(map_ds.GetRasterBand(i + 1).ReadAsArray())
-        if maps[i] is None:
-            print 'Could not read in band {b} from image'.format(b=(i + 1))
-            sys.exit(1)
-    if DEBUG:
-        print 'Read in the maps'
-
-    # Create composite land cover map
-    lc_map = np.zeros_like(maps[0])
-    for i in xrange(bands):
-        lc_map = lc_map + masks[i] * maps[i]
-
-    # Write out
     out_driver = gdal.GetDriverByName(out_format)
-    out_ds = out_driver.Create(output, map_ds.RasterXSize, map_ds.RasterYSize, 
+    out_ds = out_driver.Create(output, cols, rows,
                                1, map_ds.GetRasterBand(1).DataType)
     if out_ds is None:
         print 'Error: could not create output file {f}'.format(f=output)
         sys.exit(1)
-    out_ds.GetRasterBand(1).WriteArray(lc_map)
     out_ds.SetProjection(map_ds.GetProjection())
     out_ds.SetGeoTransform(map_ds.GetGeoTransform())
 
+    for row in xrange(0, rows, block_size):
+        nrow = min(block_size, rows - row)
+
+        # Read in number of observations for block into stack
+        nobs = nobs_ds.ReadAsArray(0, row, cols, nrow)
+        if nobs is None:
+            print 'Error: could not read #Obs rows {r}'.format(r=row)
+            sys.exit(1)
+        nobs = nobs.reshape(bands, nrow, cols)
+
+        # Band with the most observations
+        selected = select_band(nobs, ties=ties)
+        del(nobs)
+
+        # Read in land cover maps
+        maps = map_ds.ReadAsArray(0, row, cols, nrow)
+        if maps is None:
+            print 'Could not read in map rows {r}'.format(r=row)
+            sys.exit(1)
+        maps = maps.reshape(bands, nrow, cols)
+
+        # Create composite land cover map
+        r, c = np.ogrid[:nrow, :cols]
+        lc_map = maps[selected, r, c]
+
+        out_ds.GetRasterBand(1).WriteArray(lc_map, 0, row)
+        if mask_ds is not None:
+            mask_ds.GetRasterBand(1).WriteArray(selected + 1, 0, row)
+
+        if DEBUG:
+            print 'Mosaicked rows {r0}-{r1} of {t}'.format(
+                r0=row, r1=row + nrow, t=rows)
+
     # Close
     map_ds = None
+    nobs_ds = None
+    mask_ds = None
     out_ds = None
 
     if not QUIET:
@@ -189,7 +179,20 @@ def main():
         print 'Error: invalid file format - {0}'.format(out_format)
         sys.exit(1)
 
-    create_map(map_mosaic, nobs_mosaic, output, mask_fn, out_format)
+    # Tie breaking rule
+    ties = arguments['--ties']
+    if ties not in ('first', 'last'):
+        print 'Error: tie breaking rule must be "first" or "last"'
+        sys.exit(1)
+    # Block size
+    try:
+        block_size = int(arguments['--blocksize'])
+    except ValueError:
+        print 'Error: block size must be an integer'
+        sys.exit(1)
+
+    create_map(map_mosaic, nobs_mosaic, output, mask_fn, out_format,
+               ties=ties, block_size=block_size)
 
 if __name__ == '__main__':
     arguments = docopt(__doc__)
@@ -13,8 +13,15 @@ Options:
     --raster <filename>         Raster filename [default: sample.gtif]
     --rformat <format>          Raster file format [default: GTiff]
     --vector <filename>         Vector filename [default: sample.shp]
-    --vformat <format>          Vector file format [default: ESRI Shapefile]
+    --vformat <format>          Vector file format (e.g., GPKG, FlatGeobuf)
+                                    [default: ESRI Shapefile]
     --seed_val <seed_value>     Initial RNG seed value [default: None]
+    --blocksize <rows>          Rows of map read at once [default: 1024]
+    --users <accuracy>          Anticipated user's accuracy of each class for
+                                    Neyman allocation [default: 0.8]
+    --minimum <n>               Minimum sample count of each class for
+                                    "Good Practices" allocation [default: 50]
+    --design                    Print class areas and allocation and exit
     -v --verbose                Show verbose debugging messages
     -h --help                   Show help
 
@@ -24,10 +31,18 @@ Sample size (--size) "<n>" options:
 
 Allocation (--allocation) "<allocation>" options:
     proportional                Allocation proportional to area
-    good_practices              "Good Practices" allocation
+    good_practices              "Good Practices" allocation: a minimum
+                                    count of each class (--minimum), with the
+                                    rest allocated proportional to area
     equal                       Equal allocation across classes
+    neyman                      Neyman allocation from class areas and
+                                    anticipated user's accuracy (--users)
     <specified>                 Comma or space separated list of integers
 
+    Systematic samples without an allocation sample all classes with one
+    grid. With an allocation, each class is sampled by its own grid, spaced
+    to yield approximately the class sample count.
+
 Example:
 
     Output stratified random sample using specified allocation to a shapefile
@@ -44,6 +59,15 @@ Changelog:
     * 0.1.1 : 04/06/2018
         Fix bug with raster sample map generation due to float dtype on
         row/column indexers.
+    * 0.2.0 : 10/19/2026
+        Sample map one block at a time using reservoirs of pseudorandom pixel
+        keys so memory depends on sample size and samples are reproducible
+        with the same seed.
+    * 0.3.0 : 10/19/2026
+        Add proportional, equal, and Neyman allocation and systematic
+        sampling from one pass counting pixels of each class.
+    * 0.3.1 : 10/19/2026
+        Write vector output in bulk using vector/bulk_vector.py
 
 """
 from __future__ import print_function, division
@@ -62,10 +86,18 @@ except:
     import ogr
     import osr
 
-__version__ = '0.1.1'
+# Bulk vector writer is shared with vector/point2square.py
+try:
+    from bulk_vector import pixel_squares_wkb, write_features
+except ImportError:
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', 'vector'))
+    from bulk_vector import pixel_squares_wkb, write_features
+
+__version__ = '0.3.1'
 
 
-_allocation_methods = ['proportional', 'equal', 'good_practices']
+_allocation_methods = ['proportional', 'equal', 'neyman', 'good_practices']
 
 VERBOSE = False
 
@@ -90,64 +122,189 @@ def str2num(string):
     return v
 
 
-def random_stratified(image, classes, counts):
+def read_blocks(band, block_size=1024):
+    """ Yield blocks of rows from a raster band
+
+    Args:
+        band (gdal.Band): raster band
+        block_size (int): number of rows in each block
+
+    Yields:
+        tuple: first row of block and 2D np.ndarray block
+    """
+    for row in range(0, band.YSize, block_size):
+        nrow = min(block_size, band.YSize - row)
+        yield row, band.ReadAsArray(0, row, band.XSize, nrow)
+
+
+def class_counts(band, mask=None, block_size=1024, max_bins=2 ** 24):
+    """ Return sorted, unmasked classes within a map and the number of pixels
+    of each class, from one pass over blocks of the map
+
+    Integer maps are counted with ``np.bincount`` on values offset by the
+    block's minimum, falling back to ``np.unique`` for other maps or when
+    values span more than ``max_bins``.
+
+    Returns:
+        tuple: np.ndarray of classes and np.ndarray of pixel counts
+    """
+    totals = {}
+    for row, block in read_blocks(band, block_size):
+        values = block.ravel()
+        if values.size == 0:
+            continue
+        lo, hi = values.min(), values.max()
+        if values.dtype.kind in 'biu' and int(hi) - int(lo) < max_bins:
+            n = np.bincount(values.astype(np.int64) - int(lo))
+            uniq = np.flatnonzero(n)
+            counts = n[uniq]
+            uniq = uniq + int(lo)
+        else:
+            uniq, counts = np.unique(values, return_counts=True)
+        for u, n in zip(uniq.tolist(), counts.tolist()):
+            totals[u] = totals.get(u, 0) + n
+
+    classes = np.array(sorted(totals))
+    counts = np.array([totals[c] for c in classes], dtype=np.int64)
+    if mask is not None and classes.size:
+        keep = ~np.in1d(classes, mask)
+        classes, counts = classes[keep], counts[keep]
+    return classes, counts
+
+
+def pixel_keys(index, seed):
+    """ Return pseudorandom 64-bit sort keys for pixel indices
+
+    Keys come from the SplitMix64 hash of each pixel's index within the map
+    and the seed, so a pixel has the same key no matter which block it is
+    read in or in what order blocks are read.
+
+    Args:
+        index (np.ndarray): pixel indices (row * ncol + col)
+        seed (int): seed value
+
+    Returns:
+        np.ndarray: np.uint64 keys
+    """
+    with np.errstate(over='ignore'):
+        z = index.astype(np.uint64) + np.uint64(seed) * \
+            np.uint64(0x9E3779B97F4A7C15)
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+
+def reservoir_sample(band, classes, counts, seed, pooled=False,
+                     block_size=1024):
+    """
+    Return pixel strata, column, and row of a random sample of each class
+    without replacement, streaming the map one block at a time
+
+    Every pixel gets a pseudorandom key (see :func:`pixel_keys`) and the
+    pixels of each stratum with the smallest keys are kept in a reservoir,
+    which is a simple random sample of the stratum. Only pixels with keys
+    below a full reservoir's largest key are considered, and memory is
+    proportional to sample size.
+
+    Args:
+        band (gdal.Band): map raster band
+        classes (np.ndarray): sorted map classes to be sampled
+        counts (np.ndarray): sample count for each stratum
+        seed (int): seed value for pixel keys
+        pooled (bool): sample all classes as one stratum labeled 1
+        block_size (int): number of rows read at once
+
+    Return:
+        (strata, col, row, population): tuple of ndarrays, with the
+            population of each stratum
+    """
+    ncol = band.XSize
+    nstrata = 1 if pooled else classes.size
+    counts = np.asarray(counts, dtype=np.int64).reshape(nstrata)
+
+    res_keys = [np.zeros(0, dtype=np.uint64) for i in range(nstrata)]
+    res_index = [np.zeros(0, dtype=np.int64) for i in range(nstrata)]
+    threshold = np.full(nstrata, np.iinfo(np.uint64).max, dtype=np.uint64)
+    population = np.zeros(nstrata, dtype=np.int64)
+
+    for row, block in read_blocks(band, block_size):
+        flat = block.ravel()
+        # Stratum of each pixel in block
+        stratum = np.searchsorted(classes, flat)
+        stratum[stratum == classes.size] = 0
+        valid = np.flatnonzero(classes[stratum] == flat)
+        stratum = np.zeros(valid.size, dtype=np.intp) if pooled else \
+            stratum[valid]
+        population += np.bincount(stratum, minlength=nstrata)
+
+        index = valid.astype(np.int64) + row * ncol
+        keys = pixel_keys(index, seed)
+
+        # Only pixels that could displace a current sample
+        candidate = keys <= threshold[stratum]
+        index, keys, stratum = (index[candidate], keys[candidate],
+                                stratum[candidate])
+
+        for s in np.unique(stratum):
+            in_s = stratum == s
+            k = np.concatenate((res_keys[s], keys[in_s]))
+            i = np.concatenate((res_index[s], index[in_s]))
+            keep = np.lexsort((i, k))[:counts[s]]
+            res_keys[s], res_index[s] = k[keep], i[keep]
+            if res_keys[s].size == counts[s] and counts[s] > 0:
+                threshold[s] = res_keys[s][-1]
+
+    strata = np.concatenate([
+        np.repeat(1 if pooled else classes[s], res_index[s].size)
+        for s in range(nstrata)])
+    index = np.concatenate(res_index)
+
+    return (strata, index % ncol, index // ncol, population)
+
+
+def random_stratified(band, classes, counts, seed, block_size=1024):
     """
     Return pixel strata, row, column from within image from a random stratified
     sample of classes specified
 
     Args:
-        image (ndarray)         input map image
+        band (gdal.Band)        input map image band
         classes (ndarray)       map image classes to be sampled
         counts (ndarray)        map image class sample counts
+        seed (int)              seed value for random sample
+        block_size (int)        number of rows read at once
 
     Return:
         (strata, col, row)      tuple of ndarrays
     """
-    # Initialize outputs
-    strata = np.array([], dtype=np.int)
-    rows = np.array([], dtype=np.int)
-    cols = np.array([], dtype=np.int)
-
     logger.debug('Performing sampling')
 
-    for c, n in zip(classes, counts):
-        logger.debug('Sampling class {c}'.format(c=c))
+    strata, cols, rows, population = reservoir_sample(
+        band, classes, counts, seed, block_size=block_size)
 
-        # Find pixels containing class c
-        row, col = np.where(image == c)
-
-        # Check for sample size > population size
-        if n > col.size:
+    # Check for sample size > population size
+    for c, n, pop in zip(classes, counts, population):
+        if n > pop:
             logger.warning(
                 'Class {0} sample size larger than population'.format(c))
             logger.warning('Reducing sample count to size of population')
-
-            n = col.size
-
-        # Randomly sample x / y without replacement
-        # NOTE: np.random.choice new to 1.7.0...
-        # TODO: check requirement and provide replacement
-        samples = np.random.choice(col.size, n, replace=False)
-
-        logger.debug('    collected samples')
-
-        strata = np.append(strata, np.repeat(c, n))
-        rows = np.append(rows, row[samples])
-        cols = np.append(cols, col[samples])
+    logger.debug('    collected samples')
 
     return (strata, cols, rows)
 
 
-def random_simple(image, classes, count):
+def random_simple(band, classes, count, seed, block_size=1024):
     """
     Return pixel strata, row, column from within image from a simple random
     sample of classes specified. The strata returned will be all equal to 1
     because there are no strata in a non-stratified design.
 
     Args:
-        image (ndarray)         input map image
+        band (gdal.Band)        input map image band
         classes (ndarray)       map image classes to be sampled
         counts (ndarray)        map image class sample counts
+        seed (int)              seed value for random sample
+        block_size (int)        number of rows read at once
 
     Return:
         (strata, col, row)      tuple of ndarrays
@@ -165,62 +322,209 @@ def random_simple(image, classes, count):
 
     logger.debug('Performing sampling')
 
-    # Find all pixels in `image` in `classes` and store locations
-    rows, cols = np.where(np.in1d(image, classes).reshape(image.shape))
+    strata, cols, rows, population = reservoir_sample(
+        band, classes, [count], seed, pooled=True, block_size=block_size)
 
-    if count > cols.size:
+    if count > population[0]:
         logger.error('Sample size greater than population of all classes \
             included')
         logger.error('Sample count: {n}'.format(n=count))
-        logger.error('Population size: {n}'.format(n=cols.size))
+        logger.error('Population size: {n}'.format(n=population[0]))
         sys.exit(1)
 
-    # Sample some of these locations
-    sample = np.random.choice(cols.size, count, replace=False)
     logger.debug('    collected samples')
 
-    return (np.ones(count), cols[sample], rows[sample])
+    return (strata, cols, rows)
+
+
+def random_systematic(band, classes, counts, population, seed,
+                      block_size=1024):
+    """
+    Return pixel strata, row, column from within image from a systematic
+    sample with a random start of the classes specified
+
+    If one sample count is given, all classes are sampled by one grid as one
+    stratum labeled 1. Otherwise each class is sampled by its own grid, with
+    grid spacing from the class population and sample count. Sample counts
+    are approximate since grids are regular.
+
+    Args:
+        band (gdal.Band)        input map image band
+        classes (ndarray)       map image classes to be sampled
+        counts (ndarray)        sample count, or count for each class
+        population (ndarray)    population of each class
+        seed (int)              seed value for random start
+        block_size (int)        number of rows read at once
+
+    Return:
+        (strata, col, row)      tuple of ndarrays
+    """
+    counts = np.atleast_1d(np.asarray(counts, dtype=np.float64))
+    population = np.asarray(population, dtype=np.float64)
+    pooled = counts.size != classes.size
+    if pooled:
+        counts = counts[:1]
+        population = population.sum()[np.newaxis]
+
+    logger.debug('Performing sampling')
+
+    # Grid spacing (in pixels) yielding expected sample count of each stratum
+    with np.errstate(divide='ignore', invalid='ignore'):
+        spacing = np.sqrt(population / counts)
+    spacing = np.maximum(spacing, 1)
+    sampled = (counts > 0) & (population > 0)
+    offset = np.random.RandomState(seed).uniform(
+        size=(counts.size, 2)) * np.where(sampled, spacing, 0)[:, np.newaxis]
+
+    def grid(start, end, off, d):
+        k = np.arange(max(np.ceil((start - off) / d), 0),
+                      np.ceil((end - off) / d))
+        return np.floor(off + k * d).astype(np.int64)
+
+    strata, cols, rows = [], [], []
+    for row, block in read_blocks(band, block_size):
+        nrow, ncol = block.shape
+        for s in np.flatnonzero(sampled):
+            grid_rows = grid(row, row + nrow, offset[s, 0], spacing[s])
+            grid_cols = grid(0, ncol, offset[s, 1], spacing[s])
+            if grid_rows.size == 0 or grid_cols.size == 0:
+                continue
+
+            sub = block[grid_rows - row][:, grid_cols]
+            if pooled:
+                hit = np.in1d(sub, classes).reshape(sub.shape)
+            else:
+                hit = sub == classes[s]
+            r, c = np.nonzero(hit)
+
+            strata.append(np.repeat(1 if pooled else classes[s], r.size))
+            rows.append(grid_rows[r])
+            cols.append(grid_cols[c])
+
+    if not strata:
+        return (np.array([]), np.array([], dtype=np.int64),
+                np.array([], dtype=np.int64))
+    strata = np.concatenate(strata)
+    logger.debug('    collected {n} samples for target of {t}'.format(
+        n=strata.size, t=int(counts.sum())))
+
+    return (strata, np.concatenate(cols), np.concatenate(rows))
+
+
+def _round_allocation(size, weights):
+    """ Largest remainder rounding of allocation proportional to weights so
+    allocation sums to size
+    """
+    exact = size * weights / weights.sum()
+    counts = np.floor(exact).astype(np.int64)
+    remainder = size - counts.sum()
+    counts[np.argsort(counts - exact, kind='mergesort')[:remainder]] += 1
+    return counts
 
 
-def random_systematic(image, classes, counts):
-    """ """
-    raise NotImplementedError(
-        "Sorry - haven't added Systematic Sampling")
+def _good_practices(size, population, minimum):
+    """ Allocation proportional to population with a minimum in each stratum
+
+    Following Olofsson et al. (2014), strata whose proportional allocation
+    falls below ``minimum`` are given ``minimum`` samples and the rest of the
+    sample is allocated proportionally among the other strata, repeating
+    until no stratum falls below the minimum.
+    """
+    if minimum * population.size > size:
+        raise ValueError(
+            'Sample size {n} is too small for a minimum of {m} samples in '
+            'each of {k} classes'.format(n=size, m=minimum,
+                                         k=population.size))
+    fixed = np.zeros(population.size, dtype=np.bool_)
+    while True:
+        counts = np.full(population.size, minimum, dtype=np.int64)
+        free = ~fixed
+        counts[free] = _round_allocation(size - minimum * fixed.sum(),
+                                         population[free])
+        low = free & (counts < minimum)
+        if not low.any():
+            return counts
+        fixed |= low
+
+
+def allocate(method, size, population, users=0.8, minimum=50):
+    """
+    Return sample count for each stratum from an allocation method
+
+    Args:
+      method (str): Allocation method, either "proportional" to stratum
+        population, "equal" across strata, "neyman" optimal allocation for
+        estimating overall accuracy, or "good_practices" proportional
+        allocation with a minimum in each stratum
+      size (int): Total sample size
+      population (np.ndarray): Population (pixel count) of each stratum
+      users (float or np.ndarray, optional): Anticipated user's accuracy of
+        each stratum for Neyman allocation
+      minimum (int, optional): Minimum sample count of each stratum for
+        "good_practices" allocation
+
+    Returns:
+      np.ndarray: Sample count of each stratum, summing to `size`
+    """
+    population = np.asarray(population, dtype=np.float64)
+    if method == 'proportional':
+        weights = population
+    elif method == 'equal':
+        weights = np.ones_like(population)
+    elif method == 'neyman':
+        # Strata standard deviation for estimating proportion correct
+        users = np.broadcast_to(np.asarray(users, dtype=np.float64),
+                                population.shape)
+        weights = population * np.sqrt(users * (1 - users))
+    elif method == 'good_practices':
+        return _good_practices(size, population, minimum)
+    else:
+        raise NotImplementedError(
+            "Sorry - haven't added {m} allocation".format(m=method))
+
+    return _round_allocation(size, weights)
 
 
-def sample(image, method,
+def sample(band, method,
            size=None, allocation=None,
-           mask=None, order=False):
+           mask=None, order=False, seed=0, block_size=1024, users=0.8,
+           minimum=50, design=False):
     """
     Make sampling decisions and perform sampling
 
     Args:
-      image (np.ndarray): 1 dimensional array of the image
+      band (gdal.Band): Map raster band, read one block at a time
       method (str): Sampling method
       size (int, optional): Total sample size
       allocation (str, or list/np.ndarray): Allocation strategy specified as a
         string, or user specified allocation as list or np.ndarray
       mask (list or np.ndarray, optional): Values to exclude from `image`
       order (bool, optional): Order the output by strata, or not
+      seed (int, optional): Seed value for random sample
+      block_size (int, optional): Number of rows read at once
+      users (float or np.ndarray, optional): Anticipated user's accuracy of
+        each class for Neyman allocation
+      minimum (int, optional): Minimum sample count of each class for
+        "good_practices" allocation
+      design (bool, optional): Only determine allocation, returning
+        classes, class pixel counts, and sample counts instead of samples
 
     Returns:
         output (tuple): strata, row numbers, and column numbers
 
     """
-    # Find map classes within image
-    classes = np.sort(np.unique(image))
-
-    # Exclude masked values
-    classes = classes[~np.in1d(classes, mask)]
+    # Find map classes and their areas within image, excluding masked values
+    classes, population = class_counts(band, mask=mask,
+                                       block_size=block_size)
+    npix = band.XSize * band.YSize
 
     logger.debug('Found {n} classes'.format(n=classes.size))
-    for c in classes:
-        px = np.sum(image == c)
+    for c, px in zip(classes, population):
         logger.debug(
             '    class {c} - {pix}px ({pct}%)'.format(
                 c=c,
                 pix=px,
-                pct=np.round(float(px) / image.size * 100.0, decimals=2)))
+                pct=np.round(float(px) / npix * 100.0, decimals=2)))
 
     # Determine class counts from allocation type and total sample size
     if allocation is None:
@@ -230,8 +534,9 @@ def sample(image, method,
         if not isinstance(size, int):
             raise TypeError('Must specify sample size if allocation to '
                             'calculate allocation')
-        raise NotImplementedError(
-            "Sorry - haven't added any allocation types")
+        counts = allocate(allocation, size, population, users=users,
+                          minimum=minimum)
+        logger.debug('Allocation is {a}'.format(a=counts))
 
     # Or use specified allocation
     elif isinstance(allocation, list):
@@ -245,18 +550,26 @@ def sample(image, method,
             'Allocation must be a str for a method, or a list/np.ndarray')
 
     # Ensure we found allocation for each class if stratified random
-    if method == 'stratified':
+    if method == 'stratified' or (method == 'systematic' and
+                                  allocation is not None):
         if classes.size != counts.size:
             raise ValueError(
                 'Sample counts must be given for each unmasked class in map')
 
+    if design:
+        return (classes, population, counts)
+
     # Perform sample using desired method
     if method == 'stratified':
-        strata, cols, rows = random_stratified(image, classes, counts)
+        strata, cols, rows = random_stratified(band, classes, counts, seed,
+                                               block_size=block_size)
     elif method == 'random':
-        strata, cols, rows = random_simple(image, classes, counts)
+        strata, cols, rows = random_simple(band, classes, counts, seed,
+                                           block_size=block_size)
     elif method == 'systematic':
-        strata, cols, rows = random_systematic(image, classes, counts)
+        strata, cols, rows = random_systematic(band, classes, counts,
+                                               population, seed,
+                                               block_size=block_size)
 
     # Randomize samples if not ordered
     if order is not True:
@@ -271,15 +584,9 @@ def sample(image, method,
 
 
 def write_raster_output(strata, cols, rows, map_ds, output,
-                        gdal_frmt='GTiff', ndv=255):
+                        gdal_frmt='GTiff', ndv=255, block_size=1024):
     """
     """
-    # Init and fill output array with samples
-    raster = np.ones((map_ds.RasterYSize, map_ds.RasterXSize),
-                     dtype=np.uint8) * ndv
-
-    raster[rows, cols] = strata
-
     # Get output driver
     driver = gdal.GetDriverByName(gdal_frmt)
 
@@ -288,9 +595,19 @@ def write_raster_output(strata, cols, rows, map_ds, output,
                               map_ds.RasterXSize, map_ds.RasterYSize, 1,
                               gdal.GetDataTypeByName('Byte'))
 
-    # Write out band
-    sample_ds.GetRasterBand(1).SetNoDataValue(ndv)
-    sample_ds.GetRasterBand(1).WriteArray(raster)
+    # Write out band, filling blocks of rows with samples
+    band = sample_ds.GetRasterBand(1)
+    band.SetNoDataValue(ndv)
+    order = np.argsort(rows, kind='mergesort')
+    strata, cols, rows = strata[order], cols[order], rows[order]
+    for row in range(0, map_ds.RasterYSize, block_size):
+        nrow = min(block_size, map_ds.RasterYSize - row)
+        raster = np.full((nrow, map_ds.RasterXSize), ndv, dtype=np.uint8)
+
+        start, end = np.searchsorted(rows, [row, row + nrow])
+        raster[rows[start:end] - row, cols[start:end]] = strata[start:end]
+
+        band.WriteArray(raster, 0, row)
 
     # Port over metadata, projection, geotransform, etc
     sample_ds.SetProjection(map_ds.GetProjection())
@@ -302,14 +619,11 @@ def write_raster_output(strata, cols, rows, map_ds, output,
 
 
 def write_vector_output(strata, cols, rows, map_ds, output,
-                        ogr_frmt='ESRI Shapefile'):
+                        ogr_frmt='ESRI Shapefile', batch_size=10000):
     """
+    Write polygons outlining sampled pixels, building geometries for all
+    samples at once and writing them in batched transactions
     """
-    # Corners of pixel in pixel coordinates
-    corners = [(0, 0), (1, 0), (1, 1), (0, 1), (0, 0)]
-
-    # Raster geo-transform
-    gt = map_ds.GetGeoTransform()
     # Get OSR spatial reference from raster to give to OGR dataset
     map_sr = osr.SpatialReference()
     map_sr.ImportFromWkt(map_ds.GetProjectionRef())
@@ -329,30 +643,13 @@ def write_vector_output(strata, cols, rows, map_ds, output,
     # Strata field
     layer.CreateField(ogr.FieldDefn('STRATUM', ogr.OFTInteger))
 
-    # Loop through samples adding to layer
-    for i, (stratum, col, row) in enumerate(zip(strata, cols, rows)):
-        # Feature
-        feature = ogr.Feature(layer.GetLayerDefn())
-        feature.SetField('ID', int(i))
-        feature.SetField('ROW', int(row))
-        feature.SetField('COL', int(col))
-        feature.SetField('STRATUM', int(stratum))
-
-        # Geometry
-        ring = ogr.Geometry(type=ogr.wkbLinearRing)
-
-        for corner in corners:
-            ring.AddPoint(
-                gt[0] + (col + corner[0]) * gt[1] + (row + corner[1]) * gt[2],
-                gt[3] + (col + corner[1]) * gt[4] + (row + corner[1]) * gt[5])
-        square = ogr.Geometry(type=ogr.wkbPolygon)
-        square.AddGeometry(ring)
-
-        feature.SetGeometry(square)
-
-        layer.CreateFeature(feature)
-
-        feature.Destroy()
+    wkbs = pixel_squares_wkb(cols, rows, map_ds.GetGeoTransform())
+    write_features(layer, wkbs,
+                   fields=[('ID', np.arange(len(wkbs))),
+                           ('ROW', np.asarray(rows, dtype=np.int64)),
+                           ('COL', np.asarray(cols, dtype=np.int64)),
+                           ('STRATUM', np.asarray(strata, dtype=np.int64))],
+                   batch_size=batch_size)
 
     sample_ds = None
 
@@ -391,9 +688,9 @@ def main():
     # Test if allocation is built-in; if not then it needs to be list of ints
     allocation = args['--allocation']
     if allocation is None:
-        if method != 'random':
-            logger.error('Must specify allocation for designs other than\
-                simple random sampling')
+        if method == 'stratified':
+            logger.error('Must specify allocation for stratified random\
+                sampling')
             sys.exit(1)
     elif args['--allocation'] not in _allocation_methods:
         try:
@@ -414,9 +711,6 @@ def main():
                                                    s=size))
             sys.exit(1)
 
-    else:
-        raise NotImplementedError("Sorry - haven't added allocation methods")
-
     if allocation is not None:
         logger.debug('Allocation is {a}'.format(a=allocation))
 
@@ -438,6 +732,25 @@ def main():
             sys.exit(1)
     logger.debug('Mask values are {m}'.format(m=mask))
 
+    # Anticipated user's accuracy
+    try:
+        users = np.array([float(u) for u in
+                          args['--users'].replace(',', ' ').split(' ') if
+                          u != ''])
+    except:
+        logger.error("User's accuracy must be a sequence of numbers")
+        sys.exit(1)
+    if np.any((users <= 0) | (users >= 1)):
+        logger.error("User's accuracy must be between 0 and 1")
+        sys.exit(1)
+
+    # Minimum sample count of each class
+    try:
+        minimum = int(args['--minimum'])
+    except ValueError:
+        logger.error('Minimum sample count must be an integer')
+        sys.exit(1)
+
     # Should we order output by strata?
     order = args['--order']
 
@@ -458,6 +771,10 @@ def main():
     if output_vector.lower() == 'none':
         output_vector = None
 
+    # Only evaluating sample design
+    if args['--design']:
+        output_raster, output_vector = None, None
+
     # Output drivers
     gdal_frmt = args['--rformat']
     ogr_frmt = args['--vformat']
@@ -496,10 +813,18 @@ def main():
     gdal_driver = None
     ogr_driver = None
 
+    # Block size
+    try:
+        block_size = int(args['--blocksize'])
+    except:
+        logger.error('Block size must be an integer')
+        sys.exit(1)
+
     # Seed value
     seed = args['--seed_val']
     if seed.lower() == 'none':
-        seed = None
+        seed = np.random.randint(2 ** 31)
+        logger.debug('Using random seed {s}'.format(s=seed))
     else:
         try:
             seed = int(seed)
@@ -517,24 +842,45 @@ def main():
         logger.error('Could not open {f}'.format(f=image_fn))
         sys.exit(1)
 
-    image = image_ds.GetRasterBand(1).ReadAsArray()
-    logger.debug('Read in map image to be sampled')
-
-    # Do the sampling
-    strata, cols, rows = sample(image, method,
-                                size=size,
-                                allocation=allocation,
-                                mask=mask,
-                                order=order)
+    if args['--design']:
+        try:
+            classes, population, counts = sample(
+                image_ds.GetRasterBand(1), method, size=size,
+                allocation=allocation, mask=mask, users=users,
+                minimum=minimum, block_size=block_size, design=True)
+        except ValueError as e:
+            logger.error(str(e))
+            sys.exit(1)
+        counts = np.broadcast_to(counts, classes.shape) \
+            if allocation is not None else np.repeat('', classes.size)
+        print('class,pixels,proportion,sample')
+        for c, px, n in zip(classes, population, counts):
+            print('{c},{px},{p:.6f},{n}'.format(
+                c=c, px=px, p=px / population.sum(), n=n))
+        sys.exit(0)
+
+    # Do the sampling, reading map one block at a time
+    try:
+        strata, cols, rows = sample(image_ds.GetRasterBand(1), method,
+                                    size=size,
+                                    allocation=allocation,
+                                    mask=mask,
+                                    order=order,
+                                    seed=seed,
+                                    block_size=block_size,
+                                    users=users,
+                                    minimum=minimum)
+    except ValueError as e:
+        logger.error(str(e))
+        sys.exit(1)
     logger.debug('Finished collecting samples')
 
-    image = None
-
     # Write outputs
     if output_raster is not None:
         logger.debug('Writing raster output to {f}'.format(f=output_raster))
         write_raster_output(strata, cols, rows,
-                            image_ds, output_raster, gdal_frmt, ndv)
+                            image_ds, output_raster, gdal_frmt, ndv,
+                            block_size=block_size)
 
     if output_vector is not None:
         logger.debug('Writing vector output to {f}'.format(f=output_vector))
@@ -3,11 +3,11 @@
 """
 from __future__ import division, print_function
 import argparse
+import csv
 import logging
 import sys
 
 import numpy as np
-from scipy import ndimage, stats
 
 from osgeo import gdal, gdal_array, ogr, osr
 
@@ -23,11 +23,300 @@ logging.basicConfig(format='%(asctime)s.%(levelname)s: %(message)s',
                     datefmt='%H:%M:%S')
 logger = logging.getLogger(__name__)
 
-STATISTICS = ['mean', 'var', 'num', 'max', 'min', 'sum', 'mode']
+STATISTICS = ['mean', 'var', 'num', 'max', 'min', 'sum', 'mode', 'median']
+HISTOGRAM_STATISTICS = ['mode', 'median']
+
+
+def _merge_counts(seg, val, count):
+    """ Sum counts of identical (segment, value) pairs
+
+    Returns:
+        tuple: segment, value, and count arrays sorted by segment and value
+    """
+    order = np.lexsort((val, seg))
+    seg, val, count = seg[order], val[order], count[order]
+    if seg.size == 0:
+        return seg, val, count
+    new = np.ones(seg.size, dtype=np.bool_)
+    new[1:] = (seg[1:] != seg[:-1]) | (val[1:] != val[:-1])
+    idx = np.flatnonzero(new)
+    return seg[idx], val[idx], np.add.reduceat(count, idx)
+
+
+def _combine_m2(n_a, sum_a, m2_a, n_b, sum_b, m2_b):
+    """ Combine sums of squared deviations from the mean of two sets
+
+    Uses the parallel update of Chan et al. (1979) to add each block to the
+    running statistics, which avoids the cancellation of subtracting the
+    squared mean from the mean square.
+    """
+    n = n_a + n_b
+    with np.errstate(divide='ignore', invalid='ignore'):
+        delta = np.where(n_b > 0, sum_b / n_b, 0) - \
+            np.where(n_a > 0, sum_a / n_a, 0)
+        m2 = m2_a + m2_b + delta ** 2 * n_a * n_b / n
+    return np.where(n > 0, m2, 0)
+
+
+class SegmentStatistics(object):
+    """ Accumulate statistics for each segment of image bands block by block
+
+    Counts, sums, minimums and maximums are accumulated with ``np.bincount``
+    and ``reduceat`` over each block so every statistic for every band is
+    computed from one scan of the segment labels. Variance is accumulated as
+    sums of squared deviations from the mean of each block, combined across
+    blocks with the parallel update of Chan et al. Mode and median are
+    computed from sparse per-segment histograms of pixel values, kept as
+    sorted runs that are merged only when a run is at least half the size of
+    the run before it, and merged into one when a statistic is requested.
+
+    Args:
+        nbands (int): number of image bands
+        histogram (bool): keep histograms for mode and median
+    """
+    def __init__(self, nbands, histogram=False):
+        self.nbands = nbands
+        self.histogram = histogram
+        self.count = np.zeros(0, dtype=np.int64)
+        self.sum = np.zeros((nbands, 0), dtype=np.float64)
+        self.m2 = np.zeros((nbands, 0), dtype=np.float64)
+        self.min = np.zeros((nbands, 0), dtype=np.float64)
+        self.max = np.zeros((nbands, 0), dtype=np.float64)
+        self.runs = [[] for b in range(nbands)]
+
+    @property
+    def segments(self):
+        """ np.ndarray: labels of segments containing pixels
+        """
+        return np.flatnonzero(self.count)
+
+    def _grow(self, n):
+        """ Make room for segment labels up to ``n - 1``
+        """
+        size = self.count.size
+        if n <= size:
+            return
+        pad = n - size
+        self.count = np.concatenate((self.count, np.zeros(pad, np.int64)))
+
+        def _pad(arr, value):
+            fill = np.full((self.nbands, pad), value, dtype=arr.dtype)
+            return np.concatenate((arr, fill), axis=1)
+        self.sum = _pad(self.sum, 0)
+        self.m2 = _pad(self.m2, 0)
+        self.min = _pad(self.min, np.inf)
+        self.max = _pad(self.max, -np.inf)
+
+    def update(self, seg, img):
+        """ Add a block of pixels
+
+        Args:
+            seg (np.ndarray): 2D segment labels
+            img (np.ndarray): 3D (nbands x nrow x ncol) image block
+        """
+        seg = seg.ravel().astype(np.intp)
+        img = img.reshape(self.nbands, -1)
+        if seg.size == 0:
+            return
+        n = seg.max() + 1
+        self._grow(n)
+
+        count = np.bincount(seg, minlength=n)
+
+        # Sort once so min/max are reductions over contiguous segments
+        order = np.argsort(seg, kind='mergesort')
+        seg_sorted = seg[order]
+        starts = np.flatnonzero(np.concatenate(
+            ([True], seg_sorted[1:] != seg_sorted[:-1])))
+        labels = seg_sorted[starts]
+
+        for b in range(self.nbands):
+            values = img[b].astype(np.float64)
+            total = np.bincount(seg, weights=values, minlength=n)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mean = np.where(count > 0, total / count, 0)
+            m2 = np.bincount(seg, weights=(values - mean[seg]) ** 2,
+                             minlength=n)
+            self.m2[b, :n] = _combine_m2(self.count[:n], self.sum[b, :n],
+                                         self.m2[b, :n], count, total, m2)
+            self.sum[b, :n] += total
+
+            values_sorted = img[b][order]
+            self.min[b, labels] = np.minimum(
+                self.min[b, labels],
+                np.minimum.reduceat(values_sorted, starts))
+            self.max[b, labels] = np.maximum(
+                self.max[b, labels],
+                np.maximum.reduceat(values_sorted, starts))
+
+            if self.histogram:
+                # Only this block's pairs are sorted here
+                self._add_run(b, _merge_counts(
+                    seg, img[b], np.ones(seg.size, dtype=np.int64)))
+
+        self.count[:n] += count
+
+    def _add_run(self, b, run):
+        """ Add sorted histogram run, merging runs of similar size
+        """
+        runs = self.runs[b]
+        runs.append(run)
+        while len(runs) > 1 and runs[-2][0].size <= 2 * runs[-1][0].size:
+            last = runs.pop()
+            runs[-1] = _merge_counts(*[np.concatenate((mine, theirs))
+                                       for mine, theirs in
+                                       zip(runs[-1], last)])
+
+    def hist(self, b):
+        """ Return segment, value, and count of histogram of band ``b``
+        sorted by segment and value
+        """
+        runs = self.runs[b]
+        if not runs:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, np.zeros(0), empty
+        if len(runs) > 1:
+            runs[:] = [_merge_counts(*[np.concatenate(arrs)
+                                       for arrs in zip(*runs)])]
+        return runs[0]
+
+    def _hist_stat(self, stat):
+        """ Return mode or median of each segment from histograms
+        """
+        out = np.full((self.nbands, self.count.size), np.nan)
+        for b in range(self.nbands):
+            seg, val, count = self.hist(b)
+            if seg.size == 0:
+                continue
+            starts = np.flatnonzero(np.concatenate(
+                ([True], seg[1:] != seg[:-1])))
+            labels = seg[starts]
+            if stat == 'mode':
+                # Most frequent value, smallest value for ties
+                order = np.lexsort((val, -count, seg))
+                first = np.concatenate(([True], seg[order][1:] !=
+                                        seg[order][:-1]))
+                out[b, labels] = val[order][first]
+            elif stat == 'median':
+                cumcount = np.cumsum(count)
+                base = cumcount[starts] - count[starts]
+                n = self.count[labels]
+                lower = np.searchsorted(cumcount, base + (n - 1) // 2,
+                                        side='right')
+                upper = np.searchsorted(cumcount, base + n // 2,
+                                        side='right')
+                out[b, labels] = (val[lower].astype(np.float64) +
+                                  val[upper]) / 2.0
+        return out
+
+    def result(self, stat):
+        """ Return statistic for each segment label
+
+        Args:
+            stat (str): statistic to return
+
+        Returns:
+            np.ndarray: 1D array of counts for ``num``, otherwise 2D array
+                (nbands x nlabels) of statistic
+        """
+        if stat == 'num':
+            return self.count
+        if stat in HISTOGRAM_STATISTICS:
+            if not self.histogram:
+                raise ValueError('Histograms are required for {s}'.format(
+                    s=stat))
+            return self._hist_stat(stat)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if stat == 'mean':
+                return self.sum / self.count
+            elif stat == 'var':
+                return self.m2 / self.count
+        if stat == 'sum':
+            return self.sum
+        elif stat == 'min':
+            return self.min
+        elif stat == 'max':
+            return self.max
+        raise ValueError('Unknown statistic {s}'.format(s=stat))
+
+
+def write_table(filename, stats, stat_names, band_names):
+    """ Write per-segment statistics as CSV, or Parquet if ``filename``
+    ends with ".parquet"
+    """
+    segments = stats.segments
+    columns = [('segment', segments)]
+    for stat in stat_names:
+        if stat == 'num':
+            columns.append(('num', stats.result(stat)[segments]))
+            continue
+        result = stats.result(stat)
+        for i_b, band_name in enumerate(band_names):
+            columns.append(('{b}_{s}'.format(b=band_name, s=stat),
+                            result[i_b, segments]))
+
+    if filename.lower().endswith('.parquet'):
+        try:
+            import pandas as pd
+        except ImportError:
+            logger.error('Writing Parquet tables requires "pandas"')
+            sys.exit(1)
+        df = pd.DataFrame(dict(columns), columns=[c[0] for c in columns])
+        df.to_parquet(filename, index=False)
+    else:
+        with open(filename, 'w') as fid:
+            writer = csv.writer(fid)
+            writer.writerow([c[0] for c in columns])
+            writer.writerows(zip(*[c[1].tolist() for c in columns]))
+
+
+def rasterize_block(seg_ds, layer_name, img_ds, row, nrow, transform=None):
+    """ Rasterize FID of segments intersecting a block of rows of an image
+
+    Args:
+        seg_ds (ogr.DataSource): segmentation vector dataset
+        layer_name (str): name of segment layer within ``seg_ds``
+        img_ds (gdal.Dataset): image segments are rasterized to match
+        row (int): first row of block
+        nrow (int): number of rows in block
+        transform (osr.CoordinateTransformation): transformation from image
+            to segment coordinate system, if they differ
+
+    Returns:
+        np.ndarray: segment FID of each pixel in block
+    """
+    cols = img_ds.RasterXSize
+    gt = list(img_ds.GetGeoTransform())
+    gt[0] += row * gt[2]
+    gt[3] += row * gt[5]
+
+    # Spatial filter from block footprint
+    corners = [(gt[0] + c * gt[1] + r * gt[2], gt[3] + c * gt[4] + r * gt[5])
+               for c, r in ((0, 0), (cols, 0), (cols, nrow), (0, nrow))]
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for x, y in corners + corners[:1]:
+        ring.AddPoint(x, y)
+    footprint = ogr.Geometry(ogr.wkbPolygon)
+    footprint.AddGeometry(ring)
+    if transform is not None:
+        footprint.Transform(transform)
 
+    mem_raster = gdal.GetDriverByName('MEM').Create(
+        '', cols, nrow, 1, gdal.GDT_UInt32)
+    mem_raster.SetProjection(img_ds.GetProjection())
+    mem_raster.SetGeoTransform(gt)
 
-def scipy_mode(arr):
-    return stats.mode(arr, axis=None)[0]
+    # Create artificial 'FID' field
+    fid_layer = seg_ds.ExecuteSQL(
+        'select FID, * from "{l}"'.format(l=layer_name),
+        spatialFilter=footprint)
+    gdal.RasterizeLayer(mem_raster, [1], fid_layer, options=['ATTRIBUTE=FID'])
+    seg_ds.ReleaseResultSet(fid_layer)
+
+    seg = mem_raster.GetRasterBand(1).ReadAsArray()
+    mem_raster = None
+    return seg
 
 
 def objstats(args):
@@ -51,107 +340,86 @@ def objstats(args):
     if args.bands is not None:
         bands = args.bands
 
-    # Rasterize segments
-    logger.debug('About to rasterize segment vector file')
+    # Segments are rasterized for each block of rows using only features
+    # within the block, so memory is bounded by block size
     img_srs = osr.SpatialReference()
     img_srs.ImportFromWkt(img_ds.GetProjectionRef())
-
-    mem_raster = gdal.GetDriverByName('MEM').Create(
-        '', cols, rows, 1, gdal.GDT_UInt32)
-    mem_raster.SetProjection(img_ds.GetProjection())
-    mem_raster.SetGeoTransform(img_ds.GetGeoTransform())
-
-    # Create artificial 'FID' field
-    fid_layer = seg_ds.ExecuteSQL(
-        'select FID, * from "{l}"'.format(l=seg_layer.GetName()))
-    gdal.RasterizeLayer(mem_raster, [1], fid_layer, options=['ATTRIBUTE=FID'])
-    logger.debug('Rasterized segment vector file')
-
-    seg = mem_raster.GetRasterBand(1).ReadAsArray()
-    logger.debug('Read segmentation image into memory')
-    mem_raster = None
-    seg_ds = None
-
-    # Get list of unique segments
-    useg = np.unique(seg)
-
-    # If calc is num, do only for 1 band
-    out_bands = 0
-    for stat in args.stat:
-        if stat == 'num':
-            out_bands += 1
-        else:
-            out_bands += len(bands)
+    seg_srs = seg_layer.GetSpatialRef()
+    transform = None
+    if seg_srs is not None and img_srs.ExportToWkt() and \
+            not img_srs.IsSame(seg_srs):
+        transform = osr.CoordinateTransformation(img_srs, seg_srs)
+
+    img_bands = [img_ds.GetRasterBand(b) for b in bands]
+    band_names = [img_band.GetDescription() or 'Band {i}'.format(i=b)
+                  for b, img_band in zip(bands, img_bands)]
+    ndvs = [img_band.GetNoDataValue() for img_band in img_bands]
+    dtype = np.result_type(*[
+        gdal_array.GDALTypeCodeToNumericTypeCode(img_band.DataType)
+        for img_band in img_bands])
+
+    def read_block(row, nrow):
+        seg = rasterize_block(seg_ds, seg_layer.GetName(), img_ds,
+                              row, nrow, transform=transform)
+        img = np.empty((len(img_bands), nrow, cols), dtype=dtype)
+        for i_b, img_band in enumerate(img_bands):
+            img[i_b] = img_band.ReadAsArray(0, row, cols, nrow)
+        return seg, img
+
+    # Accumulate all statistics for all bands in one pass over blocks
+    stats = SegmentStatistics(
+        len(img_bands),
+        histogram=any([s in HISTOGRAM_STATISTICS for s in args.stat]))
+    for row in range(0, rows, args.blocksize):
+        nrow = min(args.blocksize, rows - row)
+        logger.debug('Calculating statistics for rows {r0}-{r1}'.format(
+            r0=row, r1=row + nrow))
+        stats.update(*read_block(row, nrow))
+
+    if args.table:
+        write_table(args.output, stats, args.stat, band_names)
+        img_ds = None
+        seg_ds = None
+        logger.info('Completed object statistic calculation')
+        return
+
+    # Output band for each stat and band, with "num" calculated once
+    outputs = []
+    for i_b in range(len(img_bands)):
+        for stat in args.stat:
+            if stat == 'num':
+                if i_b == 0:
+                    outputs.append((i_b, stat, stats.result(stat)))
+            else:
+                outputs.append((i_b, stat, stats.result(stat)[i_b]))
 
     # Create output driver
     driver = gdal.GetDriverByName(args.format)
-    out_ds = driver.Create(args.output, cols, rows, out_bands,
+    out_ds = driver.Create(args.output, cols, rows, len(outputs),
                            gdal.GDT_Float32)
+    out_ds.SetGeoTransform(img_ds.GetGeoTransform())
+    out_ds.SetProjection(img_ds.GetProjection())
 
-    # Loop through image bands
-    out_b = 0
-    out_2d = np.empty_like(seg, dtype=np.float32)
-    for i_b, b in enumerate(bands):
-        img_band = img_ds.GetRasterBand(b)
-        ndv = img_band.GetNoDataValue()
-        band_name = img_band.GetDescription()
-        if not band_name:
-            band_name = 'Band {i}'.format(i=b)
-        logger.info('Processing input band {i}, "{b}"'.format(
-            i=b, b=band_name))
-
-        img = img_band.ReadAsArray().astype(
-            gdal_array.GDALTypeCodeToNumericTypeCode(img_band.DataType))
-        logger.debug('Read image band {i}, "{b}" into memory'.format(
-            i=b, b=band_name))
+    for out_b, (i_b, stat, out) in enumerate(outputs):
+        out_band = out_ds.GetRasterBand(out_b + 1)
+        out_band.SetDescription(band_names[i_b])
+        if ndvs[i_b] is not None:
+            out_band.SetNoDataValue(ndvs[i_b])
 
-        for stat in args.stat:
-            logger.debug('    calculating {s}'.format(s=stat))
-            if stat == 'mean':
-                out = ndimage.mean(img, seg, useg)
-            elif stat == 'var':
-                out = ndimage.variance(img, seg, useg)
-            elif stat == 'num':
-                # Remove from list of stats so it is only calculated once
-                args.stat.remove('num')
-                count = np.ones_like(seg)
-                out = ndimage.sum(count, seg, useg)
-            elif stat == 'sum':
-                out = ndimage.sum(img, seg, useg)
-            elif stat == 'min':
-                out = ndimage.minimum(img, seg, useg)
-            elif stat == 'max':
-                out = ndimage.maximum(img, seg, useg)
-            elif stat == 'mode':
-                out = ndimage.labeled_comprehension(img, seg, useg,
-                                                    scipy_mode,
-                                                    out_2d.dtype, ndv)
-            else:
-                logger.error('Unknown stat. Not sure how you got here')
-                sys.exit(1)
-
-            # Transform to 2D
-            out_2d = out[seg - seg.min()]
+    # Paint statistics for segment of each pixel
+    for row in range(0, rows, args.blocksize):
+        nrow = min(args.blocksize, rows - row)
+        seg, img = read_block(row, nrow)
+        for out_b, (i_b, stat, out) in enumerate(outputs):
+            out_2d = out[seg].astype(np.float32)
 
             # Fill in NDV
-            if ndv is not None:
-                out_2d[np.where(img == ndv)] = ndv
-
-            # Write out the data
-            out_band = out_ds.GetRasterBand(out_b + 1)
-            out_band.SetDescription(band_name)
-            if ndv is not None:
-                out_band.SetNoDataValue(ndv)
-            logger.debug('    Writing object statistic for band {b}'.format(
-                    b=b + 1))
-            out_band.WriteArray(out_2d, 0, 0)
-            out_band.FlushCache()
-            logger.debug('    Wrote out object statistic for band {b}'.format(
-                    b=b + 1))
-            out_b += 1
+            if ndvs[i_b] is not None:
+                out_2d[img[i_b] == ndvs[i_b]] = ndvs[i_b]
 
-    out_ds.SetGeoTransform(img_ds.GetGeoTransform())
-    out_ds.SetProjection(img_ds.GetProjection())
+            out_ds.GetRasterBand(out_b + 1).WriteArray(out_2d, 0, row)
+        logger.debug('Wrote object statistics for rows {r0}-{r1}'.format(
+            r0=row, r1=row + nrow))
 
     img_ds = None
     seg_ds = None
@@ -169,6 +437,14 @@ def main():
     parser.add_argument('-b', '--bands', dest='bands', default=None,
                         type=int, nargs='*',
                         help='Bands within input image to process')
+    parser.add_argument('--blocksize', dest='blocksize', default=256,
+                        type=int,
+                        help='Number of rows processed at once '
+                             '(default 256)')
+    parser.add_argument('--table', action='store_true',
+                        help='Write table of statistics for each segment '
+                             'instead of raster (CSV, or Parquet if output '
+                             'ends with ".parquet")')
     parser.add_argument('--version', action='version',
                         version='%(prog)s v{v}'.format(v=__version__))
     parser.add_argument('--verbose', '-v', help="increase output verbosity",
@@ -178,7 +454,7 @@ def main():
     parser.add_argument('segment', action='store', type=str,
                         help='input segment raster file')
     parser.add_argument('output', action='store', type=str,
-                        help='output raster file')
+                        help='output raster or table file')
     parser.add_argument('stat', nargs='*', action='store',
                         help='statistic to calculate ({c})'.format(
                             c=', '.join(STATISTICS)))
@@ -188,7 +464,9 @@ def main():
     if args.verbose:
         logger.setLevel(logging.DEBUG)
 
-    if not all([stat in STATISTICS for stat in STATISTICS]):
+    if not args.stat:
+        args.stat = ['mean']
+    if not all([stat in STATISTICS for stat in args.stat]):
         logger.error('Statistic {s} is incorrect or not available.'.format(
             s=args.stat))
         parser.print_help()
@@ -6,8 +6,9 @@
 # * Purpose:    To read an image using GDAL and calculate moving window 
 # *             statistics
 # * Methods:    Use GDAL (gdal.org) to read the image and import as numpy array.
-# *             Next, use scipy's ndimage functions to calculate statistic and 
-# *             output result as single band image.
+# *             Next, use summed-area tables (or scipy's ndimage functions)
+# *             to calculate statistics for blocks of rows and output result
+# *             with one band per input band, statistic, and window size.
 # *
 # *****************************************************************************\
 
@@ -27,16 +28,16 @@ except ImportError:
     from gdalnumeric import *
 
 
+STATS = ['mean', 'var', 'contrast', 'sobel', 'min', 'max', 'percentile']
+
+
 def do_it(args):
 
     ### Set up
-    window = args.window    
-    # Setup window sizes
-    maskX = (window - 1) / 2
-    maskX = range(-1 * maskX, maskX + 1)
-    maskY = (window - 1) / 2
-    maskY = range(-1 * maskY, maskY + 1)
-    
+    # Compute every statistic for every window size from the same block
+    jobs = [(stat, window) for stat in args.stat for window in args.window]
+    halo = max([stat_halo(stat, window) for stat, window in jobs])
+
     # Register all drivers
     gdal.AllRegister()
     
@@ -52,45 +53,81 @@ def do_it(args):
     cols = inDs.RasterXSize
     rows = inDs.RasterYSize
     bands = inDs.RasterCount
-    
-    xBlockSize = inDs.GetRasterBand(1).GetBlockSize()[0]
-    yBlockSize = inDs.GetRasterBand(1).GetBlockSize()[1]
-    
-    nXBlocks = (int)((cols + xBlockSize - 1) / (xBlockSize))
-    nXBlocks = (int)((rows + yBlockSize - 1) / (yBlockSize))
+
+    blockSize = args.blocksize
+    if blockSize <= 0:
+        blockSize = rows
     
     # Initialize output dataset
     driver = gdal.GetDriverByName(args.format)
-    outDs = driver.Create(args.output, cols, rows, bands, gdal.GDT_Float32)
+    outDs = driver.Create(args.output, cols, rows, bands * len(jobs),
+                          gdal.GDT_Float32)
     if outDs is None:
         print 'Could not write to ' + args.output
         sys.exit(1)
     
-    # Read in data
-    inData = zeros([rows, cols])
     for b in range(bands):
         inBand = inDs.GetRasterBand(b + 1)
         NoData = inBand.GetNoDataValue()
         
         if NoData is None:
             NoData = -9999
-        inData[:,:] = inBand.ReadAsArray(0, 0, cols, rows).astype(float)
-        
-        # Process statistic
-        if args.stat == 'mean':
-            outData = moving_mean(inData, window)
-        elif args.stat == 'var':
-            outData = moving_var(inData, window)
-        elif args.stat == 'contrast':
-            outData = moving_contrast(inData, window)
-        elif args.stat == 'sobel':
-            outData = sobel_mean(inData, window)
-
-        # Write out data
-        outBand = outDs.GetRasterBand(b+1)
-        outBand.SetNoDataValue(NoData)
-        outBand.WriteArray(outData, 0, 0)
-        outBand.FlushCache()
+
+        outBands = []
+        for i, (stat, window) in enumerate(jobs):
+            outBand = outDs.GetRasterBand(b * len(jobs) + i + 1)
+            outBand.SetNoDataValue(NoData)
+            outBand.SetDescription('Band {b} {s} {w}x{w}'.format(
+                b=b + 1, s=stat, w=window))
+            outBands.append(outBand)
+
+        sobelMax = 0.0
+        for start in range(0, rows, blockSize):
+            end = min(start + blockSize, rows)
+            # Read block and neighboring rows, reflecting at image edges
+            readStart = max(start - halo, 0)
+            readEnd = min(end + halo, rows)
+            inData = inBand.ReadAsArray(0, readStart, cols,
+                                        readEnd - readStart)
+            inData = numpy.pad(inData.astype(numpy.float32),
+                               ((halo - (start - readStart),
+                                 halo - (readEnd - end)),
+                                (halo, halo)),
+                               mode='symmetric')
+            # Integral image shared by all windows
+            sat = summed_area_table(inData)
+
+            # Process statistic
+            for (stat, window), outBand in zip(jobs, outBands):
+                if stat == 'mean':
+                    outData = moving_mean(inData, window, halo, sat=sat)
+                elif stat == 'var':
+                    outData = moving_var(inData, window, halo)
+                elif stat == 'contrast':
+                    outData = moving_contrast(inData, window, halo, sat=sat)
+                elif stat == 'sobel':
+                    outData, magMax = sobel_magnitude_mean(inData, window,
+                                                           halo)
+                    sobelMax = max(sobelMax, magMax)
+                elif stat == 'min':
+                    outData = moving_min(inData, window, halo)
+                elif stat == 'max':
+                    outData = moving_max(inData, window, halo)
+                elif stat == 'percentile':
+                    outData = moving_percentile(inData, window,
+                                                args.percentile, halo)
+
+                # Write out data
+                outBand.WriteArray(outData, 0, start)
+
+        # Sobel magnitude is normalized by maximum over entire band
+        if sobelMax > 0:
+            for (stat, window), outBand in zip(jobs, outBands):
+                if stat == 'sobel':
+                    rescale_band(outBand, 255.0 / sobelMax, blockSize)
+
+        for outBand in outBands:
+            outBand.FlushCache()
         
     outDs.SetGeoTransform(inDs.GetGeoTransform())
     outDs.SetProjection(inDs.GetProjection())
@@ -101,63 +138,212 @@ def do_it(args):
     print 'Results written to ' + args.output
 
 
-def moving_mean(Ic, window):
-    # Init output image
-    Im = empty(Ic.shape, dtype='Float32')
-    # Uniform filter -> mean
-    scipy.ndimage.filters.uniform_filter(Ic, window, output=Im)
-    
-    return Im
+def rescale_band(band, scale, blockSize):
+    """
+    Multiplies raster band by scale, one block of rows at a time
+    """
+    for start in range(0, band.YSize, blockSize):
+        nrow = min(blockSize, band.YSize - start)
+        data = band.ReadAsArray(0, start, band.XSize, nrow)
+        data *= scale
+        band.WriteArray(data, 0, start)
+
+
+def window_extent(window):
+    """
+    Returns number of pixels before and after center pixel within window,
+    using the same origin as scipy.ndimage filters for even window sizes
+    """
+    before = window // 2
+    return before, window - 1 - before
+
+
+def stat_halo(stat, window):
+    """
+    Returns number of neighboring pixels needed around image to compute
+    moving window statistic
+    """
+    if stat == 'var':
+        # Variance around moving mean needs moving mean of neighbors
+        return 2 * (window // 2)
+    elif stat == 'sobel':
+        # Sobel operator needs one more pixel
+        return window // 2 + 1
+    return window // 2
 
 
-def moving_var(Ic, window):
-    # Init output image
-    Im = numpy.empty(Ic.shape, dtype='Float32')
-    scipy.ndimage.filters.uniform_filter(Ic, window, output=Im)
+def fit_image(Ic, pad, halo):
+    """
+    Returns image padded by exactly halo pixels on each side, given image
+    already padded by pad pixels. Missing padding is reflected.
+    """
+    if pad > halo:
+        return crop_image(Ic, pad - halo)
+    elif pad < halo:
+        return numpy.pad(Ic, halo - pad, mode='symmetric')
+    return Ic
+
+
+def crop_image(Ic, pad):
+    """
+    Returns image without pad pixels on each side
+    """
+    if pad == 0:
+        return Ic
+    return Ic[pad:-pad, pad:-pad]
+
+
+def summed_area_table(Ic):
+    """
+    Returns summed-area table (integral image) of image
+
+    Table has a leading row and column of zeros so the sum of Ic[y0:y1, x0:x1]
+    is sat[y1, x1] - sat[y0, x1] - sat[y1, x0] + sat[y0, x0]. Sums are kept
+    as 64-bit floats to limit cancellation error.
+    """
+    sat = numpy.zeros((Ic.shape[0] + 1, Ic.shape[1] + 1),
+                      dtype=numpy.float64)
+    numpy.cumsum(Ic, axis=0, dtype=numpy.float64, out=sat[1:, 1:])
+    numpy.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+    return sat
+
+
+def window_sum(sat, window, pad):
+    """
+    Returns moving window sum from summed-area table of image padded by pad
+    pixels on each side. Cost per pixel does not depend on window size.
+    """
+    before, after = window_extent(window)
+    nrow = sat.shape[0] - 1 - 2 * pad
+    ncol = sat.shape[1] - 1 - 2 * pad
+    y0 = pad - before
+    y1 = pad + after + 1
+
+    Is = sat[y1:y1 + nrow, y1:y1 + ncol].copy()
+    Is -= sat[y0:y0 + nrow, y1:y1 + ncol]
+    Is -= sat[y1:y1 + nrow, y0:y0 + ncol]
+    Is += sat[y0:y0 + nrow, y0:y0 + ncol]
+    return Is
+
+
+def moving_mean(Ic, window, pad=0, sat=None):
+    """
+    Returns moving window mean of image padded by pad pixels on each side
+
+    Summed-area table of the padded image may be given as sat to share it
+    between window sizes.
+    """
+    halo = stat_halo('mean', window)
+    if pad < halo:
+        Ic = fit_image(Ic, pad, halo)
+        pad, sat = halo, None
+    if sat is None:
+        sat = summed_area_table(Ic)
+
+    Im = window_sum(sat, window, pad)
+    Im /= window * window
+
+    return Im.astype(numpy.float32)
+
+
+def moving_var(Ic, window, pad=0):
+    """
+    Returns moving window mean of squared differences from the moving mean
+    of image padded by pad pixels on each side
+    """
+    radius = window // 2
+    Ic = fit_image(Ic, pad, stat_halo('var', window))
+    # Moving mean within window of every output pixel
+    Im = moving_mean(Ic, window, radius)
     # Subtracting mean
-    Im *= -1 
-    Im += Ic
+    Im -= crop_image(Ic, radius)
     # Squaring difference
     Im **= 2
     # Summing and dividing differences by pix in window
-    scipy.ndimage.filters.uniform_filter(Im, window, output=Im)
-    return Im
+    return moving_mean(Im, window, radius)
 
 
-def moving_contrast(Ic, window):
-    # Init output image
-    Im = empty(Ic.shape, dtype='Float32')
-    # Set up contrast kernel
-    center = window * window - 1
-    k = ones([window, window]) * -1
-    k[(window - 1) / 2, (window - 1) / 2] = center
-    # Filter the image
-    Im = scipy.ndimage.convolve(Ic, k, mode='reflect')
+def moving_contrast(Ic, window, pad=0, sat=None):
+    """
+    Returns difference between center pixel and sum of its neighbors within
+    moving window, i.e., convolution with a kernel of -1 and a center of
+    window * window - 1, of image padded by pad pixels on each side
+    """
+    halo = stat_halo('contrast', window)
+    if pad < halo:
+        Ic = fit_image(Ic, pad, halo)
+        pad, sat = halo, None
+    if sat is None:
+        sat = summed_area_table(Ic)
 
-    return Im
+    Im = crop_image(Ic, pad) * numpy.float64(window * window)
+    Im -= window_sum(sat, window, pad)
 
+    return Im.astype(numpy.float32)
 
-def sobel_mean(Ic, window):
+
+def moving_min(Ic, window, pad=0):
     """
-    Returns mean filtered sobel gradient magnitude of input image
+    Returns moving window minimum of image padded by pad pixels on each side
+
+    Separable filters of scipy.ndimage have cost per pixel independent of
+    window size.
     """
+    halo = stat_halo('min', window)
+    Ic = fit_image(Ic, pad, halo)
+    return crop_image(scipy.ndimage.minimum_filter(Ic, size=window), halo)
+
+
+def moving_max(Ic, window, pad=0):
+    """
+    Returns moving window maximum of image padded by pad pixels on each side
+    """
+    halo = stat_halo('max', window)
+    Ic = fit_image(Ic, pad, halo)
+    return crop_image(scipy.ndimage.maximum_filter(Ic, size=window), halo)
+
+
+def moving_percentile(Ic, window, percentile, pad=0):
+    """
+    Returns moving window percentile of image padded by pad pixels on each
+    side. Unlike other statistics, cost grows with the window size.
+    """
+    halo = stat_halo('percentile', window)
+    Ic = fit_image(Ic, pad, halo)
+    return crop_image(scipy.ndimage.percentile_filter(Ic, percentile,
+                                                      size=window), halo)
+
+
+def sobel_magnitude_mean(Ic, window, pad=0):
+    """
+    Returns moving window mean of sobel gradient magnitude of image padded by
+    pad pixels on each side, and the maximum magnitude within image
+    """
+    radius = window // 2
+    Ic = fit_image(Ic, pad, stat_halo('sobel', window))
     # Get directional components
     dx = scipy.ndimage.sobel(Ic, 0)
     dy = scipy.ndimage.sobel(Ic, 1)
     # Get magnitude
-    mag = numpy.hypot(dx, dy)
+    mag = crop_image(numpy.hypot(dx, dy), 1)
     # Clear memory
     del dx
     del dy
+
+    return moving_mean(mag, window, radius), crop_image(mag, radius).max()
+
+
+def sobel_mean(Ic, window):
+    """
+    Returns mean filtered sobel gradient magnitude of input image
+    """
+    Im, mag_max = sobel_magnitude_mean(Ic, window)
     # Normalize
-    mag *= 255.0 / numpy.max(mag)
+    Im *= 255.0 / mag_max
     ### TODO: re-impliment or delete Gaussian filter part
-    # apply Gaussian filter
-    # scipy.ndimage.filters.gaussian_filter(mag, sigma, output=Ic)
     ### Using mean filter instead of gaussian
-    Ic = moving_mean(mag, window)
 
-    return Ic
+    return Im
 
 
 # Main program
@@ -168,19 +354,27 @@ def main():
     For a 3x3 window image mean:
     window_stats.py -w 3 -s mean input.tif output.tif\n
     For a 5x5 window image variance:
-    window_stats.py -w 5 -s var input.tif output.tif
+    window_stats.py -w 5 -s var input.tif output.tif\n
+    For 31x31 and 61x61 window image mean and maximum:
+    window_stats.py -w 31 -w 61 -s mean -s max input.tif output.tif
     """
     parser = argparse.ArgumentParser(prog='window_stats.py', 
         description=desc, 
         epilog=example,
         formatter_class=RawTextHelpFormatter)
 
-    parser.add_argument('-w', action='store', dest='window', type=int,
-        help='size of moving window', 
-        default=3)
-    parser.add_argument('-s', action='store', dest='stat', type=str,
-        help='statistic to calculate (mean, var, contrast, sobel)',
-        default='mean')
+    parser.add_argument('-w', action='append', dest='window', type=int,
+        help='size of moving window, may be repeated (default 3)')
+    parser.add_argument('-s', action='append', dest='stat', type=str,
+        help='statistic to calculate, may be repeated (%s)' % 
+             ', '.join(STATS))
+    parser.add_argument('-q', action='store', dest='percentile', type=float,
+        help='percentile for "percentile" statistic (default 50)',
+        default=50)
+    parser.add_argument('-b', action='store', dest='blocksize', type=int,
+        help='number of rows read per block, or 0 for entire image '
+             '(default 512)',
+        default=512)
     
     parser.add_argument('--f', dest='format', default='GTiff',
         help='GDAL format for output file (default "GTiff")')
@@ -191,14 +385,18 @@ def main():
         help='output raster file')
 
     args = parser.parse_args()
+    if args.window is None:
+        args.window = [3]
+    if args.stat is None:
+        args.stat = ['mean']
 
-    possible = ['mean', 'var', 'contrast', 'sobel']
-    if (args.stat in possible) is False:
+    if any([stat not in STATS for stat in args.stat]):
         print 'Error: statistic incorrect or not available.'
         print parser.print_help()
         sys.exit(1)
     # Check if window is odd number (for non-sobel)
-    elif (args.window % 2 == 0 and args.stat != 'sobel') is True:
+    elif any([window % 2 == 0 and stat != 'sobel'
+              for stat in args.stat for window in args.window]):
         print 'Error: window size must be odd integer value'
         print parser.print_help()
         sys.exit(1)
@@ -6,15 +6,32 @@ Usage:
 
 Options:
     --pattern <pattern>     Result file pattern [default: record_*.mat]
+    --header                Only check MATLAB file headers and sizes
+    --cache <file>          Skip files unchanged since checked OK in cache
+    --report <file>         Write JSON report of corrupt and missing rows
+    --nrow <nrow>           Number of rows expected to have results
+    -p --ncpu <n>           Number of processes [default: 1]
     -v --verbose            Show check for all files
     -h --help               Show help
 
+The header check reads the 128 byte header of each (version 5) MATLAB file
+and the tag of each variable in it, and fails files whose variables do not
+exactly fill the file, such as those truncated while being written, without
+decompressing or decoding the variables.
+
+Rows are numbered by the last number in the file name (e.g., 100 for
+"record_change100.mat") to find rows missing results.
+
 """
 from __future__ import print_function
 
 import fnmatch
+import json
 import logging
+import multiprocessing
 import os
+import re
+import struct
 import sys
 
 from docopt import docopt
@@ -25,12 +42,125 @@ logging.basicConfig(format='%(asctime)s %(module)s %(levelname)s: %(message)s',
                     datefmt='%H:%M:%S')
 logger = logging.getLogger(__name__)
 
-def check_results(location, pattern='record_*.mat'):
+# MATLAB level 5 MAT-file data types of variables
+_miMATRIX = 14
+_miCOMPRESSED = 15
+
+
+def check_header(filename):
+    """ Check MATLAB file header and sizes of variables without decoding
+
+    Args:
+      filename (str): MATLAB file
+
+    Returns:
+      str: description of error, or None if file looks OK
+
+    """
+    size = os.path.getsize(filename)
+    with open(filename, 'rb') as f:
+        header = f.read(128)
+        if len(header) < 128:
+            return 'truncated header'
+        if header[:10] != b'MATLAB 5.0':
+            return 'not a version 5 MAT-file: {h}'.format(
+                h=header[:19].decode('ascii', 'replace'))
+        endian = header[126:128]
+        if endian == b'IM':
+            fmt = '<II'
+        elif endian == b'MI':
+            fmt = '>II'
+        else:
+            return 'unknown byte order'
+
+        pos = 128
+        nvar = 0
+        while pos < size:
+            f.seek(pos)
+            tag = f.read(8)
+            if len(tag) < 8:
+                return 'truncated variable tag at byte {p}'.format(p=pos)
+            mdtype, nbytes = struct.unpack(fmt, tag)
+            if mdtype not in (_miMATRIX, _miCOMPRESSED):
+                return 'unknown variable type {t} at byte {p}'.format(
+                    t=mdtype, p=pos)
+            pos += 8 + nbytes
+            nvar += 1
+        if pos > size:
+            return 'truncated: variables need {n} bytes, file has {s}'.format(
+                n=pos, s=size)
+        if nvar == 0:
+            return 'no variables'
+
+    return None
+
+
+def check_load(filename):
+    """ Check MATLAB file by loading it
+
+    Args:
+      filename (str): MATLAB file
+
+    Returns:
+      str: description of error, or None if file loads
+
+    """
+    try:
+        spio.loadmat(filename)
+    except Exception as e:
+        return str(e) or e.__class__.__name__
+    return None
+
+
+def _check(job):
+    """ Check one file, returning filename, size, mtime and any error """
+    filename, header = job
+    st = os.stat(filename)
+    try:
+        error = check_header(filename) if header else check_load(filename)
+    except Exception as e:
+        error = str(e) or e.__class__.__name__
+    return filename, st.st_size, st.st_mtime, error
+
+
+def result_row(filename):
+    """ Return row of result from last number in file name, or None """
+    numbers = re.findall(r'\d+', os.path.basename(filename))
+    return int(numbers[-1]) if numbers else None
+
+
+def read_cache(filename):
+    """ Return dict of size, mtime and mode of files previously checked OK """
+    if filename is None or not os.path.isfile(filename):
+        return {}
+    with open(filename) as f:
+        return json.load(f)
+
+
+def write_cache(filename, cache):
+    """ Write dict of files checked OK, replacing cache atomically """
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cache, f)
+    os.rename(tmp, filename)
+
+
+def check_results(location, pattern='record_*.mat', header=False,
+                  cache=None, nrow=None, ncpu=1):
     """ Check results matching pattern within location for errors
-    
+
     Args:
       location (str): directory location of the results
       pattern (str, optional): file pattern to check
+      header (bool, optional): only check headers and sizes of files
+      cache (str, optional): JSON file of files previously checked OK, which
+        are skipped unless changed, and updated with files checked OK
+      nrow (int, optional): number of rows expected to have results
+      ncpu (int, optional): number of processes
+
+    Returns:
+      dict: report of files checked, cached, corrupt (with error and row),
+        and rows missing results
 
     """
     results = fnmatch.filter(os.listdir(location), pattern)
@@ -38,28 +168,77 @@ def check_results(location, pattern='record_*.mat'):
         logger.error('Found 0 results')
         sys.exit(1)
     results.sort()
+    results = [os.path.join(location, r) for r in results]
 
-    errors = 0
+    # Skip files unchanged since checked OK, with full load if required
+    checked = read_cache(cache)
+    mode = 'header' if header else 'load'
+    todo = []
     for r in results:
-        r = os.path.join(location, r)
-        try:
-            mat = spio.loadmat(r)
-        except:
-            logger.error('Could not open {r}'.format(r=r))
-            errors += 1
-        else:
+        key = os.path.abspath(r)
+        st = os.stat(r)
+        prev = checked.get(key)
+        if prev and prev[:2] == [st.st_size, st.st_mtime] and \
+                (prev[2] == 'load' or prev[2] == mode):
+            continue
+        todo.append(r)
+    logger.info('Checking {n} of {t} results ({c} cached)'.format(
+        n=len(todo), t=len(results), c=len(results) - len(todo)))
+
+    jobs = [(r, header) for r in todo]
+    if ncpu > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(ncpu)
+        checks = pool.imap_unordered(_check, jobs, chunksize=16)
+    else:
+        pool = None
+        checks = (_check(job) for job in jobs)
+
+    corrupt = []
+    for r, size, mtime, error in checks:
+        if error is None:
             logger.debug('Opened {r}'.format(r=r))
+            checked[os.path.abspath(r)] = [size, mtime, mode]
+        else:
+            logger.error('Could not open {r}: {e}'.format(r=r, e=error))
+            checked.pop(os.path.abspath(r), None)
+            corrupt.append({'file': r, 'row': result_row(r), 'error': error})
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    if cache is not None:
+        write_cache(cache, checked)
+
+    # Rows without results
+    rows = set(result_row(r) for r in results) - set([None])
+    last = nrow if nrow is not None else max(rows) if rows else 0
+    missing = sorted(set(range(1, last + 1)) - rows)
 
     logger.info('Completed')
     logger.info('    {e} of {n} failed to open'.format(
-            e=errors, n=len(results)))
+            e=len(corrupt), n=len(results)))
+    if missing:
+        logger.info('    {m} of {n} rows missing results'.format(
+            m=len(missing), n=last))
+
+    return {
+        'location': location,
+        'pattern': pattern,
+        'mode': mode,
+        'files': len(results),
+        'checked': len(todo),
+        'cached': len(results) - len(todo),
+        'corrupt': sorted(corrupt, key=lambda c: c['file']),
+        'missing_rows': missing
+    }
 
 if __name__ == '__main__':
     args = docopt(__doc__)
 
     if args['--verbose']:
         logger.setLevel(logging.DEBUG)
-    
+
     location = args['<location>']
     if not os.path.isdir(location):
         logger.error('{d} is not a directory'.format(d=location))
@@ -69,6 +248,19 @@ if __name__ == '__main__':
     if '*' not in pattern:
         pattern += '*'
 
+    try:
+        ncpu = int(args['--ncpu'])
+        nrow = int(args['--nrow']) if args['--nrow'] else None
+    except ValueError:
+        logger.error('Number of processes and rows must be integers')
+        sys.exit(1)
+
     logger.debug('Searching in {d} for files matching {p}'.format(
             d=location, p=pattern))
-    check_results(location, pattern=pattern)
+    report = check_results(location, pattern=pattern,
+                           header=args['--header'], cache=args['--cache'],
+                           nrow=nrow, ncpu=ncpu)
+
+    if args['--report']:
+        with open(args['--report'], 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+""" Map CCDC change records from the PyTable created by pytable_ccdc.py
+
+Usage:
+    ccdc_map.py [options] <pytable> <example_image> <output> <products>...
+
+Options:
+    --start=<date>          Map breaks on or after date (YYYY-MM-DD)
+    --end=<date>            Map breaks before date (YYYY-MM-DD)
+    --reduce=<how>          Map "first" or "last" break of pixels [default: first]
+    --yeardoy               Map dates as YYYYDOY instead of MATLAB datenum
+    --ndv=<ndv>             Value of pixels without a break [default: 0]
+    -f --format=<format>    Output file format [default: GTiff]
+    --ot=<dtype>            Output data type [default: Float32]
+    -b --blocksize=<rows>   Number of rows mapped at once [default: 100]
+    -h --help               Show help
+
+Products are fields of the CCDC records, optionally indexed for fields with
+more than one value, like "coefs[0,3]" or "magnitude[4]". Each product is a
+band of the output, all mapped in one pass over the table.
+
+Examples:
+
+    Map the date (as YYYYDOY) and the change magnitude in the 5th band of the
+    first break during 2010:
+
+    > ccdc_map.py --start 2010-01-01 --end 2011-01-01 --yeardoy \\
+    ... ccdc_record_change.h5 LE70130302010211EDC00_stack change_2010.gtif \\
+    ... t_break "magnitude[4]"
+
+"""
+from __future__ import division, print_function
+import re
+import sys
+
+from docopt import docopt
+import numpy as np
+try:
+    from osgeo import gdal
+    from osgeo import gdal_array
+except ImportError:
+    import gdal
+    import gdal_array
+
+from ccdc_query import (iter_blocks, open_table, paint, parse_date,
+                        reduce_records)
+
+# Fields of CCDC records which are dates
+DATE_FIELDS = ['t_start', 't_end', 't_break']
+
+# MATLAB datenum of 1970-01-01
+_DATENUM_EPOCH = 719529
+
+_PRODUCT = re.compile(r'^(\w+)(?:\[([\d, ]+)\])?$')
+
+
+def parse_product(product):
+    """ Return field and index of product, e.g. ``coefs[0,3]``
+
+    Args:
+      product (str): field name, optionally followed by indexes in brackets
+
+    Returns:
+      tuple: field name and tuple of indexes into field
+
+    """
+    match = _PRODUCT.match(product.strip())
+    if match is None:
+        raise ValueError('Cannot parse product "{p}"'.format(p=product))
+    field, index = match.groups()
+    index = () if index is None else \
+        tuple(int(i) for i in index.replace(',', ' ').split())
+    return field, index
+
+
+def datenum2yeardoy(datenum):
+    """ Return YYYYDOY of MATLAB datenums """
+    days = (np.asarray(datenum) - _DATENUM_EPOCH).astype('datetime64[D]')
+    year = days.astype('datetime64[Y]')
+    doy = (days - year).astype(np.int64) + 1
+    return (year.astype(np.int64) + 1970) * 1000 + doy
+
+
+def product_values(rec, field, index=(), yeardoy=False):
+    """ Return values of a product for each record """
+    values = rec[field][(slice(None), ) + index]
+    if yeardoy and field in DATE_FIELDS:
+        values = datenum2yeardoy(values)
+    return values
+
+
+def ccdc_map(table, products, nrow, ncol, t_break=None, how='first',
+             yeardoy=False, fill=0, dtype=np.float32, block_size=100):
+    """ Yield maps of products of CCDC records for each block of rows
+
+    Records within each block are read once, reduced to the first or last
+    break of each pixel, and scattered into each product.
+
+    Args:
+      table (tables.Table): CCDC record table
+      products (list): (field, index) of each product (see
+        ``parse_product``)
+      nrow (int): number of rows in image
+      ncol (int): number of columns in image
+      t_break (tuple, optional): start (inclusive) and end (exclusive)
+        MATLAB datenum of breaks, or all breaks
+      how (str, optional): map "first" or "last" break of each pixel
+      yeardoy (bool, optional): map dates as YYYYDOY
+      fill (int or float, optional): value of pixels without a break
+      dtype (np.dtype, optional): data type of maps
+      block_size (int, optional): number of rows in each block
+
+    Yields:
+      tuple: first row and number of rows of block, and list of map of each
+        product for block
+
+    """
+    if t_break is None:
+        t_break = (1, np.inf)
+    fields = ['pos', 't_break'] + sorted(
+        set(f for f, _ in products) - set(['pos', 't_break']))
+
+    for row, n, rec in iter_blocks(table, nrow, ncol, block_size=block_size,
+                                   t_break=t_break, fields=fields):
+        rec = reduce_records(rec, how=how)
+        values = np.empty(rec.size, dtype=[('pos', rec['pos'].dtype),
+                                           ('value', dtype)])
+        values['pos'] = rec['pos']
+        maps = []
+        for field, index in products:
+            values['value'] = product_values(rec, field, index, yeardoy)
+            maps.append(paint(values, 'value', ncol, row, n, fill=fill))
+        yield row, n, maps
+
+
+def main():
+    args = docopt(__doc__)
+
+    # Products
+    try:
+        products = [parse_product(p) for p in args['<products>']]
+    except ValueError as e:
+        print('Error: {e}'.format(e=e))
+        sys.exit(1)
+
+    # Break date window
+    t_break = None
+    if args['--start'] or args['--end']:
+        t_break = (parse_date(args['--start'], 'start')
+                   if args['--start'] else 1,
+                   parse_date(args['--end'], 'end')
+                   if args['--end'] else np.inf)
+
+    how = args['--reduce']
+    if how not in ('first', 'last'):
+        print('Error: --reduce must be "first" or "last"')
+        sys.exit(1)
+
+    try:
+        ndv = float(args['--ndv'])
+        block_size = int(args['--blocksize'])
+    except ValueError:
+        print('Error: NoData value and block size must be numbers')
+        sys.exit(1)
+
+    gdal_dtype = gdal.GetDataTypeByName(args['--ot'])
+    if gdal_dtype == gdal.GDT_Unknown:
+        print('Error: unknown output data type {t}'.format(t=args['--ot']))
+        sys.exit(1)
+    dtype = gdal_array.GDALTypeCodeToNumericTypeCode(gdal_dtype)
+
+    # Example image
+    try:
+        ex_ds = gdal.Open(args['<example_image>'], gdal.GA_ReadOnly)
+    except RuntimeError:
+        ex_ds = None
+    if ex_ds is None:
+        print('Error: could not open example image')
+        sys.exit(1)
+    nrow, ncol = ex_ds.RasterYSize, ex_ds.RasterXSize
+
+    driver = gdal.GetDriverByName(args['--format'])
+    if driver is None:
+        print('Error: unknown format {f}'.format(f=args['--format']))
+        sys.exit(1)
+    out_ds = driver.Create(args['<output>'], ncol, nrow, len(products),
+                           gdal_dtype)
+    if out_ds is None:
+        print('Error: could not create output {f}'.format(f=args['<output>']))
+        sys.exit(1)
+    out_ds.SetProjection(ex_ds.GetProjection())
+    out_ds.SetGeoTransform(ex_ds.GetGeoTransform())
+    for i, product in enumerate(args['<products>']):
+        out_ds.GetRasterBand(i + 1).SetDescription(product)
+        out_ds.GetRasterBand(i + 1).SetNoDataValue(ndv)
+    ex_ds = None
+
+    h5file, table = open_table(args['<pytable>'])
+    with h5file:
+        missing = [f for f, _ in products if f not in table.colnames]
+        if missing:
+            print('Error: unknown fields {f}'.format(f=', '.join(missing)))
+            sys.exit(1)
+        for product, (field, index) in zip(args['<products>'], products):
+            shape = table.coldtypes[field].shape
+            if len(index) != len(shape) or \
+                    any(i >= s for i, s in zip(index, shape)):
+                print('Error: product {p} must index field of shape {s}'
+                      .format(p=product, s=shape))
+                sys.exit(1)
+
+        for row, n, maps in ccdc_map(table, products, nrow, ncol,
+                                     t_break=t_break, how=how,
+                                     yeardoy=args['--yeardoy'], fill=ndv,
+                                     dtype=dtype, block_size=block_size):
+            for i, m in enumerate(maps):
+                out_ds.GetRasterBand(i + 1).WriteArray(m, 0, row)
+            print('Mapped rows {r}-{e} of {n}'.format(r=row, e=row + n,
+                                                      n=nrow))
+
+    out_ds = None
+
+
+if __name__ == '__main__':
+    main()
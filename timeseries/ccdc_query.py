@@ -0,0 +1,326 @@
+#!/usr/bin/env python
+""" Query CCDC records from the PyTable created by pytable_ccdc.py
+
+Usage:
+    ccdc_query.py [options] <pytable> <ncol>
+
+Options:
+    --rows=<rows>           Rows of pixels "start end" to query
+    --cols=<cols>           Columns of pixels "start end" to query
+    --start=<date>          Query breaks on or after date (YYYY-MM-DD)
+    --end=<date>            Query breaks before date (YYYY-MM-DD)
+    --fields=<fields>       Fields to output [default: pos, t_start, t_end, t_break]
+    -h --help               Show help
+
+Examples:
+
+    Print the position, row, column and date of all breaks during 2010 from
+    images with 8000 columns:
+
+    > ccdc_query.py --start 2010-01-01 --end 2011-01-01 \\
+    ... --fields "pos, t_break" ccdc_record_change.h5 8000
+
+Records are queried with ``read_where`` so the indexes on ``pos`` and
+``t_break`` created by ``pytable_ccdc.py`` are used. Pixel positions
+(``pos``) are 1-based and row-major, as in CCDC: ``pos = row * ncol + col + 1``
+for 0-based ``row`` and ``col``. Dates (``t_start``, ``t_end``,
+``t_break``) are MATLAB datenums and ``t_break`` is 0 for records without a
+break.
+
+"""
+from __future__ import division, print_function
+import datetime as dt
+import sys
+
+from docopt import docopt
+import numpy as np
+import tables
+
+# Days between MATLAB datenum and Python proleptic Gregorian ordinal
+_DATENUM_OFFSET = 366
+
+
+def date2datenum(date):
+    """ Return MATLAB datenum of a ``datetime.date`` """
+    return date.toordinal() + _DATENUM_OFFSET
+
+
+def datenum2date(datenum):
+    """ Return ``datetime.date`` of a MATLAB datenum """
+    return dt.date.fromordinal(int(datenum) - _DATENUM_OFFSET)
+
+
+def parse_date(value, name):
+    """ Return MATLAB datenum of a YYYY-MM-DD date given on the command line,
+    exiting with an error naming the option if it cannot be parsed
+    """
+    try:
+        return date2datenum(dt.datetime.strptime(value, '%Y-%m-%d').date())
+    except ValueError:
+        print('Error: {n} date must be YYYY-MM-DD'.format(n=name))
+        sys.exit(1)
+
+
+def pos2rowcol(pos, ncol):
+    """ Return 0-based rows and columns of 1-based, row-major positions """
+    pos = np.asarray(pos, dtype=np.int64) - 1
+    return pos // ncol, pos % ncol
+
+
+def rowcol2pos(row, col, ncol):
+    """ Return 1-based, row-major positions of 0-based rows and columns """
+    return np.asarray(row, dtype=np.int64) * ncol + col + 1
+
+
+def open_table(filename, node='/CCDCRec/rec_cg'):
+    """ Return open PyTables file and CCDC record table within it """
+    h5file = tables.open_file(filename, mode='r')
+    return h5file, h5file.get_node(node)
+
+
+def query(table, pos=None, t_break=None, ncol=None, cols=None,
+          fields=None):
+    """ Return CCDC records by range of pixel position and break date
+
+    Args:
+      table (tables.Table): CCDC record table
+      pos (tuple, optional): first and last pixel position (inclusive)
+      t_break (tuple, optional): start (inclusive) and end (exclusive)
+        MATLAB datenum of breaks
+      ncol (int, optional): number of columns in image, required to select
+        by ``cols``
+      cols (tuple, optional): first and last column (0-based, exclusive)
+      fields (list, optional): fields to return, or all
+
+    Returns:
+      np.ndarray: structured array of records
+
+    """
+    conditions, condvars = [], {}
+    if pos is not None:
+        conditions.append('(pos >= pos0) & (pos <= pos1)')
+        condvars.update(pos0=pos[0], pos1=pos[1])
+    if t_break is not None:
+        conditions.append('(t_break >= t0) & (t_break < t1)')
+        condvars.update(t0=t_break[0], t1=t_break[1])
+
+    if conditions:
+        rec = table.read_where(' & '.join(conditions), condvars)
+    else:
+        rec = table.read()
+
+    if cols is not None:
+        if ncol is None:
+            raise ValueError('Must know number of columns to query columns')
+        _, col = pos2rowcol(rec['pos'], ncol)
+        rec = rec[(col >= cols[0]) & (col < cols[1])]
+
+    if fields is not None:
+        rec = rec[list(fields)]
+    return rec
+
+
+def query_block(table, ncol, row, nrow, col=0, ncols=None, t_break=None,
+                fields=None):
+    """ Return CCDC records within a block of pixels
+
+    Args:
+      table (tables.Table): CCDC record table
+      ncol (int): number of columns in image
+      row (int): first row of block
+      nrow (int): number of rows in block
+      col (int, optional): first column of block
+      ncols (int, optional): number of columns in block, or through last
+        column of image
+      t_break (tuple, optional): start (inclusive) and end (exclusive)
+        MATLAB datenum of breaks
+      fields (list, optional): fields to return, or all
+
+    Returns:
+      np.ndarray: structured array of records
+
+    """
+    ncols = ncol - col if ncols is None else ncols
+    pos = (int(rowcol2pos(row, col, ncol)),
+           int(rowcol2pos(row + nrow - 1, col + ncols - 1, ncol)))
+    cols = None if (col == 0 and ncols == ncol) else (col, col + ncols)
+    if fields is not None and 'pos' not in fields:
+        fields = ['pos'] + list(fields)
+    return query(table, pos=pos, t_break=t_break, ncol=ncol, cols=cols,
+                 fields=fields)
+
+
+def iter_blocks(table, nrow, ncol, block_size=100, t_break=None,
+                fields=None):
+    """ Yield CCDC records within each block of rows of an image
+
+    Args:
+      table (tables.Table): CCDC record table
+      nrow (int): number of rows in image
+      ncol (int): number of columns in image
+      block_size (int, optional): number of rows in each block
+      t_break (tuple, optional): start (inclusive) and end (exclusive)
+        MATLAB datenum of breaks
+      fields (list, optional): fields to return, or all
+
+    Yields:
+      tuple: first row and number of rows of block, and a structured array
+        of records within block
+
+    """
+    for row in range(0, nrow, block_size):
+        n = min(block_size, nrow - row)
+        yield row, n, query_block(table, ncol, row, n, t_break=t_break,
+                                  fields=fields)
+
+
+def reduce_records(rec, how='first', key='t_break'):
+    """ Return one record for each pixel position
+
+    Records are sorted by position and ``key`` and the first or last record
+    of each position is kept.
+
+    Args:
+      rec (np.ndarray): structured array of records
+      how (str, optional): keep "first" or "last" record of each pixel
+      key (str, optional): field to order records of each pixel by
+
+    Returns:
+      np.ndarray: structured array of records, sorted by position
+
+    """
+    if how not in ('first', 'last'):
+        raise ValueError('Unknown reduction "{h}"'.format(h=how))
+    if rec.size == 0:
+        return rec
+    rec = rec[np.lexsort((rec[key], rec['pos']))]
+    if how == 'first':
+        keep = np.concatenate(([True], rec['pos'][1:] != rec['pos'][:-1]))
+    else:
+        keep = np.concatenate((rec['pos'][1:] != rec['pos'][:-1], [True]))
+    return rec[keep]
+
+
+def paint(rec, field, ncol, row, nrow, col=0, ncols=None, fill=0,
+          dtype=None):
+    """ Return raster of a field of records with one record per pixel
+
+    Args:
+      rec (np.ndarray): structured array of records, at most one per pixel
+        (see ``reduce_records``)
+      field (str): field to paint
+      ncol (int): number of columns in image
+      row (int): first row of raster
+      nrow (int): number of rows in raster
+      col (int, optional): first column of raster
+      ncols (int, optional): number of columns in raster, or through last
+        column of image
+      fill (int or float, optional): value of pixels without a record
+      dtype (np.dtype, optional): raster data type, or that of field
+
+    Returns:
+      np.ndarray: raster of field (nrow x ncols, plus any dimensions of the
+        field)
+
+    """
+    ncols = ncol - col if ncols is None else ncols
+    values = rec[field]
+    out = np.full((nrow, ncols) + values.shape[1:], fill,
+                  dtype=dtype or values.dtype)
+    r, c = pos2rowcol(rec['pos'], ncol)
+    out[r - row, c - col] = values
+    return out
+
+
+def paint_blocks(table, field, nrow, ncol, block_size=100, t_break=None,
+                 how='first', fill=0, dtype=None):
+    """ Yield raster of a field for each block of rows of an image
+
+    For example, the date of the first break in 2010 for each pixel:
+
+        >>> t_break = (date2datenum(dt.date(2010, 1, 1)),
+        ...            date2datenum(dt.date(2011, 1, 1)))
+        >>> for row, n, raster in paint_blocks(table, 't_break', nrow, ncol,
+        ...                                    t_break=t_break):
+        ...     band.WriteArray(raster, 0, row)
+
+    Args:
+      table (tables.Table): CCDC record table
+      field (str): field to paint
+      nrow (int): number of rows in image
+      ncol (int): number of columns in image
+      block_size (int, optional): number of rows in each block
+      t_break (tuple, optional): start (inclusive) and end (exclusive)
+        MATLAB datenum of breaks, or all breaks (excluding records without
+        a break, whose ``t_break`` is 0)
+      how (str, optional): paint "first" or "last" record of each pixel,
+        by break date
+      fill (int or float, optional): value of pixels without a record
+      dtype (np.dtype, optional): raster data type, or that of field
+
+    Yields:
+      tuple: first row and number of rows of block, and raster of block
+
+    """
+    # Records without a break would sort ahead of any break
+    if t_break is None:
+        t_break = (1, np.inf)
+    fields = ['pos', 't_break'] + [f for f in [field]
+                                   if f not in ('pos', 't_break')]
+    for row, n, rec in iter_blocks(table, nrow, ncol, block_size=block_size,
+                                   t_break=t_break, fields=fields):
+        rec = reduce_records(rec, how=how)
+        yield row, n, paint(rec, field, ncol, row, n, fill=fill,
+                            dtype=dtype)
+
+
+def _parse_range(value, name):
+    try:
+        start, end = [int(v) for v in value.replace(',', ' ').split()]
+    except ValueError:
+        print('Error: {n} must be two integers "start end"'.format(n=name))
+        sys.exit(1)
+    return start, end
+
+
+def main():
+    args = docopt(__doc__)
+
+    try:
+        ncol = int(args['<ncol>'])
+    except ValueError:
+        print('Error: number of columns must be an integer')
+        sys.exit(1)
+
+    pos = cols = t_break = None
+    if args['--rows']:
+        rows = _parse_range(args['--rows'], 'rows')
+        pos = (int(rowcol2pos(rows[0], 0, ncol)),
+               int(rowcol2pos(rows[1] - 1, ncol - 1, ncol)))
+    if args['--cols']:
+        cols = _parse_range(args['--cols'], 'columns')
+    if args['--start'] or args['--end']:
+        t_break = (parse_date(args['--start'], 'start')
+                   if args['--start'] else 1,
+                   parse_date(args['--end'], 'end')
+                   if args['--end'] else np.inf)
+    fields = [f for f in args['--fields'].replace(',', ' ').split(' ') if f]
+
+    h5file, table = open_table(args['<pytable>'])
+    with h5file:
+        missing = [f for f in fields if f not in table.colnames]
+        if missing:
+            print('Error: unknown fields {f}'.format(f=', '.join(missing)))
+            sys.exit(1)
+        rec = query(table, pos=pos, t_break=t_break, ncol=ncol, cols=cols,
+                    fields=sorted(set(fields) | set(['pos'])))
+
+    row, col = pos2rowcol(rec['pos'], ncol)
+    print(','.join(['row', 'col'] + fields))
+    for i in range(rec.size):
+        print(','.join([str(row[i]), str(col[i])] +
+                       [str(rec[f][i]) for f in fields]))
+
+
+if __name__ == '__main__':
+    main()
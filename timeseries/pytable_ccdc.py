@@ -3,13 +3,34 @@
 #$ -l h_rt=24:00:00
 #$ -N pytable_ccdc
 #$ -j y
+""" Ingest CCDC ``rec_cg`` records from MATLAB files into a PyTables table
 
+Usage:
+    pytable_ccdc.py [options] <location> <output>
+
+Options:
+    --pattern=<pattern>     Result file pattern [default: record_change*.mat]
+    --ignore=<fields>       Fields to not ingest [default: band, bands]
+    -p --ncpu=<n>           Number of processes reading files [default: 1]
+    --restart               Start over instead of resuming from checkpoint
+    -h --help               Show help
+
+MATLAB files are read into NumPy structured arrays by a pool of processes
+and appended to the table in bulk by the main process. Each ingested file
+is checkpointed in the table "/CCDCRec/ingested" with the number of table
+rows after it was appended, so an interrupted ingest resumes from the last
+file checkpointed.
+
+"""
 from __future__ import print_function
 import fnmatch
+from functools import partial
 import logging
+import multiprocessing
 import os
 import sys
 
+from docopt import docopt
 import numpy as np
 import scipy.io
 import tables
@@ -65,87 +86,176 @@ def get_description(mats, ignore=[]):
             
         return description 
 
-def create_pytable(filename, mats, description):
-    """ Loop through MATLAB mat files adding to PyTable """
+def description_dtype(description):
+    """ Return NumPy structured dtype of rows for PyTable description """
+    return tables.description.dtype_from_descr(description)
+
+def read_mat(mat, dtype):
+    """ Read non-blank records of a MATLAB file into a structured array
+
+    Args:
+      mat (str): MATLAB file containing ``rec_cg``
+      dtype (np.dtype): structured dtype of table rows
+
+    Returns:
+      tuple: MATLAB filename and structured array of records, or None if the
+        file could not be read
+
+    """
+    try:
+        m = scipy.io.loadmat(mat,
+                             squeeze_me=True,
+                             struct_as_record=True)['rec_cg']
+        m = np.atleast_1d(m)
+
+        # Skip blank rows -- those with only empty arrays
+        blank = np.ones(m.size, dtype=bool)
+        for name in m.dtype.names:
+            blank &= np.array([isinstance(item, np.ndarray) and item.size == 0
+                               for item in m[name]], dtype=bool)
+        m = m[~blank]
+
+        rec = np.zeros(m.size, dtype=dtype)
+        for name in dtype.names:
+            if m.size:
+                rec[name] = np.array(m[name].tolist())
+    except Exception:
+        return mat, None
+
+    return mat, rec
+
+def _checkpointed(ingested):
+    """ Return set of filenames and number of rows of last checkpoint """
+    if ingested.nrows == 0:
+        return set(), 0
+    names = [f.decode('utf-8') if isinstance(f, bytes) else f
+             for f in ingested.col('filename')]
+    return set(names), int(ingested.cols.nrows[-1])
+
+def create_pytable(filename, mats, description, ncpu=1, resume=True):
+    """ Read MATLAB mat files in parallel, bulk appending them to PyTable
+
+    Args:
+      filename (str): PyTable HDF5 filename
+      mats (list): MATLAB files to ingest
+      description (dict): PyTable description of table
+      ncpu (int, optional): number of processes reading MATLAB files
+      resume (bool, optional): skip files checkpointed in an existing table
+
+    """
+    dtype = description_dtype(description)
 
     # Open PyTable file
-    with tables.open_file(filename, mode='w') as h5file:
-        # Create group
-        group = h5file.create_group(h5file.root, 'CCDCRec')
-        # Create table
-        table = h5file.create_table('/CCDCRec', 
-                                    'rec_cg', 
-                                    description, 
-                                    'CCDC Records')
-        # Get row
-        record = table.row
-        
-        # Loop through MATLAB files
-        for i, mat in enumerate(mats):
-            if i % 10 == 0:
-                print('    processing record {i} / {n}'.format(i=i,
-                                                               n=len(mats)))
-            # Open up .mat file
+    mode = 'a' if resume and os.path.isfile(filename) else 'w'
+    with tables.open_file(filename, mode=mode) as h5file:
+        if '/CCDCRec/rec_cg' in h5file:
+            table = h5file.get_node('/CCDCRec/rec_cg')
             try:
-                m = scipy.io.loadmat(mat, 
-                                     squeeze_me=True, 
-                                     struct_as_record=True)['rec_cg']
-            except:
+                ingested = h5file.get_node('/CCDCRec/ingested')
+            except tables.NoSuchNodeError:
+                # Without checkpoints we cannot tell which files it holds
+                print('Error: {f} was created before ingests were '
+                      'checkpointed and cannot be resumed. Use --restart to '
+                      'create it again'.format(f=filename))
+                return 1
+        else:
+            # Create group
+            group = h5file.create_group(h5file.root, 'CCDCRec')
+            # Create table
+            table = h5file.create_table('/CCDCRec',
+                                        'rec_cg',
+                                        description,
+                                        'CCDC Records')
+            # Create checkpoint of files ingested
+            ingested = h5file.create_table('/CCDCRec',
+                                           'ingested',
+                                           {'filename': tables.StringCol(1024),
+                                            'nrows': tables.Int64Col()},
+                                           'MATLAB files ingested')
+
+        # Drop indexes while appending -- they are created again at the end
+        for col in (table.cols.pos, table.cols.t_break):
+            if col.is_indexed:
+                col.remove_index()
+
+        # Roll back rows appended after last checkpoint
+        done, nrows = _checkpointed(ingested)
+        if table.nrows > nrows:
+            print('Removing {n} rows appended after last checkpoint'.format(
+                n=table.nrows - nrows))
+            table.truncate(nrows)
+
+        pending = [mat for mat in mats if mat not in done]
+        if done:
+            print('Resuming after {d} files ingested'.format(d=len(done)))
+
+        # Read files in parallel, preserving order for checkpoint
+        if ncpu > 1 and len(pending) > 1:
+            pool = multiprocessing.Pool(ncpu)
+            results = pool.imap(partial(read_mat, dtype=dtype), pending)
+        else:
+            pool = None
+            results = (read_mat(mat, dtype) for mat in pending)
+
+        for i, (mat, rec) in enumerate(results):
+            if i % 10 == 0:
+                print('    processing record {i} / {n}'.format(
+                    i=i, n=len(pending)))
+            if rec is None:
                 # TODO logging
                 print('Warning: MATLAB file {m} may be corrupt'.format(m=mat))
-                
-            # Loop through records in .mat file
-            for rec_cg in m:
-                # Skip blank rows
-                if all([item.size == 0 if 
-                        type(item) == np.ndarray 
-                        else False for item in rec_cg]):
-                    continue
-                # Loop through fields in record
-                for name, item in zip(rec_cg.dtype.names, rec_cg):
-                    # Ignore fields not in table description
-                    if name not in description.keys():
-                        continue
-                    # Insert item
-                    record[name] = item
-                    
-                # Append row before going to next
-                record.append()
-                
-            # Flush output before going to new MATLAB file
+                continue
+
+            # Append records and then checkpoint file
+            if rec.size:
+                table.append(rec)
             table.flush()
-    
+            ingested.append([(mat, table.nrows)])
+            ingested.flush()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
         # Create indexing on position and change date
         table.cols.pos.create_index(optlevel=9)
         table.cols.t_break.create_index(optlevel=9)
-            
+
     # Context manager takes care of closing
     return 0
 
 def main():
-    # Setup
-    root = '/projectnb/landsat/projects/CMS/stacks/Mexico/p022r049'
-    location = 'images/TSFitMap'
-    pattern = 'record_change*.mat'
-    pytable_name = '/projectnb/landsat/projects/CMS/stacks/Mexico/p022r049/ccdc_record_change.h5'
-    
-    os.chdir(root)
-    
+    args = docopt(__doc__)
+
+    location = args['<location>']
+    if not os.path.isdir(location):
+        print('Error: {d} is not a directory'.format(d=location))
+        sys.exit(1)
+    pytable_name = args['<output>']
+    pattern = args['--pattern']
+    ignore = [f for f in args['--ignore'].replace(',', ' ').split(' ') if f]
+    try:
+        ncpu = int(args['--ncpu'])
+    except ValueError:
+        print('Error: number of processes must be an integer')
+        sys.exit(1)
+
     # Find record_change files
     # TODO logging
     print('Finding MATLAB files...')
-    mats = find_mat_files(location, pattern)
+    mats = sorted(find_mat_files(location, pattern))
     print('Found {n} MATLAB files'.format(n=len(mats)))
-    
+
     # Determine our PyTable description from mat files
     print('Getting description...')
-    desc = get_description(mats, ignore=['band', 'bands'])
+    desc = get_description(mats, ignore=ignore)
     print('Description:')
     print(desc)
-    
+
     # Create PyTable
     print('Creating PyTable...')
-    sys.exit(create_pytable(pytable_name, mats, desc))
+    sys.exit(create_pytable(pytable_name, mats, desc, ncpu=ncpu,
+                            resume=not args['--restart']))
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,389 @@
+#!/usr/bin/env python
+""" Chip dataset of stacks at sample locations for model training
+
+Usage:
+    chip_dataset.py [options] <samples> <location> <output>
+
+Options:
+    -n --name <name>        Pattern of each stack file [default: *stack]
+    -d --dname <dname>      Pattern for each stack directory [default: L*]
+    --bands <bands>         Bands of stacks to extract [default: all]
+    --size <size>           Chip width and height in pixels [default: 9]
+    --label <field>         Sample label field or CSV column [default: STRATUM]
+    --ndv <ndv>             Value of chip pixels beyond stacks [default: -9999]
+    --shard <n>             Number of chips in each shard [default: 1024]
+    -p --ncpu <n>           Number of processes [default: 1]
+    -v --verbose            Show verbose debugging messages
+    -h --help               Show help
+
+Samples are read from the raster or vector output of "maps/sample_map.py"
+(every pixel not NoData in the raster, labeled by its value, or the centroid
+of each feature in the vector, labeled by "--label"), or from a CSV file with
+columns "x", "y" and "--label".
+
+The output directory holds a "manifest.json" describing the dataset, the
+date of each stack ("dates.npy"), and shards of chips. Each shard is a
+directory of NumPy arrays:
+
+    chips.npy       chips (chip x time x band x row x column)
+    labels.npy      label of each chip
+    xy.npy          X and Y coordinate of center of each chip
+
+Shards are extracted in parallel and each is written under a temporary name
+and renamed when complete, so running again resumes by extracting only the
+shards that are missing. Read the dataset back, memory-mapped, with
+ChipDataset:
+
+    >>> ds = ChipDataset('chips/')
+    >>> chips, label = ds[0]
+
+"""
+from __future__ import division, print_function
+import datetime as dt
+import fnmatch
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sys
+
+from docopt import docopt
+import numpy as np
+try:
+    from osgeo import gdal, gdal_array, ogr
+except ImportError:
+    import gdal
+    import gdal_array
+    import ogr
+
+logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',
+                    level=logging.INFO,
+                    datefmt='%H:%M:%S')
+logger = logging.getLogger(__name__)
+
+gdal.UseExceptions()
+ogr.UseExceptions()
+
+MANIFEST = 'manifest.json'
+
+
+def find_stacks(location, stkname='*stack', stkdir='L*'):
+    """ Returns dates and filenames of stacks, sorted by date
+
+    Dates are parsed from the Landsat ID of each stack's directory or
+    filename.
+    """
+    stacks = []
+    for root, dirs, files in os.walk(location, topdown=True):
+        dirs[:] = fnmatch.filter(dirs, stkdir)
+        for f in fnmatch.filter(files, stkname):
+            stack = os.path.join(root, f)
+            for name in (os.path.basename(root), f):
+                try:
+                    date = dt.datetime.strptime(name[9:16], '%Y%j').date()
+                except ValueError:
+                    continue
+                stacks.append((date, stack))
+                break
+            else:
+                logger.warning('Could not find date of {f}'.format(f=stack))
+    stacks.sort()
+    return [d for d, _ in stacks], [s for _, s in stacks]
+
+
+def read_raster_samples(filename, block_size=1024):
+    """ Returns X, Y and value of each pixel that is not NoData """
+    ds = gdal.Open(filename, gdal.GA_ReadOnly)
+    band = ds.GetRasterBand(1)
+    ndv = band.GetNoDataValue()
+    gt = ds.GetGeoTransform()
+
+    cols, rows, labels = [], [], []
+    for row in range(0, ds.RasterYSize, block_size):
+        nrow = min(block_size, ds.RasterYSize - row)
+        data = band.ReadAsArray(0, row, ds.RasterXSize, nrow)
+        r, c = np.nonzero(data != ndv) if ndv is not None else \
+            np.nonzero(np.ones_like(data, dtype=bool))
+        rows.append(r + row)
+        cols.append(c)
+        labels.append(data[r, c])
+    ds = None
+
+    cols = np.concatenate(cols) + 0.5
+    rows = np.concatenate(rows) + 0.5
+    x = gt[0] + cols * gt[1] + rows * gt[2]
+    y = gt[3] + cols * gt[4] + rows * gt[5]
+    return x, y, np.concatenate(labels)
+
+
+def read_vector_samples(filename, label):
+    """ Returns X, Y of centroid and label of each feature """
+    ds = ogr.Open(filename)
+    layer = ds.GetLayer()
+    x, y, labels = [], [], []
+    for feature in layer:
+        centroid = feature.GetGeometryRef().Centroid()
+        x.append(centroid.GetX())
+        y.append(centroid.GetY())
+        labels.append(feature.GetField(label))
+    ds = None
+    return np.array(x), np.array(y), np.array(labels)
+
+
+def read_csv_samples(filename, label):
+    """ Returns X, Y and label of each row of a CSV file """
+    data = np.genfromtxt(filename, delimiter=',', names=True, dtype=None,
+                         encoding='utf-8')
+    for name in ('x', 'y', label):
+        if name not in data.dtype.names:
+            raise KeyError('CSV file has no column "{n}"'.format(n=name))
+    return (data['x'].astype(np.float64), data['y'].astype(np.float64),
+            data[label])
+
+
+def read_samples(filename, label='STRATUM'):
+    """ Returns X, Y and label of samples from a raster, vector or CSV """
+    if filename.lower().endswith('.csv'):
+        return read_csv_samples(filename, label)
+    try:
+        gdal.Open(filename, gdal.GA_ReadOnly)
+    except RuntimeError:
+        return read_vector_samples(filename, label)
+    return read_raster_samples(filename)
+
+
+def read_window(ds, bands, xoff, yoff, size, fill, dtype):
+    """ Returns chip (band x row x column) of a dataset, filling any part of
+    it beyond the dataset
+    """
+    chip = np.full((len(bands), size, size), fill, dtype=dtype)
+    x0, y0 = max(xoff, 0), max(yoff, 0)
+    x1 = min(xoff + size, ds.RasterXSize)
+    y1 = min(yoff + size, ds.RasterYSize)
+    if x1 <= x0 or y1 <= y0:
+        return chip
+    for i, b in enumerate(bands):
+        chip[i, y0 - yoff:y1 - yoff, x0 - xoff:x1 - xoff] = \
+            ds.GetRasterBand(b).ReadAsArray(x0, y0, x1 - x0, y1 - y0)
+    return chip
+
+
+def _shard_name(i):
+    return 'shard_{i:05d}'.format(i=i)
+
+
+def _write_shard(job):
+    """ Extract chips of one shard from every stack and write shard """
+    (output, shard, stacks, bands, xoff, yoff, xy, labels, size, fill,
+     dtype) = job
+    tmp = os.path.join(output, _shard_name(shard) + '.tmp')
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    os.mkdir(tmp)
+
+    chips = np.lib.format.open_memmap(
+        os.path.join(tmp, 'chips.npy'), mode='w+', dtype=dtype,
+        shape=(len(xoff), len(stacks), len(bands), size, size))
+
+    # Read chips in order of rows within each stack
+    order = np.lexsort((xoff, yoff))
+    for t, stack in enumerate(stacks):
+        ds = gdal.Open(stack, gdal.GA_ReadOnly)
+        for i in order:
+            chips[i, t] = read_window(ds, bands, xoff[i], yoff[i], size,
+                                      fill, dtype)
+        ds = None
+    chips.flush()
+    del chips
+
+    np.save(os.path.join(tmp, 'labels.npy'), labels)
+    np.save(os.path.join(tmp, 'xy.npy'), xy)
+    os.rename(tmp, os.path.join(output, _shard_name(shard)))
+    return shard
+
+
+def chip_dataset(samples, location, output, stkname='*stack', stkdir='L*',
+                 bands=None, size=9, label='STRATUM', fill=-9999,
+                 shard_size=1024, ncpu=1):
+    """ Writes chip dataset of stacks at sample locations
+
+    Args:
+      samples (str): sample raster, vector or CSV file
+      location (str): directory of stacks
+      output (str): output directory
+      stkname (str, optional): pattern of each stack file
+      stkdir (str, optional): pattern for each stack directory
+      bands (list, optional): bands of stacks to extract, or all
+      size (int, optional): chip width and height in pixels
+      label (str, optional): sample label field or CSV column
+      fill (int or float, optional): value of chip pixels beyond stacks
+      shard_size (int, optional): number of chips in each shard
+      ncpu (int, optional): number of processes
+
+    """
+    dates, stacks = find_stacks(location, stkname, stkdir)
+    if not stacks:
+        logger.error('Could not find any stacks in {d}'.format(d=location))
+        sys.exit(1)
+
+    ex_ds = gdal.Open(stacks[0], gdal.GA_ReadOnly)
+    shape = (ex_ds.RasterYSize, ex_ds.RasterXSize)
+    gt = ex_ds.GetGeoTransform()
+    if bands is None:
+        bands = list(range(1, ex_ds.RasterCount + 1))
+    dtype = np.dtype(gdal_array.GDALTypeCodeToNumericTypeCode(
+        ex_ds.GetRasterBand(bands[0]).DataType))
+    ex_ds = None
+    for stack in stacks:
+        ds = gdal.Open(stack, gdal.GA_ReadOnly)
+        if (ds.RasterYSize, ds.RasterXSize) != shape or \
+                ds.GetGeoTransform() != gt or ds.RasterCount < max(bands):
+            logger.error('{f} does not match grid and bands of {e}'.format(
+                f=stack, e=stacks[0]))
+            sys.exit(1)
+        ds = None
+
+    # Sample locations and upper left pixel of their chips
+    x, y, labels = read_samples(samples, label)
+    det = gt[1] * gt[5] - gt[2] * gt[4]
+    col = ((x - gt[0]) * gt[5] - (y - gt[3]) * gt[2]) / det
+    row = ((y - gt[3]) * gt[1] - (x - gt[0]) * gt[4]) / det
+    xoff = np.floor(col).astype(np.int64) - size // 2
+    yoff = np.floor(row).astype(np.int64) - size // 2
+    xy = np.column_stack((x, y))
+    logger.info('Extracting {n} chips from {t} stacks'.format(
+        n=len(x), t=len(stacks)))
+
+    # Start, or check we are resuming, the same dataset
+    manifest = {
+        'samples': os.path.abspath(samples),
+        'stacks': [os.path.abspath(s) for s in stacks],
+        'dates': [d.isoformat() for d in dates],
+        'bands': bands,
+        'size': size,
+        'fill': fill,
+        'dtype': dtype.str,
+        'nchip': len(x),
+        'shard_size': shard_size,
+        'nshard': -(-len(x) // shard_size)
+    }
+    if not os.path.isdir(output):
+        os.makedirs(output)
+    manifest_file = os.path.join(output, MANIFEST)
+    if os.path.isfile(manifest_file):
+        with open(manifest_file) as f:
+            if json.load(f) != json.loads(json.dumps(manifest)):
+                logger.error('{d} holds a different chip dataset'.format(
+                    d=output))
+                sys.exit(1)
+    else:
+        with open(manifest_file, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        np.save(os.path.join(output, 'dates.npy'),
+                np.array(dates, dtype='datetime64[D]'))
+
+    jobs = []
+    for shard in range(manifest['nshard']):
+        if os.path.isdir(os.path.join(output, _shard_name(shard))):
+            continue
+        s = slice(shard * shard_size, (shard + 1) * shard_size)
+        jobs.append((output, shard, stacks, bands, xoff[s], yoff[s], xy[s],
+                     labels[s], size, fill, dtype))
+    logger.info('Writing {n} of {t} shards'.format(
+        n=len(jobs), t=manifest['nshard']))
+
+    if ncpu > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(ncpu)
+        results = pool.imap_unordered(_write_shard, jobs)
+    else:
+        pool = None
+        results = (_write_shard(job) for job in jobs)
+
+    for i, shard in enumerate(results):
+        logger.debug('Wrote shard {s} ({i}/{n})'.format(
+            s=shard, i=i + 1, n=len(jobs)))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+
+class ChipDataset(object):
+    """ Chip dataset written by chip_dataset, memory-mapped
+
+    Args:
+      path (str): chip dataset directory
+
+    Attributes:
+      dates (np.ndarray): date of each stack (time)
+      labels (np.ndarray): label of each chip
+      xy (np.ndarray): X and Y of center of each chip
+      shards (list): memory-mapped chips of each shard
+
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, MANIFEST)) as f:
+            self.manifest = json.load(f)
+        self.dates = np.load(os.path.join(path, 'dates.npy'))
+        self.shard_size = self.manifest['shard_size']
+
+        names = [os.path.join(path, _shard_name(i))
+                 for i in range(self.manifest['nshard'])]
+        missing = [n for n in names if not os.path.isdir(n)]
+        if missing:
+            raise IOError('Chip dataset is incomplete -- missing {n} '
+                          'shards'.format(n=len(missing)))
+
+        self.shards = [np.load(os.path.join(n, 'chips.npy'), mmap_mode='r')
+                       for n in names]
+        self.labels = np.concatenate([np.load(os.path.join(n, 'labels.npy'))
+                                      for n in names])
+        self.xy = np.concatenate([np.load(os.path.join(n, 'xy.npy'))
+                                  for n in names])
+
+    def __len__(self):
+        return self.manifest['nchip']
+
+    def __getitem__(self, i):
+        """ Returns chip (time x band x row x column) and label of chip i """
+        if i < 0:
+            i += len(self)
+        shard, j = divmod(i, self.shard_size)
+        return self.shards[shard][j], self.labels[i]
+
+
+def main():
+    args = docopt(__doc__)
+    if args['--verbose']:
+        logger.setLevel(logging.DEBUG)
+
+    if not os.path.exists(args['<samples>']):
+        logger.error('Could not find samples {f}'.format(f=args['<samples>']))
+        sys.exit(1)
+    if not os.path.isdir(args['<location>']):
+        logger.error('{d} is not a directory'.format(d=args['<location>']))
+        sys.exit(1)
+
+    try:
+        bands = None if args['--bands'] == 'all' else \
+            [int(b) for b in args['--bands'].replace(',', ' ').split()]
+        size = int(args['--size'])
+        shard_size = int(args['--shard'])
+        ncpu = int(args['--ncpu'])
+        fill = float(args['--ndv'])
+    except ValueError:
+        logger.error('Bands, size, shard size, number of processes and NoData '
+                     'value must be numbers')
+        sys.exit(1)
+    if fill.is_integer():
+        fill = int(fill)
+
+    chip_dataset(args['<samples>'], args['<location>'], args['<output>'],
+                 stkname=args['--name'], stkdir=args['--dname'],
+                 bands=bands, size=size, label=args['--label'], fill=fill,
+                 shard_size=shard_size, ncpu=ncpu)
+
+
+if __name__ == '__main__':
+    main()
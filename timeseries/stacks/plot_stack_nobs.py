@@ -7,6 +7,7 @@ Usage:
 Options:
     --to=<dir>          Output directory [default: pwd]
     --calc_clear        Calculate clear %
+    --catalog=<file>    Read and store Fmask counts in SQLite catalog
     -h                  Show help
 
 Example:
@@ -42,6 +43,14 @@ from ggplot import *
 
 from osgeo import gdal
 
+# Catalog of Fmask counts is shared with landsat/remove_cloudy.py
+try:
+    from mask_catalog import MaskCatalog, clear_percent, count_mask
+except ImportError:
+    sys.path.append(os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', '..', 'landsat'))
+    from mask_catalog import MaskCatalog, clear_percent, count_mask
+
 # root = '/projectnb/landsat/projects/CMS/stacks/'
 # pattern = 'p*r*'
 # countries = ['Colombia', 'Mexico', 'Peru']
@@ -87,19 +96,19 @@ def plot_year_doy(df, title, palette='RdYlGn'):
            ggtitle(title))
 
 
-def get_clear_pct(stack_img, mask_band=8, ndv=255):
-    """ Returns clear percent of image """
-    # Open dataset and read in mask band
-    ds = gdal.Open(stack_img)
-    mask = ds.GetRasterBand(mask_band).ReadAsArray().astype(np.uint8)
+def get_clear_pct(stack_img, mask_band=8, ndv=255, catalog=None):
+    """ Returns clear percent of image, from a MaskCatalog if given """
+    # Count mask band values, or look them up
+    if catalog is not None:
+        counts = catalog.counts(stack_img, mask_band)
+    else:
+        counts = count_mask(stack_img, mask_band)[0]
     # Return clear percent of non NODATA
-    clear = np.where(mask <= 1)[0].size
-    data = np.where(mask != 255)[0].size
-    return clear / data * 100.0
+    return clear_percent(counts, clear=[0, 1], ndv=ndv)
 
 
 def get_year_doy(location, image_pattern='L*', stack_pattern='L*stack',
-                 calc_clear=False):
+                 calc_clear=False, catalog=None):
     """ Returns dataframe of Landsat ID, year, DOY, and clear percent """
     logger.debug('Finding images')
     # File path to directories
@@ -126,7 +135,7 @@ def get_year_doy(location, image_pattern='L*', stack_pattern='L*stack',
         clear = np.zeros(len(images))
         for i, stack in enumerate(stacks):
             logger.debug('    {i} / {n}'.format(i=i, n=len(images)))
-            clear[i] = get_clear_pct(stack)
+            clear[i] = get_clear_pct(stack, catalog=catalog)
 
         logger.debug('Calculated cloud cover')
 
@@ -158,6 +167,7 @@ if __name__ == '__main__':
     if to == 'pwd':
         to = os.getcwd()
     calc_clear = args['--calc_clear']
+    catalog = MaskCatalog(args['--catalog']) if args['--catalog'] else None
 
     out_plot = os.path.join(to, name + '_nobs_plot.png')
     out_df = os.path.join(to, name + '_df.df')
@@ -165,7 +175,7 @@ if __name__ == '__main__':
     logger.info('Writing output to {f}'.format(f=out_plot))
 
     if not os.path.isfile(out_df):
-        df = get_year_doy(location, calc_clear=calc_clear)
+        df = get_year_doy(location, calc_clear=calc_clear, catalog=catalog)
         try:
             df.to_pickle(out_df)
             df.to_csv(out_csv)
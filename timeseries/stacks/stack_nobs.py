@@ -12,6 +12,10 @@ Options:
     -m --mask <band>        Mask band [default: 8]
     -n --ndv <ndv>          No data value [default: 255]
     -f --format <format>    Output file format [default: GTiff]
+    --years                 Add band counting observations in each year
+    --seasons               Add band counting observations in each season
+    -p --ncpu <n>           Number of processes [default: 1]
+    -b --blocksize <rows>   Number of rows counted at once [default: 1024]
     -v --debug              Show (verbose) debugging messages
     -h --help               Show help
 """
@@ -24,7 +28,9 @@ except ImportError:
     import gdal
     import gdal_array
     
+import datetime as dt
 import fnmatch
+import multiprocessing
 import os
 import sys 
     
@@ -34,10 +40,80 @@ DEBUG = False
 QUIET = False
 
 
-def stack_nobs(location, output, mask_val, mask_band, stkname, stkdir, format):
+SEASONS = ['DJF', 'MAM', 'JJA', 'SON']
+
+
+def stack_date(stack):
+    """
+    Returns date of stack from Landsat ID of its directory or filename
+    """
+    for name in (os.path.basename(os.path.dirname(stack)),
+                 os.path.basename(stack)):
+        try:
+            return dt.datetime.strptime(name[9:16], '%Y%j')
+        except ValueError:
+            pass
+    return None
+
+
+def valid_lut(mask_val, dtype):
+    """
+    Returns boolean lookup table, indexed by mask value minus an offset, that
+    is True for values not in mask_val, and the offset
+
+    Lookup tables are only made for integer data types of 16 bits or less;
+    otherwise returns None, None.
+    """
+    dtype = np.dtype(dtype)
+    if dtype.kind not in 'iu' or dtype.itemsize > 2:
+        return None, None
+    info = np.iinfo(dtype)
+    lut = np.ones(int(info.max) - int(info.min) + 1, dtype=np.bool_)
+    for val in mask_val:
+        if val == int(val) and info.min <= val <= info.max:
+            lut[int(val) - info.min] = False
+    return lut, info.min
+
+
+def _count_block(args):
+    """
+    Returns number of valid observations in one block of rows for each
+    output band, summed over all stacks
+    """
+    (stacks, groups, nbands, mask_val, mask_band, row, nrow, dtype) = args
+
+    nobs = None
+    lut, offset = None, None
+    for stack, group in zip(stacks, groups):
+        src_ds = gdal.Open(stack, gdal.GA_ReadOnly)
+        data = src_ds.GetRasterBand(mask_band).ReadAsArray(
+            0, row, src_ds.RasterXSize, nrow)
+        src_ds = None
+
+        if nobs is None:
+            nobs = np.zeros((nbands, ) + data.shape, dtype=dtype)
+            lut, offset = valid_lut(mask_val, data.dtype)
+        # Mask
+        if lut is not None:
+            mask = lut[data.astype(np.int32) - offset]
+        else:
+            mask = ~np.in1d(data, mask_val).reshape(data.shape)
+        # Add non-zero to nobs
+        for b in group:
+            nobs[b] += mask
+
+    return row, nobs
+
+
+def stack_nobs(location, output, mask_val, mask_band, stkname, stkdir, format,
+               years=False, seasons=False, ncpu=1, block_size=1024):
     """
     Loops through stacks within location building image that stores number of
     valid observations in each pixel.
+
+    Blocks of rows are counted in parallel, summing all stacks within each
+    block. Optionally also counts observations within each year and each
+    season (by month: DJF, MAM, JJA, SON) as additional bands.
     """
     # Find the stacks
     stacks = []
@@ -47,6 +123,7 @@ def stack_nobs(location, output, mask_val, mask_band, stkname, stkdir, format):
             stacks.append(os.path.join(root, f))
     if len(stacks) == 0:
         print 'Error: could not find any stacks in {0}'.format(location)
+        sys.exit(1)
 
     # Determine output data type
     if len(stacks) < 255:
@@ -57,49 +134,81 @@ def stack_nobs(location, output, mask_val, mask_band, stkname, stkdir, format):
         print 'Do you really have {0} stacks?'.format(str(len(stacks)))
         sys.exit(1)
     
-    # Open first stack to get size; create output Nobs image
+    # Open first stack to get size
     ex_ds = gdal.Open(stacks[0], gdal.GA_ReadOnly)
     if ex_ds is None:
-        print 'Error: could not open {img}'.format(stacks[0])
+        print 'Error: could not open {img}'.format(img=stacks[0])
         sys.exit(1)
-    nobs = np.zeros((ex_ds.RasterYSize, ex_ds.RasterXSize), dtype=dtype)
-    
+    shape = (ex_ds.RasterYSize, ex_ds.RasterXSize)
 
-    # Loop through remainder of stacks adding to nobs
+    # Check stacks before counting
     for stack in stacks:
         src_ds = gdal.Open(stack, gdal.GA_ReadOnly)
         if src_ds is None:
             print 'Error: could not open {img}'.format(img=stack)
             sys.exit(1)
-        if (src_ds.RasterYSize, src_ds.RasterXSize) != nobs.shape:
+        if (src_ds.RasterYSize, src_ds.RasterXSize) != shape:
             print 'Error: {img} is not a consistent size'.format(img=stack)
+            sys.exit(1)
         if mask_band > src_ds.RasterCount:
             print 'Error: {img} does not have band {band}'.format(
                 img=stack, band=mask_band)
             sys.exit(1)
-        # Read in
-        data = src_ds.GetRasterBand(mask_band).ReadAsArray()
-        # Mask
-        mask = np.logical_and.reduce([data != val for val in mask_val])
-        # Add non-zero to nobs
-        nobs = nobs + mask
-        # Close dataset
         src_ds = None
-        if not QUIET:
-            print 'Finished image {num}/{total}'.format(
-                num=stacks.index(stack) + 1, total=len(stacks))
+
+    # Output bands each stack adds to
+    names = ['All']
+    groups = [[0] for stack in stacks]
+    if years or seasons:
+        dates = [stack_date(stack) for stack in stacks]
+        if None in dates:
+            print 'Error: could not find date of {img}'.format(
+                img=stacks[dates.index(None)])
+            sys.exit(1)
+    if years:
+        uyears = sorted(set([d.year for d in dates]))
+        for group, d in zip(groups, dates):
+            group.append(len(names) + uyears.index(d.year))
+        names.extend([str(y) for y in uyears])
+    if seasons:
+        for group, d in zip(groups, dates):
+            group.append(len(names) + (d.month % 12) // 3)
+        names.extend(SEASONS)
 
     # Write out nobs
     driver = gdal.GetDriverByName(format)
     dst_ds = driver.Create(output,
-                         ex_ds.RasterXSize, ex_ds.RasterYSize, 1,
+                         ex_ds.RasterXSize, ex_ds.RasterYSize, len(names),
                          gdal_array.NumericTypeCodeToGDALTypeCode(dtype))
     if dst_ds is None:
         print 'Error: could not write to output file {f}'.format(f=output)
         sys.exit(1)
-    dst_ds.GetRasterBand(1).WriteArray(nobs)
     dst_ds.SetProjection(ex_ds.GetProjection())
     dst_ds.SetGeoTransform(ex_ds.GetGeoTransform())
+    for i, name in enumerate(names):
+        dst_ds.GetRasterBand(i + 1).SetDescription(name)
+
+    # Count blocks of rows in parallel
+    jobs = [(stacks, groups, len(names), mask_val, mask_band,
+             row, min(block_size, shape[0] - row), dtype)
+            for row in xrange(0, shape[0], block_size)]
+    if ncpu > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(ncpu)
+        results = pool.imap_unordered(_count_block, jobs)
+    else:
+        pool = None
+        results = (_count_block(job) for job in jobs)
+
+    for i, (row, nobs) in enumerate(results):
+        for b in xrange(len(names)):
+            dst_ds.GetRasterBand(b + 1).WriteArray(nobs[b], 0, row)
+        if not QUIET:
+            print 'Finished block {num}/{total}'.format(
+                num=i + 1, total=len(jobs))
+
+    if pool is not None:
+        pool.close()
+        pool.join()
 
     # Close example and destination datasets
     ex_ds = None
@@ -189,7 +298,17 @@ def main():
 
     gdal.AllRegister()
 
-    stack_nobs(location, output, mask_val, mask_band, stkname, stkdir, format)
+    # Parallel processing
+    try:
+        ncpu = int(arguments['--ncpu'])
+        block_size = int(arguments['--blocksize'])
+    except ValueError:
+        print 'Error: number of processes and block size must be integers'
+        sys.exit(1)
+
+    stack_nobs(location, output, mask_val, mask_band, stkname, stkdir, format,
+               years=arguments['--years'], seasons=arguments['--seasons'],
+               ncpu=ncpu, block_size=block_size)
 
 if __name__ == '__main__':
     arguments = docopt(__doc__)
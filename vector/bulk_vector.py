@@ -0,0 +1,143 @@
+""" Bulk creation of square polygon features with OGR
+
+Builds square polygon geometries for many features at once as Well Known
+Binary (WKB) in NumPy, rather than one ``ogr.Geometry`` point at a time, and
+writes features in batches within transactions. Shared by
+``vector/point2square.py``, ``vector/shuffle_shp.py`` and
+``maps/sample_map.py``.
+
+Drivers with transactions (e.g., "GPKG") are much faster when features are
+written within them. Other drivers, like "ESRI Shapefile" or "FlatGeobuf",
+simply write without transactions.
+"""
+from __future__ import division, print_function
+import logging
+
+import numpy as np
+try:
+    from osgeo import ogr
+except ImportError:
+    import ogr
+
+logger = logging.getLogger(__name__)
+
+# WKB for a polygon with one ring of 5 points (little endian)
+_WKB_POLYGON = np.dtype([
+    ('byte_order', 'u1'),
+    ('geom_type', '<u4'),
+    ('nrings', '<u4'),
+    ('npoints', '<u4'),
+    ('coords', '<f8', (5, 2))
+])
+
+# Corners of a unit square, clockwise from top left, closing the ring
+_UNIT_SQUARE = np.array([[0, 0], [1, 0], [1, 1], [0, 1], [0, 0]],
+                        dtype=np.float64)
+
+
+def polygons_wkb(x, y):
+    """ Return WKB for polygons of one ring of 5 points each
+
+    Args:
+        x (np.ndarray): X coordinates of rings (n x 5)
+        y (np.ndarray): Y coordinates of rings (n x 5)
+
+    Returns:
+        list: WKB ``bytes`` of each polygon
+    """
+    x = np.asarray(x, dtype=np.float64)
+    wkb = np.empty(x.shape[0], dtype=_WKB_POLYGON)
+    wkb['byte_order'] = 1
+    wkb['geom_type'] = ogr.wkbPolygon
+    wkb['nrings'] = 1
+    wkb['npoints'] = 5
+    wkb['coords'][..., 0] = x
+    wkb['coords'][..., 1] = y
+
+    buf = wkb.tobytes()
+    size = _WKB_POLYGON.itemsize
+    return [buf[i:i + size] for i in range(0, len(buf), size)]
+
+
+def pixel_squares_wkb(cols, rows, gt):
+    """ Return WKB of polygons outlining pixels of a raster
+
+    Args:
+        cols (np.ndarray): Pixel columns
+        rows (np.ndarray): Pixel rows
+        gt (tuple): Raster geotransform
+
+    Returns:
+        list: WKB ``bytes`` of each polygon
+    """
+    c = np.asarray(cols, dtype=np.float64)[:, np.newaxis] + _UNIT_SQUARE[:, 0]
+    r = np.asarray(rows, dtype=np.float64)[:, np.newaxis] + _UNIT_SQUARE[:, 1]
+    return polygons_wkb(gt[0] + c * gt[1] + r * gt[2],
+                        gt[3] + c * gt[4] + r * gt[5])
+
+
+def point_squares_wkb(x, y, size, topleft=False):
+    """ Return WKB of squares of a given size around (or from) points
+
+    Args:
+        x (np.ndarray): X coordinates of points
+        y (np.ndarray): Y coordinates of points
+        size (float): Width of squares
+        topleft (bool): Points are top left corner of squares, instead of
+            center
+
+    Returns:
+        list: WKB ``bytes`` of each polygon
+    """
+    offset = _UNIT_SQUARE * size
+    if not topleft:
+        offset = offset - size / 2.0
+    x = np.asarray(x, dtype=np.float64)[:, np.newaxis] + offset[:, 0]
+    y = np.asarray(y, dtype=np.float64)[:, np.newaxis] - offset[:, 1]
+    return polygons_wkb(x, y)
+
+
+def write_features(layer, wkbs, fields=None, sources=None, fids=None,
+                   batch_size=10000):
+    """ Write polygons and attributes to a layer in batched transactions
+
+    Args:
+        layer (ogr.Layer): Layer to write features to
+        wkbs (list): WKB of each feature geometry, or None for no geometry
+        fields (list): Name and sequence of values for fields to set, with
+            None for null values
+        sources (list): Features to copy fields from, if any
+        fids (list): FID of each feature, if any
+        batch_size (int): Number of features written per transaction
+
+    Returns:
+        int: Number of features written
+    """
+    defn = layer.GetLayerDefn()
+    fields = [] if fields is None else \
+        [(defn.GetFieldIndex(name), np.asarray(values).tolist())
+         for name, values in fields]
+
+    n = len(wkbs)
+    for start in range(0, n, batch_size):
+        end = min(start + batch_size, n)
+        in_transaction = layer.StartTransaction() == 0
+        for i in range(start, end):
+            feature = ogr.Feature(defn)
+            if sources is not None:
+                feature.SetFrom(sources[i])
+            if fids is not None:
+                feature.SetFID(int(fids[i]))
+            for idx, values in fields:
+                if values[i] is not None:
+                    feature.SetField(idx, values[i])
+            if wkbs[i] is not None:
+                feature.SetGeometryDirectly(
+                    ogr.CreateGeometryFromWkb(wkbs[i]))
+            layer.CreateFeature(feature)
+        if in_transaction:
+            layer.CommitTransaction()
+        logger.debug('Wrote features {s}-{e} of {n}'.format(
+            s=start, e=end, n=n))
+
+    return n
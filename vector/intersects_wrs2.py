@@ -3,20 +3,46 @@
 
 Usage:
     intersects_wrs2.py [options] <path> <row> <data>
+    intersects_wrs2.py [options] <data>
+    intersects_wrs2.py [options] --batch [<data>...]
 
 Options:
-    --wrs2_file             Override location of WRS-2 file
+    --wrs2_file <file>      Override location of WRS-2 file
+    --cache <file>          Cache WRS-2 footprints in NumPy file for reuse
     --a_srs <EPSG>          Override test data CRS with EPSG code
+    --batch                 Write table of WRS-2 intersections of many data
+    --list <file>           File listing data to test in batch, one per line
+    -o --output <file>      Batch output CSV file [default: stdout]
+    -p --ncpu <n>           Number of processes for batch extents [default: 1]
     -q --quiet              Surpress printing of answer
     -v --verbose            Print verbose debugging messages
     -h --help               Print help screen
-    
+
+Without a path and row, prints the path and row of each WRS-2 footprint the
+data intersects.
+
+WRS-2 descending footprints are read once into an index of their geometries
+and bounding boxes. With "--cache", the index is saved to (or loaded from, if
+newer than the WRS-2 file) a compact NumPy file so later runs do not read
+the shapefile at all.
+
+In batch mode, each data (rasters or vector datasources, given as paths or
+wildcard patterns, or listed in "--list") is opened and its extent
+reprojected in parallel, and a CSV table of "data,path,row" is written with
+a line for each WRS-2 footprint each data intersects (or empty path and row
+if none). Footprints are found using a Sort-Tile-Recursive (STR) packed
+R-tree of their bounding boxes.
+
 """
 
+import csv
+import glob
+import multiprocessing
 import os
 import sys
 
 from docopt import docopt
+import numpy as np
 
 try:
     from osgeo import gdal, ogr, osr
@@ -30,6 +56,9 @@ wrs2_file = '/projectnb/landsat/datasets/WRS-2/wrs2_descending.shp'
 QUIET = False
 VERBOSE = False
 
+# Points along each edge of test extent when reprojecting
+DENSIFY = 10
+
 def gdal_get_extent(ds):
     """ Uses input data's GDAL dataset to calculate extent within
     its projection
@@ -64,29 +93,295 @@ def gdal_get_extent(ds):
     return (ext, ext_srs)
     
 def ogr_get_extent(data_ds):
-    raise NotImplementedError
+    """ Uses input data's OGR datasource to calculate extent of all layers
+    within the projection of the first layer
+
+    Input:
+        data_ds         Test data OGR datasource
+
+    Returns:
+        extent          coordinates of each corner
+        proj            projection of input data
+    """
+    ext_srs = None
+    bounds = []
+    for i in range(data_ds.GetLayerCount()):
+        layer = data_ds.GetLayer(i)
+        if layer.GetFeatureCount() == 0:
+            continue
+        minx, maxx, miny, maxy = layer.GetExtent()
+        corners = [[minx, maxy], [minx, miny], [maxx, miny], [maxx, maxy]]
+
+        srs = layer.GetSpatialRef()
+        if srs is not None:
+            # Keep after datasource is closed
+            srs = srs.Clone()
+        if ext_srs is None:
+            ext_srs = srs
+        elif srs is not None and not srs.IsSame(ext_srs):
+            corners = reproj_coord(densify(corners), srs, ext_srs)
+        bounds.append(corners)
+
+    if not bounds:
+        raise ValueError('No features in any layer')
+
+    bounds = np.concatenate([np.asarray(b) for b in bounds])
+    minx, miny = bounds.min(axis=0)
+    maxx, maxy = bounds.max(axis=0)
+    ext = [[minx, maxy], [minx, miny], [maxx, miny], [maxx, maxy]]
+    return (ext, ext_srs)
+
+def open_extent(data, ext_srs=None):
+    """ Returns extent and projection of raster or vector data
+
+    Input:
+        data            Test data filename
+        ext_srs         Override projection of test data, if given
+
+    Returns:
+        extent          coordinates of each corner
+        proj            projection of input data
+    """
+    gdal.UseExceptions()
+    try:
+        data_ds = gdal.Open(data, gdal.GA_ReadOnly)
+        ext, srs = gdal_get_extent(data_ds)
+    except RuntimeError:
+        data_ds = ogr.Open(data, gdal.GA_ReadOnly)
+        if data_ds is None:
+            raise ValueError('Cannot open data with GDAL or OGR')
+        ext, srs = ogr_get_extent(data_ds)
+    data_ds = None
+
+    if ext_srs is None:
+        if srs is None:
+            raise ValueError('Data has no projection')
+        ext_srs = srs
+    return (ext, ext_srs)
+
+def traditional_order(srs):
+    """ Use X/Y (longitude/latitude) axis order for GDAL >= 3 """
+    if hasattr(srs, 'SetAxisMappingStrategy'):
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+def densify(coord, n=DENSIFY):
+    """ Returns ring of coordinates with n points along each edge
+    """
+    coord = np.asarray(coord, dtype=np.float64)
+    start = coord
+    end = np.roll(coord, -1, axis=0)
+    f = np.arange(n, dtype=np.float64)[:, np.newaxis, np.newaxis] / n
+    # Points along each edge, ordered edge by edge
+    ring = (start + f * (end - start)).transpose(1, 0, 2).reshape(-1, 2)
+    return ring.tolist()
 
 def reproj_coord(coord, s_srs, t_srs):
-    """ Reprojects coordinates into targeted projection
+    """ Reprojects coordinates into targeted projection, all at once
     """
-    transform = osr.CoordinateTransformation(s_srs, t_srs)
+    transform = osr.CoordinateTransformation(traditional_order(s_srs),
+                                             traditional_order(t_srs))
 
-    t_coord = []
+    try:
+        t_coord = transform.TransformPoints([(x, y) for x, y in coord])
+    except:
+        raise ValueError('Could not transform coordinates\n'
+                         'Source: ' + str(s_srs) + '\n'
+                         'Dest: ' + str(t_srs))
 
-    for x, y in coord:
-        try:
-            x, y, z = transform.TransformPoint(x, y, 0)
-        except:
-            print 'Could not transform coordinates'
-            print 'Source: ' + str(s_srs)
-            print 'Dest: ' + str(t_srs)
-            print 'X: ' + str(x) + ' Y: ' + str(y)
-            sys.exit(-1)
-        t_coord.append([x, y])
-    
-    return t_coord
+    return [[x, y] for x, y, z in t_coord]
+
+def extent_geometry(ext, ext_srs, t_srs):
+    """ Returns polygon of test extent reprojected into targeted projection
+    """
+    t_ext = reproj_coord(densify(ext), ext_srs, t_srs)
+
+    ring = ogr.Geometry(ogr.wkbLinearRing)
+    for e in t_ext:
+        ring.AddPoint_2D(e[0], e[1])
+    ring.CloseRings()
+
+    t_geom = ogr.Geometry(ogr.wkbPolygon)
+    t_geom.AddGeometryDirectly(ring)
+    t_geom.AssignSpatialReference(t_srs)
+
+    return t_geom
+
+class STRtree(object):
+    """ Sort-Tile-Recursive packed R-tree of bounding boxes
+
+    Boxes are sorted into vertical slices by the X of their centers, and
+    within each slice by the Y of their centers, and packed into leaves of
+    `capacity` boxes. Each higher level packs consecutive nodes of the level
+    below, so the children of node i are nodes i * capacity to
+    (i + 1) * capacity - 1.
+
+    Attributes:
+        order           index of box at each leaf entry
+        levels          bounds of entries (level 0) and of nodes at each
+                        level above
+    """
+
+    def __init__(self, bounds, capacity=10):
+        bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        self.capacity = capacity
+
+        # Sort into slices by X, then by Y within slices
+        n = len(bounds)
+        cx = (bounds[:, 0] + bounds[:, 1]) / 2.0
+        cy = (bounds[:, 2] + bounds[:, 3]) / 2.0
+        nleaf = -(-n // capacity)
+        slice_size = capacity * int(np.ceil(np.sqrt(nleaf)))
+        order = np.argsort(cx, kind='mergesort')
+        slices = np.arange(n) // slice_size
+        self.order = order[np.lexsort((cy[order], slices))]
+
+        self.levels = [bounds[self.order]]
+        while len(self.levels[-1]) > capacity:
+            b = self.levels[-1]
+            starts = np.arange(0, len(b), capacity)
+            self.levels.append(np.column_stack([
+                np.minimum.reduceat(b[:, 0], starts),
+                np.maximum.reduceat(b[:, 1], starts),
+                np.minimum.reduceat(b[:, 2], starts),
+                np.maximum.reduceat(b[:, 3], starts)
+            ]))
+
+    def query(self, bounds):
+        """ Returns sorted indexes of boxes intersecting bounds (minimum X,
+        maximum X, minimum Y, maximum Y)
+        """
+        nodes = np.arange(len(self.levels[-1]))
+        for level in range(len(self.levels) - 1, -1, -1):
+            b = self.levels[level][nodes]
+            nodes = nodes[(b[:, 0] <= bounds[1]) & (b[:, 1] >= bounds[0]) &
+                          (b[:, 2] <= bounds[3]) & (b[:, 3] >= bounds[2])]
+            if level > 0:
+                nodes = (nodes[:, np.newaxis] * self.capacity +
+                         np.arange(self.capacity)).ravel()
+                nodes = nodes[nodes < len(self.levels[level - 1])]
+        return np.sort(self.order[nodes])
+
+class WRS2Index(object):
+    """ WRS-2 descending footprints and their bounding boxes
+
+    Footprints are tested for intersection by bounding box first, using an
+    STR-tree, and then by geometry for those bounding boxes that intersect.
+
+    Attributes:
+        path            WRS-2 path of each footprint
+        row             WRS-2 row of each footprint
+        bounds          minimum X, maximum X, minimum Y, maximum Y of each
+                        footprint
+        wkb             WKB geometry of each footprint
+        srs             spatial reference system of footprints
+    """
+
+    def __init__(self, path, row, bounds, wkb, srs_wkt):
+        self.path = np.asarray(path, dtype=np.int32)
+        self.row = np.asarray(row, dtype=np.int32)
+        self.bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+        self.wkb = list(wkb)
+        self.srs = traditional_order(osr.SpatialReference())
+        self.srs.ImportFromWkt(srs_wkt)
+        self._geoms = {}
+        self.tree = STRtree(self.bounds)
+
+    @classmethod
+    def from_shapefile(cls, filename):
+        """ Read descending footprints from WRS-2 shapefile
+        """
+        wrs2 = ogr.Open(filename)
+        if wrs2 is None:
+            raise IOError('Could not open WRS-2 shapefile {f}'.format(
+                f=filename))
+        layer = wrs2.GetLayer()
+        layer.SetAttributeFilter("MODE = 'D'")
+
+        path, row, bounds, wkb = [], [], [], []
+        for feat in layer:
+            geom = feat.GetGeometryRef()
+            path.append(feat.GetFieldAsInteger('PATH'))
+            row.append(feat.GetFieldAsInteger('ROW'))
+            bounds.append(geom.GetEnvelope())
+            wkb.append(bytes(geom.ExportToWkb()))
+
+        return cls(path, row, bounds, wkb, layer.GetSpatialRef().ExportToWkt())
+
+    @classmethod
+    def load(cls, filename, cache=None):
+        """ Load footprints from cache if newer than WRS-2 shapefile, or read
+        them from the shapefile, saving them to the cache if given
+        """
+        if (cache is not None and os.path.isfile(cache) and
+                (not os.path.isfile(filename) or
+                 os.path.getmtime(cache) >= os.path.getmtime(filename))):
+            z = np.load(cache)
+            wkb = z['wkb'].tobytes()
+            offsets = z['offsets']
+            return cls(z['path'], z['row'], z['bounds'],
+                       [wkb[i:j] for i, j in zip(offsets[:-1], offsets[1:])],
+                       str(z['srs']))
+
+        index = cls.from_shapefile(filename)
+        if cache is not None:
+            index.save(cache)
+        return index
+
+    def save(self, cache):
+        """ Save footprints to a NumPy file
+        """
+        offsets = np.cumsum([0] + [len(w) for w in self.wkb])
+        with open(cache, 'wb') as f:
+            np.savez(f,
+                     path=self.path, row=self.row, bounds=self.bounds,
+                     wkb=np.frombuffer(b''.join(self.wkb), dtype=np.uint8),
+                     offsets=offsets, srs=np.array(self.srs.ExportToWkt()))
+
+    def geometry(self, i):
+        """ Returns geometry of footprint i
+        """
+        if i not in self._geoms:
+            self._geoms[i] = ogr.CreateGeometryFromWkb(self.wkb[i])
+        return self._geoms[i]
+
+    def find(self, path, row):
+        """ Returns index of footprint for path and row, or None
+        """
+        i = np.flatnonzero((self.path == path) & (self.row == row))
+        return int(i[0]) if i.size else None
+
+    def candidates(self, bounds):
+        """ Returns indexes of footprints whose bounding box intersects
+        bounds (minimum X, maximum X, minimum Y, maximum Y)
+        """
+        return self.tree.query(bounds)
+
+    def intersecting(self, geom):
+        """ Returns list of (path, row) of footprints intersecting geometry
+        in the footprints' spatial reference system
+        """
+        return [(int(self.path[i]), int(self.row[i]))
+                for i in self.candidates(geom.GetEnvelope())
+                if self.geometry(i).Intersects(geom)]
+
+    def intersects(self, geom, path, row):
+        """ Returns True if geometry intersects footprint of path and row
+        """
+        return (path, row) in self.intersecting(geom)
+
+def load_index(cache=None):
+    """ Returns WRS-2 index, exiting with an error if it cannot be loaded
+    """
+    try:
+        return WRS2Index.load(wrs2_file, cache=cache)
+    except (IOError, RuntimeError):
+        print 'Error: could not open WRS-2 shapefile'
+        print '    Location: %s' % str(wrs2_file)
+        print 'Please redefine using --wrs2_file option'
+        sys.exit(-1)
 
-def test_intersect(path, row, ext, ext_srs):
+def test_intersect(path, row, ext, ext_srs, index=None):
     """ Returns True (1) or False (0) if test extent intersects WRS-2 
     path and row footprint
 
@@ -95,65 +390,160 @@ def test_intersect(path, row, ext, ext_srs):
         row             WRS-2 row
         ext             test extent
         ext_srs         test extent's spatial reference system
+        index           WRS2Index of footprints, loaded if not given
     
     Returns:
         1               True
         0               False
     """
-    # Read in WRS-2 path/row
-    wrs2 = ogr.Open(wrs2_file)
-    if wrs2 is None:
-        print 'Error: could not open WRS-2 shapefile'
-        print '    Location: %s' % str(wrs2_file)
-        print 'Please redefine using --wrs2_file option'
-        sys.exit(-1)
-    
-    # Open layer
-    layer = wrs2.GetLayer()
-    if layer is None:
-        print 'Error opening layer'
-        sys.exit(-1)
+    if index is None:
+        index = load_index()
 
-    # Find correct feature
-    found = False
-    for feat in layer:
-        if (feat.GetFieldAsInteger('PATH') == path and
-            feat.GetFieldAsInteger('ROW') == row and
-            feat.GetFieldAsString('MODE') == 'D'):
-            found = True
-            break
-    if found is False:
+    # Find correct footprint
+    i = index.find(path, row)
+    if i is None:
         print 'Error: could not find path/row specified in WRS-2 shapefile'
         sys.exit(-1)
 
-    # Grab the geometry from the chosen feature
-    f_geom = feat.GetGeometryRef()
+    # Create geometry from reprojected test extent
+    t_geom = extent_geometry(ext, ext_srs, index.srs)
 
-    # Identify WRS-2 file spatial ref system & reproject test extent
-    t_srs = layer.GetSpatialRef()
-    t_ext = reproj_coord(ext, ext_srs, t_srs)
+    # Test for intersection
+    return int(index.geometry(i).Intersects(t_geom))
 
-    # Create geometry from reprojected test extent
-    ring = ogr.Geometry(ogr.wkbLinearRing)
-    for e in t_ext:
-        ring.AddPoint(e[0], e[1])
-    ring.CloseRings()
+def find_intersect(ext, ext_srs, index=None):
+    """ Returns list of (path, row) of WRS-2 footprints intersecting test
+    extent
 
-    t_geom = ogr.Geometry(ogr.wkbPolygon)
-    t_geom.AddGeometryDirectly(ring)
-    
-    t_geom.AssignSpatialReference(t_srs)
+    Input:
+        ext             test extent
+        ext_srs         test extent's spatial reference system
+        index           WRS2Index of footprints, loaded if not given
 
-    # Test for intersection
-    return f_geom.Intersect(t_geom)
+    Returns:
+        list            (path, row) of each footprint
+    """
+    if index is None:
+        index = load_index()
+
+    return index.intersecting(extent_geometry(ext, ext_srs, index.srs))
+
+
+def _data_geometry(job):
+    """ Returns data, WKB of its extent in target projection, and any error
+    """
+    data, epsg, t_wkt = job
+    try:
+        ext_srs = None
+        if epsg is not None:
+            ext_srs = osr.SpatialReference()
+            ext_srs.ImportFromEPSG(epsg)
+        ext, ext_srs = open_extent(data, ext_srs)
+
+        t_srs = osr.SpatialReference()
+        t_srs.ImportFromWkt(t_wkt)
+        t_geom = extent_geometry(ext, ext_srs, t_srs)
+    except Exception as e:
+        return data, None, str(e)
+
+    return data, bytes(t_geom.ExportToWkb()), None
+
+def batch_intersect(datasets, index, epsg=None, ncpu=1):
+    """ Yields WRS-2 footprints intersecting each of many data
+
+    Input:
+        datasets        Test data filenames
+        index           WRS2Index of footprints
+        epsg            Override test data CRS with EPSG code
+        ncpu            Number of processes opening data
+
+    Yields:
+        data            Test data filename
+        found           list of (path, row) of each footprint
+        error           Error opening data, or None
+    """
+    jobs = [(data, epsg, index.srs.ExportToWkt()) for data in datasets]
+    if ncpu > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(ncpu)
+        results = pool.imap(_data_geometry, jobs)
+    else:
+        pool = None
+        results = (_data_geometry(job) for job in jobs)
+
+    for data, wkb, error in results:
+        if error is not None:
+            yield data, [], error
+        else:
+            yield data, index.intersecting(ogr.CreateGeometryFromWkb(wkb)), \
+                None
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+def find_data(patterns, list_file=None):
+    """ Returns data matching each pattern and listed within file
+    """
+    datasets = []
+    if list_file is not None:
+        with open(list_file) as f:
+            patterns = patterns + [l.strip() for l in f if l.strip()]
+    for pattern in patterns:
+        # Keep data that are not files (e.g., database connections)
+        datasets.extend(sorted(glob.glob(pattern)) or [pattern])
+    return datasets
+
+def batch_main(index, epsg):
+    """ Writes table of WRS-2 footprints intersecting each of many data
+    """
+    datasets = find_data(args['<data>'], args['--list'])
+    if not datasets:
+        print 'Error: no data to test'
+        sys.exit(-1)
+    try:
+        ncpu = int(args['--ncpu'])
+    except ValueError:
+        print 'Error: number of processes must be an integer'
+        sys.exit(-1)
 
+    output = args['--output']
+    f = sys.stdout if output == 'stdout' else open(output, 'wb')
+    writer = csv.writer(f)
+    writer.writerow(['data', 'path', 'row'])
+
+    nerror = 0
+    for data, found, error in batch_intersect(datasets, index, epsg, ncpu):
+        if error is not None:
+            sys.stderr.write('Error: {d}: {e}\n'.format(d=data, e=error))
+            nerror += 1
+        if not found:
+            writer.writerow([data, '', ''])
+        for p, r in found:
+            writer.writerow([data, p, r])
+        if VERBOSE:
+            sys.stderr.write('{d}: {n} path/rows\n'.format(d=data,
+                                                            n=len(found)))
+
+    if f is not sys.stdout:
+        f.close()
+
+    return int(nerror > 0)
 
 def main():
     """ Main function that processes input
     """
-    path = int(args['<path>'])
-    row = int(args['<row>'])
-    data = args['<data>']
+    global wrs2_file
+    if args['--wrs2_file'] is not None:
+        wrs2_file = args['--wrs2_file']
+
+    if args['--batch']:
+        epsg = int(args['--a_srs']) if args['--a_srs'] is not None else None
+        return batch_main(load_index(cache=args['--cache']), epsg)
+
+    path, row = args['<path>'], args['<row>']
+    if path is not None:
+        path, row = int(path), int(row)
+    data = args['<data>'][0]
     print data
 
     ext_srs = None
@@ -164,34 +554,30 @@ def main():
             print 'Error: could not process EPSG override into a valid CS'
             sys.exit(-1)
 
-    # Try opening as GDAL or OGR data
+    # Open as GDAL or OGR data and define the extent to be tested
     gdal.AllRegister()
-    gdal.UseExceptions()
-    
     try:
-        data_ds = gdal.Open(data, gdal.GA_ReadOnly)
-        type = 'GDAL'
-    except:
-        try:
-            data_ds = ogr.Open(data, gdal.GA_ReadOnly)
-            type = 'OGR'
-        except:
-            print 'Error: cannot open data with GDAL or OGR'
-            sys.exit(-1)
+        ext, ext_srs = open_extent(data, ext_srs)
+    except (ValueError, RuntimeError) as e:
+        print 'Error: {e}'.format(e=e)
+        sys.exit(-1)
 
-    # Define the extent to be tested
-    if type == 'GDAL':
-        if ext_srs is None:
-            ext, ext_srs = gdal_get_extent(data_ds)
-        else:
-            ext, _ignore = gdal_get_extent(data_ds)
-    elif type == 'OGR':
-        if ext_srs is None:
-            ext, ext_srs = ogr_get_extent(data_ds)
+    index = load_index(cache=args['--cache'])
+
+    try:
+        if path is None:
+            found = find_intersect(ext, ext_srs, index)
         else:
-            ext, _ignore = ogr_get_extent(data_ds)
+            ans = test_intersect(path, row, ext, ext_srs, index)
+    except ValueError as e:
+        print e
+        sys.exit(-1)
 
-    ans = test_intersect(path, row, ext, ext_srs)
+    if path is None:
+        if not QUIET:
+            for p, r in found:
+                print '{p:03d}{r:03d}'.format(p=p, r=r)
+        return int(len(found) > 0)
 
     if not QUIET:
         print 'Intersect?: ' + str(ans)
@@ -205,4 +591,6 @@ if __name__ == '__main__':
     #           False       0
     if args['--quiet']:
         QUIET = True
+    if args['--verbose']:
+        VERBOSE = True
     sys.exit(main())
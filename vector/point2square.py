@@ -6,7 +6,8 @@ Usage:
 
 Options:
     --overwrite             Allow overwrite of output?
-    -f --format=format      Output format [default: ESRI Shapefile]
+    -f --format=format      Output format (e.g., GPKG, FlatGeobuf)
+                                [default: ESRI Shapefile]
     -q --quiet              Surpress printing of answer
     -v --verbose            Print verbose debugging messages
     -h --help               Print help screen
@@ -22,6 +23,8 @@ try:
 except:
     import ogr
 
+from bulk_vector import point_squares_wkb, write_features
+
 # Make stdout unbuffered
 sys.stdout = os.fdopen(sys.stdout.fileno(), 'w', 0)
 
@@ -42,16 +45,12 @@ http://stackoverflow.com/questions/3002085/python-to-print-out-status-bar-and-pe
     sys.stdout.write("[ %s ] %.2f%%" % (progress, percent * 100))
     sys.stdout.flush()
 
-def point2square(size, input, output, topleft, format):
+def point2square(size, input, output, topleft, format, batch_size=10000):
     """
+    Writes squares around (or from the top left of) each input point,
+    building geometries for a batch of points at once and writing each batch
+    within a transaction
     """
-    # Configure corners
-    if topleft is True:
-        corners = [(0, 0), (size, 0), (size, -size), (0, -size), (0, 0)]
-    elif topleft is False:
-        hs = size / 2.0
-        corners = [(-hs, hs), (hs, hs), (hs, -hs), (-hs, -hs), (-hs, hs)]
-
     # Open & get layer
     in_ds = ogr.Open(input)
     if in_ds is None:
@@ -81,47 +80,37 @@ def point2square(size, input, output, topleft, format):
         if result != 0:
             print 'Error: cannot create field {0}'.format(defn.GetName())
             sys.exit(1)
-    fields = [f.GetName() for f in featDefn]
 
     # Setup progress bar
     if VERBOSE:
         n_feat = in_layer.GetFeatureCount()
         i = 0.0
 
-    # Populate fields
+    def write_batch(batch):
+        points = [f.GetGeometryRef().GetPoint_2D() for f in batch]
+        x, y = zip(*points)
+        wkbs = point_squares_wkb(x, y, size, topleft=topleft)
+        write_features(out_layer, wkbs, sources=batch,
+                       fids=[f.GetFID() for f in batch],
+                       batch_size=batch_size)
+
+    # Populate fields and geometry in batches of features
+    batch = []
     for in_feat in in_layer:
-        # Progress
-        if VERBOSE:
-            drawProgressBar(i / n_feat)
-            i += 1.0
-
-        # Setup new feature
-        out_feat = ogr.Feature(in_layer.GetLayerDefn())
-        out_feat.SetFID(in_feat.GetFID())
-        
-        # Add fields and populate
-        for f in fields:
-            out_feat.SetField(f, in_feat.GetField(f))
-
-        # Setup geometry
-        point = in_feat.GetGeometryRef().GetPoint_2D()
-        ring = ogr.Geometry(type=ogr.wkbLinearRing)
-        for corner in corners:
-            ring.AddPoint(corner[0] + point[0], 
-                          corner[1] + point[1])
-        poly = ogr.Geometry(type=ogr.wkbPolygon)
-        poly.AddGeometry(ring)
-
-        # Set geometry for out_feat
-        out_feat.SetGeometry(poly)
-        
-        # Add feature to layer
-        out_layer.CreateFeature(out_feat)
-
-        # Flush memory of feature
-        out_feat.Destroy()
+        batch.append(in_feat)
+        if len(batch) == batch_size:
+            write_batch(batch)
+            batch = []
+
+            # Progress
+            if VERBOSE:
+                i += batch_size
+                drawProgressBar(i / n_feat)
+    if batch:
+        write_batch(batch)
 
     if VERBOSE:
+        drawProgressBar(1.0)
         print ''
         print 'Done processing all features from input layer'
 
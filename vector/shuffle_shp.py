@@ -1,57 +1,283 @@
 #!/usr/bin/env python
-"""
+""" Shuffles the order of features in a vector layer
+
+Usage:
+    shuffle_shp.py [options] <input> <output>
+
+Options:
+    --seed <seed>           Random seed for a reproducible shuffle
+    --strata <field>        Interleave features stratified by field
+    --buckets <n>           Shuffle through n temporary files on disk instead
+                                of in memory [default: 1]
+    --tmpdir <dir>          Directory for temporary files
+    --batch <n>             Features written per transaction [default: 10000]
+    --overwrite             Allow overwrite of output?
+    -f --format=format      Output format (e.g., GPKG, FlatGeobuf)
+                                [default: ESRI Shapefile]
+    -v --verbose            Print verbose debugging messages
+    -h --help               Print help screen
+
+Features are read once, in order, and written in a random order to a new
+layer. With "--strata", features of each stratum are shuffled and then
+interleaved so that any run of output features holds each stratum roughly in
+proportion to its size.
+
+For layers too large to shuffle in memory, "--buckets" first reads only the
+stratum field (if any) to decide the output order, then spills features into
+temporary files, each holding a consecutive range of the output, and writes
+each file in order.
+
 """
 import os
 import sys
-import random
+import tempfile
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+from docopt import docopt
+import numpy as np
+
+try:
+    from osgeo import ogr
+except:
+    import ogr
+
+from bulk_vector import write_features
+
+VERBOSE = False
+
+
+def shuffle_order(n, strata=None, seed=None):
+    """ Returns input index of each output feature
+
+    Args:
+        n (int): Number of features
+        strata (np.ndarray): Stratum of each feature, if stratified
+        seed (int): Random seed
+
+    Returns:
+        np.ndarray: Index of input feature at each output position
+    """
+    rng = np.random.RandomState(seed)
+    if strata is None:
+        return rng.permutation(n)
+
+    # Shuffle within strata, interleaving strata by rank within stratum
+    strata = np.asarray(strata)
+    key = np.empty(n, dtype=np.float64)
+    for stratum in np.unique(strata):
+        idx = np.flatnonzero(strata == stratum)
+        key[idx] = (rng.permutation(idx.size) +
+                    rng.uniform(size=idx.size)) / idx.size
+    return np.argsort(key, kind='mergesort')
+
+
+def read_features(layer):
+    """ Yields WKB geometry and field values of each feature, in order """
+    nfield = layer.GetLayerDefn().GetFieldCount()
+    layer.ResetReading()
+    for feat in layer:
+        geom = feat.GetGeometryRef()
+        yield (bytes(geom.ExportToWkb()) if geom is not None else None,
+               [feat.GetField(i) if feat.IsFieldSet(i) else None
+                for i in range(nfield)])
+
+
+def read_strata(layer, field):
+    """ Returns values of a field for each feature, reading no geometry """
+    defn = layer.GetLayerDefn()
+    idx = defn.GetFieldIndex(field)
+    layer.SetIgnoredFields(
+        ['OGR_GEOMETRY', 'OGR_STYLE'] +
+        [defn.GetFieldDefn(i).GetName()
+         for i in range(defn.GetFieldCount()) if i != idx])
+    layer.ResetReading()
+    strata = [feat.GetField(idx) for feat in layer]
+    layer.SetIgnoredFields([])
+    return np.array(strata)
+
+
+def count_features(layer):
+    """ Returns number of features read from layer, reading no fields or
+    geometry
+
+    Unlike ``GetFeatureCount``, this does not count records deleted but not
+    packed from shapefiles.
+    """
+    defn = layer.GetLayerDefn()
+    layer.SetIgnoredFields(
+        ['OGR_GEOMETRY', 'OGR_STYLE'] +
+        [defn.GetFieldDefn(i).GetName() for i in range(defn.GetFieldCount())])
+    layer.ResetReading()
+    n = sum(1 for feat in layer)
+    layer.SetIgnoredFields([])
+    return n
+
+
+def write_buffer(layer, buffer, names, batch_size):
+    """ Writes list of WKB geometry and field values of features """
+    wkbs = [wkb for wkb, _ in buffer]
+    fields = [(name, [values[i] for _, values in buffer])
+              for i, name in enumerate(names)]
+    return write_features(layer, wkbs, fields=fields, batch_size=batch_size)
+
+
+def shuffle_shp(input, output, format, seed=None, strata=None, buckets=1,
+                tmpdir=None, batch_size=10000):
+    """ Writes features of input layer to output in random order
+
+    Args:
+        input (str): Input vector filename
+        output (str): Output vector filename
+        format (str): OGR driver of output
+        seed (int): Random seed
+        strata (str): Field to stratify shuffle by, if any
+        buckets (int): Number of temporary files to shuffle through, or 1 to
+            shuffle in memory
+        tmpdir (str): Directory for temporary files
+        batch_size (int): Features written per transaction
+    """
+    in_ds = ogr.Open(input)
+    if in_ds is None:
+        print 'Error: could not open input file'
+        sys.exit(1)
+    in_layer = in_ds.GetLayer()
+    in_defn = in_layer.GetLayerDefn()
+    names = [in_defn.GetFieldDefn(i).GetName()
+             for i in range(in_defn.GetFieldCount())]
+    if strata is not None and strata not in names:
+        print 'Error: input layer has no field {f}'.format(f=strata)
+        sys.exit(1)
+
+    # Create output
+    driver = ogr.GetDriverByName(format)
+    out_ds = driver.CreateDataSource(output)
+    if out_ds is None:
+        print 'Error: could not create output file'
+        sys.exit(1)
+    out_layer = out_ds.CreateLayer(in_layer.GetName(),
+                                   in_layer.GetSpatialRef(),
+                                   in_defn.GetGeomType())
+    for i in range(in_defn.GetFieldCount()):
+        if out_layer.CreateField(in_defn.GetFieldDefn(i)) != 0:
+            print 'Error: cannot create field {0}'.format(names[i])
+            sys.exit(1)
 
-from osgeo import ogr
+    if buckets <= 1:
+        # Read all features into memory and write in shuffled order
+        buffer = list(read_features(in_layer))
+        nread = len(buffer)
+        values = None
+        if strata is not None:
+            values = np.array([v[names.index(strata)] for _, v in buffer])
+        order = shuffle_order(nread, values, seed)
+        if VERBOSE:
+            print 'Read {n} features - writing'.format(n=nread)
+        n = write_buffer(out_layer, [buffer[i] for i in order], names,
+                         batch_size)
+    else:
+        # Output position of each input feature, counted from a first pass
+        if strata is not None:
+            values = read_strata(in_layer, strata)
+            nread = len(values)
+        else:
+            values = None
+            nread = count_features(in_layer)
+        order = shuffle_order(nread, values, seed)
+        position = np.empty(nread, dtype=np.int64)
+        position[order] = np.arange(nread)
 
-def gen_random(l):
-    in_id = range(l.GetFeatureCount())
+        # Spill features to the file holding their range of the output
+        files = [tempfile.TemporaryFile(dir=tmpdir) for _ in range(buckets)]
+        nspill = 0
+        for feature in read_features(in_layer):
+            if nspill == nread:
+                print 'Error: input layer has more features than first ' \
+                    'read ({n})'.format(n=nread)
+                sys.exit(1)
+            pickle.dump((int(position[nspill]), feature),
+                        files[position[nspill] * buckets // nread],
+                        pickle.HIGHEST_PROTOCOL)
+            nspill += 1
+        if nspill != nread:
+            print 'Error: input layer has fewer features ({s}) than first ' \
+                'read ({n})'.format(s=nspill, n=nread)
+            sys.exit(1)
+        if VERBOSE:
+            print 'Spilled {n} features to {b} files'.format(n=nread,
+                                                             b=buckets)
 
-    out_id = random.sample(range(min(in_id), max(in_id) + 1), len(in_id))
-    
-    assert len(in_id) == len(out_id), \
-            'Error: input and output features disagree'
+        n = 0
+        for f in files:
+            f.seek(0)
+            buffer = []
+            while True:
+                try:
+                    buffer.append(pickle.load(f))
+                except EOFError:
+                    break
+            f.close()
+            buffer.sort(key=lambda b: b[0])
+            n += write_buffer(out_layer, [b[1] for b in buffer], names,
+                              batch_size)
+            if VERBOSE:
+                print 'Wrote {n} features'.format(n=n)
 
-    return (in_id, out_id)
+    if n != nread:
+        print 'Error: input feature count does not match output feature count'
+        sys.exit(1)
 
-shp = '/projectnb/landsat/projects/IDS/ceholden/LC_MAP/Audubon/sample/prep/2014_01_23_audubon_sample_sq_attr_wrs2.shp'
-out = '/projectnb/landsat/projects/IDS/ceholden/LC_MAP/Audubon/sample/2014_01_23_audubon_sample.shp'
+    out_ds = None
+    in_ds = None
 
-# OPEN shp file to be shuffled
-in_ds = ogr.Open(shp)
-l = in_ds.GetLayer()
 
-# Get random order of FIDs
-in_id, out_id = gen_random(l)
+def main():
+    """ Main function that processes input
+    """
+    input = arguments['<input>']
+    if not os.path.exists(input):
+        print 'Error: could not find input file {0}'.format(input)
+        sys.exit(1)
 
-# CREATE output shuffled shp file dataset
-driver = ogr.GetDriverByName('ESRI Shapefile')
-out_ds = driver.CreateDataSource(out)
+    output = arguments['<output>']
+    if os.path.dirname(output) == '':
+        output = './' + output
+    if os.path.exists(output) and arguments['--overwrite']:
+        print 'Output layer exists - overwriting'
+        try:
+            ds = ogr.Open(output)
+            driver = ds.GetDriver()
+            driver.DeleteDataSource(output)
+        except:
+            print 'Error: could not overwrite existing output file'
+            sys.exit(1)
+    elif os.path.exists(output) and not arguments['--overwrite']:
+        print 'Error: output file already exists. Specify "--overwrite"'
+        sys.exit(1)
 
-# Create output layer
-d_l = out_ds.CreateLayer(l.GetName(),
-                     l.GetSpatialRef(),
-                     l.GetLayerDefn().GetGeomType())
-# Setup fields
-for i in range(l.GetLayerDefn().GetFieldCount()):
-    d_l.CreateField(l.GetLayerDefn().GetFieldDefn(i))
+    try:
+        seed = int(arguments['--seed']) if arguments['--seed'] else None
+        buckets = int(arguments['--buckets'])
+        batch_size = int(arguments['--batch'])
+    except ValueError:
+        print 'Error: seed, buckets and batch must be integers'
+        sys.exit(1)
 
-# Create output feature
-dst_feat = ogr.Feature(feature_def = l.GetLayerDefn())
+    format = arguments['--format']
+    if ogr.GetDriverByName(format) is None:
+        print 'Error: unknown output format {0}'.format(format)
+        sys.exit(1)
 
-### SHUFFLE features
-for _out_id in out_id:
-    # Read feature using FID from out_id
-    f = l.GetFeature(_out_id)
-    dst_feat.SetFrom(f)
-    d_l.CreateFeature(dst_feat)
+    shuffle_shp(input, output, format, seed=seed,
+                strata=arguments['--strata'], buckets=buckets,
+                tmpdir=arguments['--tmpdir'], batch_size=batch_size)
 
-assert l.GetFeatureCount() == d_l.GetFeatureCount(), \
-        'Error: input feature count does not match output feature count'
 
-# SAVE shapefile
-in_ds = None
-out_ds = None
+if __name__ == '__main__':
+    arguments = docopt(__doc__)
+    if arguments['--verbose']:
+        VERBOSE = True
+    main()
@@ -1,8 +1,10 @@
 #!/usr/bin/env python
+from concurrent.futures import ThreadPoolExecutor
 import os
 
 import click
 from cligj import format_opt
+import numpy as np
 import pandas as pd
 from pathlib import Path
 import rasterio
@@ -10,6 +12,120 @@ from rasterio.rio import options as rio_opts
 from rasterio.windows import Window
 
 
+def chip_windows(src, chips, shape):
+    """ Return window of each chip within an image, and order of chips by
+    the block of the image they start in
+
+    Args:
+        src (rasterio.DatasetReader): image
+        chips (pd.DataFrame): chips with upper left ``x`` and ``y``
+        shape (tuple): columns and rows of chips
+
+    Returns:
+        tuple: list of windows, and array of chip indexes sorted by block
+    """
+    cols, rows = ~src.transform * (chips['x'].values, chips['y'].values)
+    cols, rows = np.asarray(cols).astype(int), np.asarray(rows).astype(int)
+    windows = [Window.from_offlen(c, r, shape[0], shape[1])
+               for c, r in zip(cols, rows)]
+
+    block_rows, block_cols = src.block_shapes[0]
+    order = np.lexsort((cols // block_cols, rows // block_rows))
+    return windows, order
+
+
+def read_chip(src, window, fill):
+    """ Read a chip, filling any of it beyond the image """
+    inside = (window.col_off >= 0 and window.row_off >= 0 and
+              window.col_off + window.width <= src.width and
+              window.row_off + window.height <= src.height)
+    if inside:
+        return src.read(window=window)
+    return src.read(window=window, boundless=True, fill_value=fill)
+
+
+def extract_image(image, chips, shape, outdir=None, chip_pattern=None,
+                  driver=None):
+    """ Read all chips from one image, writing each to a file or returning
+    them all
+
+    Args:
+        image (Path): image
+        chips (pd.DataFrame): chips with upper left ``x`` and ``y``
+        shape (tuple): columns and rows of chips
+        outdir (Path): directory of chip files, or None to return chips
+        chip_pattern (str): chip filename pattern
+        driver (str): chip file format
+
+    Returns:
+        tuple: image, and array of chips (nchip x band x row x col) if not
+            written to files
+    """
+    with rasterio.open(str(image)) as src:
+        windows, order = chip_windows(src, chips, shape)
+
+        if outdir is None:
+            fill = src.nodata if src.nodata is not None else 0
+            data = np.full((len(windows), src.count, shape[1], shape[0]),
+                           fill, dtype=src.dtypes[0])
+            for i in order:
+                data[i] = read_chip(src, windows[i], fill)
+            return image, data
+
+        out_kwargs = src.meta.copy()
+        out_kwargs['driver'] = driver
+        out_kwargs['width'] = shape[0]
+        out_kwargs['height'] = shape[1]
+
+        records = chips.to_dict('records')
+        for i in order:
+            # Format output filename
+            _chip = dict(records[i], Index=chips.index[i] + 1,  # index on 1
+                         input=image.name)
+            out_image = outdir.joinpath(chip_pattern.format(**_chip))
+            # Make sure output directory exists
+            out_image.parent.mkdir(parents=True, exist_ok=True)
+
+            out_kwargs['transform'] = src.window_transform(windows[i])
+            with rasterio.open(str(out_image), 'w', **out_kwargs) as dst:
+                dst.write(src.read(window=windows[i]))
+
+    return image, None
+
+
+def write_archive(archive, chips, results):
+    """ Write chips from each image into one HDF5 (.h5) or NumPy (.npz)
+    archive
+
+    Each image is an array of its chips (nchip x band x row x col) named by
+    the image file name, next to the chip ``index``, ``name``, ``x`` and
+    ``y``.
+    """
+    columns = {
+        'index': chips.index.values + 1,
+        'name': chips['name'].astype(str).values.astype('S'),
+        'x': chips['x'].values,
+        'y': chips['y'].values
+    }
+
+    if archive.suffix in ('.h5', '.hdf5'):
+        import h5py
+        with h5py.File(str(archive), 'w') as h5:
+            for key, values in columns.items():
+                h5.create_dataset('chips/' + key, data=values)
+            for image, data in results:
+                click.echo('Writing chips for image: {}'.format(image.name))
+                h5.create_dataset('images/' + image.name, data=data,
+                                  chunks=(1, ) + data.shape[1:],
+                                  compression='gzip')
+    else:
+        arrays = dict(('chips_' + k, v) for k, v in columns.items())
+        for image, data in results:
+            click.echo('Read chips for image: {}'.format(image.name))
+            arrays[image.name] = data
+        np.savez_compressed(str(archive), **arrays)
+
+
 @click.command(short_help='Clip out ROIs')
 @click.argument('indir',
                 type=click.Path(exists=True, file_okay=False,
@@ -27,9 +143,14 @@ from rasterio.windows import Window
               help='Output chip filename pattern')
 @click.option('--shape', multiple=True, default=(100, ), type=int,
               help='Shape of chips (cols/rows)', show_default=True)
+@click.option('--archive', type=str, default=None,
+              help='Write all chips into one HDF5 (.h5) or NumPy (.npz) '
+                   'archive in OUTDIR instead of chip files')
+@click.option('--njobs', type=int, default=1, show_default=True,
+              help='Number of images read at once')
 @format_opt
 def clip(indir, chip_csv, outdir,
-         image_pattern, chip_pattern, shape, driver):
+         image_pattern, chip_pattern, shape, archive, njobs, driver):
     """ Output image chips listed in a CSV file
 
     \b
@@ -39,6 +160,9 @@ def clip(indir, chip_csv, outdir,
         * x (float): upper left X coordinate of chip
         * y (float): upper left Y coordinate of chip
 
+    Each image is opened once and all chips are read from it in the order of
+    the blocks of the image they start in. Images are read by a pool of
+    ``--njobs`` threads.
     """
     # Handle 1 or 2 inputs
     if not len(shape):
@@ -48,39 +172,31 @@ def clip(indir, chip_csv, outdir,
 
     indir, chip_csv, outdir = Path(indir), Path(chip_csv), Path(outdir)
     outdir.mkdir(parents=True, exist_ok=True)
+    if archive is not None:
+        archive = outdir.joinpath(archive)
+        if archive.suffix not in ('.h5', '.hdf5', '.npz'):
+            raise click.BadParameter('Archive must be .h5, .hdf5 or .npz',
+                                     param_hint='--archive')
 
     # Chip info
     chips = pd.read_csv(chip_csv)
 
     # Input images
-    images = list(indir.glob(image_pattern))
+    images = sorted(indir.glob(image_pattern))
 
-    for chip in chips.itertuples():
-        _chip = dict(zip(chip._fields, chip))
-        _chip['Index'] += 1  # index on 1
-        for image in images:
-            # Format output filename
-            _chip['input'] = image.name
-            out_image = outdir.joinpath(chip_pattern.format(**_chip))
-            # Make sure output directory exists
-            out_image.parent.mkdir(parents=True, exist_ok=True)
+    kwargs = {} if archive is not None else dict(
+        outdir=outdir, chip_pattern=chip_pattern, driver=driver)
+
+    with ThreadPoolExecutor(max_workers=njobs) as executor:
+        results = executor.map(
+            lambda image: extract_image(image, chips, shape, **kwargs),
+            images)
 
-            with rasterio.open(str(image)) as src:
-                # Formulate chip bounds
-                col, row = map(int, ~src.transform * (chip.x, chip.y))
-                window = Window.from_offlen(col, row, shape[0], shape[1])
-
-                # Form output kwargs
-                out_kwargs = src.meta.copy()
-                out_kwargs['driver'] = driver
-                out_kwargs['width'] = shape[0]
-                out_kwargs['height'] = shape[1]
-                out_kwargs['transform'] = src.window_transform(window)
-
-                click.echo('Writing output for image: {}'
-                           .format(out_image.name))
-                with rasterio.open(str(out_image), 'w', **out_kwargs) as dst:
-                    dst.write(src.read(window=window))
+        if archive is not None:
+            write_archive(archive, chips, results)
+        else:
+            for image, _ in results:
+                click.echo('Wrote chips for image: {}'.format(image.name))
 
 
 if __name__ == '__main__':